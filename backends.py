@@ -0,0 +1,262 @@
+import os
+import sys
+import time
+import shutil
+import hashlib
+import logging
+import argparse
+import importlib.util
+
+import cv2
+import numpy as np
+import supervision as sv
+
+
+logger = logging.getLogger(__name__)
+
+# torch: PyTorch eager execution, onnx: ONNX Runtime, openvino: OpenVINO runtime
+RUNTIMES = ('torch', 'onnx', 'openvino')
+# Packages of the export and the inference of a runtime, installed from requirements-backends.txt
+RUNTIME_PACKAGES = {'onnx': ('onnx', 'onnxruntime'), 'openvino': ('openvino',)}
+runtime = os.getenv("RUNTIME", "torch")
+weights = os.getenv("WEIGHTS", "yolov8n.pt")
+# Detector input size; exported models are built for it
+imgsz = int(os.getenv("IMGSZ", "640"))
+# INT8=1 quantizes the exported model
+int8 = os.getenv("INT8") == "1"
+# Calibration dataset of the OpenVINO INT8 export
+int8_data = os.getenv("INT8_DATA", "coco128.yaml")
+warmup_runs = int(os.getenv("WARMUP_RUNS", "2"))
+model_cache = os.getenv("MODEL_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "dst", "models"))
+
+
+def weights_hash(path, chunk_size=1 << 20):
+    """
+    Returns:
+        The first 16 hex digits of the SHA-256 of the weights file.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+
+def _yolo(*args, **kwargs):
+    # ultralytics pulls in torch; it is imported when the first model is built, not with this module
+    from ultralytics import YOLO
+    return YOLO(*args, **kwargs)
+
+
+def _resolve_weights(path):
+    # Official weights such as yolov8n.pt are downloaded by ultralytics on first use
+    if os.path.exists(path):
+        return path
+    return _yolo(path).ckpt_path
+
+
+def export_model(weights=weights, runtime=runtime, imgsz=imgsz, int8=int8, cache_dir=model_cache):
+    """
+    Exports the weights for a runtime, once; later calls return the cached export.
+
+    The cache key holds the weights hash, so retrained weights under the same
+    name are exported again. Exports have a dynamic input shape, so ROI windows
+    can be detected at other sizes than `imgsz`.
+
+    Args:
+        weights: Path of the PyTorch weights.
+        runtime: 'onnx' or 'openvino'.
+        imgsz: Input size the export is built and calibrated for.
+        int8: Quantize the model to INT8.
+        cache_dir: Directory of the exported models.
+
+    Returns:
+        Path of the exported model (an .onnx file or an OpenVINO model directory).
+    """
+    if runtime not in RUNTIMES[1:]:
+        raise ValueError(f"Cannot export to {runtime!r}, expected one of {RUNTIMES[1:]}")
+    # Fail before a long export that could not be loaded afterwards
+    missing = [package for package in RUNTIME_PACKAGES[runtime] if importlib.util.find_spec(package) is None]
+    if missing:
+        raise ImportError(f"Runtime {runtime} needs {', '.join(missing)}: "
+                          f"pip install -r requirements-backends.txt")
+    weights = _resolve_weights(weights)
+    stem = os.path.splitext(os.path.basename(weights))[0]
+    key = f"{stem}-{weights_hash(weights)}-{imgsz}{'-int8' if int8 else ''}"
+    target = os.path.join(cache_dir, f"{key}.onnx" if runtime == 'onnx' else f"{key}_openvino_model")
+    if os.path.exists(target):
+        logger.info(f'Using cached export {target}')
+        return target
+
+    os.makedirs(cache_dir, exist_ok=True)
+    started = time.perf_counter()
+    # Export next to a copy of the weights so parallel exports of other keys do not collide
+    work_dir = os.path.join(cache_dir, f"{key}.{os.getpid()}.tmp")
+    os.makedirs(work_dir, exist_ok=True)
+    try:
+        work_weights = os.path.join(work_dir, f"{key}.pt")
+        shutil.copyfile(weights, work_weights)
+        model = _yolo(work_weights)
+        if runtime == 'onnx':
+            exported = model.export(format='onnx', imgsz=imgsz, dynamic=True, simplify=True)
+            if int8:
+                # ultralytics has no INT8 ONNX export, weights are quantized by ONNX Runtime
+                from onnxruntime.quantization import QuantType, quantize_dynamic
+                quantized = os.path.join(work_dir, f"{key}.int8.onnx")
+                quantize_dynamic(exported, quantized, weight_type=QuantType.QUInt8)
+                exported = quantized
+        else:
+            exported = model.export(format='openvino', imgsz=imgsz, dynamic=True, int8=int8, data=int8_data)
+        # Rename is atomic: a file replaces a concurrent export of the same key, while a
+        # directory cannot replace one, then the export that was renamed first is used
+        try:
+            os.replace(exported, target)
+        except OSError:
+            if not os.path.exists(target):
+                raise
+            logger.info(f'Using concurrent export {target}')
+            return target
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    logger.info(f'Exported {weights} to {target} in {time.perf_counter() - started:.1f}s')
+    return target
+
+
+def warm_up(model, imgsz=imgsz, runs=warmup_runs):
+    """
+    Runs the detector on blank frames so the first real frame does not pay for
+    lazy initialization (predictor setup, graph compilation, memory pools).
+    """
+    blank = np.zeros((imgsz, imgsz, 3), dtype=np.uint8)
+    started = time.perf_counter()
+    for _ in range(runs):
+        model.predict(source=blank, imgsz=imgsz, verbose=False)
+    if runs:
+        logger.info(f'Warm-up: {runs} runs in {(time.perf_counter() - started) * 1000:.0f} ms')
+
+
+def load_model(weights=weights, runtime=runtime, imgsz=imgsz, int8=int8):
+    """
+    Loads the detector for a runtime, exporting it first if needed, and warms it up.
+
+    Returns:
+        A YOLO model; the predict/track API is the same for every runtime.
+    """
+    if runtime not in RUNTIMES:
+        raise ValueError(f"Unknown runtime {runtime!r}, expected one of {RUNTIMES}")
+    if runtime == 'torch':
+        if int8:
+            logger.warning('INT8 needs the onnx or openvino runtime, running the float model')
+        model = _yolo(weights)
+    else:
+        model = _yolo(export_model(weights, runtime, imgsz, int8), task='detect')
+    logger.info(f'Detector: {weights}, runtime {runtime}, imgsz {imgsz}{", int8" if int8 and runtime != "torch" else ""}')
+    warm_up(model, imgsz)
+    return model
+
+
+def _match(reference, candidate, iou_threshold):
+    """
+    Greedily matches the boxes of two sv.Detections of the same class.
+
+    Returns:
+        List of (reference index, candidate index, iou).
+    """
+    if not len(reference) or not len(candidate):
+        return []
+    iou = sv.box_iou_batch(reference.xyxy, candidate.xyxy)
+    iou[reference.class_id[:, None] != candidate.class_id[None, :]] = 0
+    matches = []
+    for flat in np.argsort(-iou, axis=None):
+        i, j = np.unravel_index(flat, iou.shape)
+        if iou[i, j] < iou_threshold:
+            break
+        if any(i == m[0] or j == m[1] for m in matches):
+            continue
+        matches.append((int(i), int(j), float(iou[i, j])))
+    return matches
+
+
+def parity_check(model, frames, reference=None, imgsz=imgsz, iou_threshold=0.5):
+    """
+    Compares the detections of a model against the PyTorch path.
+
+    Args:
+        model: Model under test, e.g. from load_model(runtime='onnx').
+        frames: List of numpy image arrays.
+        reference: PyTorch YOLO model, loaded from `weights` when None.
+        imgsz: Input size of both models.
+        iou_threshold: Minimum IoU of a matched pair of boxes.
+
+    Returns:
+        Dict with the detection counts, unmatched boxes, mean IoU and the
+        largest confidence difference of the matched boxes, and the ms per
+        frame of both models.
+    """
+    if reference is None:
+        reference = _yolo(weights)
+        warm_up(reference, imgsz)
+    report = {'frames': len(frames), 'reference': 0, 'candidate': 0, 'missing': 0, 'extra': 0,
+              'mean_iou': 0.0, 'max_confidence_diff': 0.0, 'reference_ms': 0.0, 'candidate_ms': 0.0}
+    ious = []
+    for frame in frames:
+        started = time.perf_counter()
+        expected = sv.Detections.from_ultralytics(reference.predict(source=frame, imgsz=imgsz, verbose=False)[0])
+        report['reference_ms'] += (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        actual = sv.Detections.from_ultralytics(model.predict(source=frame, imgsz=imgsz, verbose=False)[0])
+        report['candidate_ms'] += (time.perf_counter() - started) * 1000
+
+        matches = _match(expected, actual, iou_threshold)
+        report['reference'] += len(expected)
+        report['candidate'] += len(actual)
+        report['missing'] += len(expected) - len(matches)
+        report['extra'] += len(actual) - len(matches)
+        for i, j, iou in matches:
+            ious.append(iou)
+            report['max_confidence_diff'] = max(report['max_confidence_diff'],
+                                                abs(float(expected.confidence[i]) - float(actual.confidence[j])))
+    if ious:
+        report['mean_iou'] = float(np.mean(ious))
+    if frames:
+        report['reference_ms'] /= len(frames)
+        report['candidate_ms'] /= len(frames)
+    return report
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Export the detector and check it against PyTorch')
+    parser.add_argument('--runtime', choices=RUNTIMES[1:], default=runtime if runtime != 'torch' else 'onnx')
+    parser.add_argument('--int8', action='store_true', default=int8)
+    parser.add_argument('--imgsz', type=int, default=imgsz)
+    parser.add_argument('--source', default='people-walking.mp4')
+    parser.add_argument('--frames', type=int, default=50)
+    parser.add_argument('--min-recall', type=float, default=0.9,
+                        help='Fail when fewer of the PyTorch detections are matched')
+    args = parser.parse_args()
+
+    cap = cv2.VideoCapture(args.source)
+    frames = []
+    while len(frames) < args.frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    if not frames:
+        sys.exit(f'Cannot read {args.source}')
+
+    model = load_model(runtime=args.runtime, imgsz=args.imgsz, int8=args.int8)
+    report = parity_check(model, frames, imgsz=args.imgsz)
+    for key, value in report.items():
+        print(f'{key:>20}: {value:.3f}' if isinstance(value, float) else f'{key:>20}: {value}')
+
+    recall = 1 - report['missing'] / report['reference'] if report['reference'] else 1.0
+    if recall < args.min_recall:
+        sys.exit(f'Parity check failed: recall {recall:.3f} < {args.min_recall}')
+
+
+if __name__ == "__main__":
+    main()
+# cmd python backends.py --runtime onnx --int8
@@ -0,0 +1,120 @@
+import os
+import sys
+import json
+import time
+import logging
+import sqlite3
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+
+import warm
+from benchmark import synthetic_clip
+from frame_ring import FrameRing
+
+
+logging.basicConfig(level=logging.INFO)
+
+TARGETS = ('server', 'uav', 'uav-warm')
+
+
+def _wait_for_report(path, process=None, timeout=120.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path) as f:
+                return json.load(f)
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f'{process.args} exited with {process.returncode} before its first frame')
+        time.sleep(0.01)
+    raise TimeoutError(f'No first frame within {timeout}s')
+
+
+def time_to_first_frame(launch, report_path):
+    """
+    Returns:
+        Dict with the wall-clock ms from the launch to the first frame and the
+        phases reported by the worker.
+    """
+    if os.path.exists(report_path):
+        os.unlink(report_path)
+    launched_at = time.time()
+    process = launch(report_path)
+    report = _wait_for_report(report_path, process)
+    if process is not None:
+        process.wait(timeout=30)
+    return {'ttff_ms': (report['first_frame_at'] - launched_at) * 1000, 'phases': report['phases']}
+
+
+def fork_view(report_path):
+    # The view is a child of the daemon, its first frame is only seen through the report
+    warm.request({'cmd': 'view', 'n': 1, 'report': report_path, 'exit': True})
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time to first frame of the dst workers')
+    parser.add_argument('--target', choices=TARGETS + ('all',), default='all')
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--source', help='video of the inference server, a long synthetic clip by default')
+    parser.add_argument('--output', help='write the JSON report to this file')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    source = args.source or synthetic_clip(os.path.join(work_dir, 'synthetic.mp4'), frames=3000)
+    report_path = os.path.join(work_dir, 'startup.json')
+    # Workers stop right after their first frame and never open windows
+    env = dict(os.environ, HEADLESS='1', STARTUP_REPORT=report_path, STARTUP_EXIT='1')
+    targets = TARGETS if args.target == 'all' else (args.target,)
+
+    # The views read the operator's selection table, it may not exist yet
+    with sqlite3.connect('tracker_data.db') as conn:
+        conn.execute('CREATE TABLE IF NOT EXISTS tracked_objects (position INTEGER PRIMARY KEY, tracker_id INTEGER)')
+
+    def cold(script, *script_args):
+        return lambda path: subprocess.Popen([sys.executable, script, *script_args], env=env)
+
+    results = {}
+    for target in targets:
+        server = daemon = None
+        try:
+            if target == 'server':
+                launch = cold('inference_server.py', source)
+            elif target == 'uav':
+                # The view attaches to a running server, only its own startup is measured
+                server = subprocess.Popen([sys.executable, 'inference_server.py', source],
+                                          env=dict(os.environ, HEADLESS='1'))
+                ring = FrameRing.attach(timeout=120)
+                ring.close()
+                launch = cold('uav.py', '1')
+            else:
+                daemon = subprocess.Popen([sys.executable, 'warm.py', 'serve', source],
+                                          env=dict(os.environ, HEADLESS='1'))
+                ring = FrameRing.attach(timeout=120)
+                ring.close()
+                launch = fork_view
+
+            runs = [time_to_first_frame(launch, report_path) for _ in range(args.runs)]
+        finally:
+            for process in (server, daemon):
+                if process is not None:
+                    process.terminate()
+                    process.wait(timeout=30)
+
+        ttff = np.array([run['ttff_ms'] for run in runs])
+        results[target] = {'median_ms': float(np.median(ttff)), 'min_ms': float(ttff.min()),
+                           'max_ms': float(ttff.max()), 'runs': runs}
+        logging.info(f'{target}: first frame after {results[target]["median_ms"]:.0f} ms (median of {len(runs)})')
+
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+
+
+if __name__ == "__main__":
+    main()
+# cmd python bench_startup.py --runs 5 --output startup.json
@@ -0,0 +1,101 @@
+import sys
+import json
+import time
+import logging
+
+import cv2
+import numpy as np
+import supervision as sv
+from ultralytics import YOLO
+
+from tracking import TrackingPipeline, weights
+
+
+logging.basicConfig(level=logging.INFO)
+
+
+class DoublePassPipeline:
+    """
+    The previous per-frame work: model.track followed by a second sv.ByteTrack pass.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.tracker = sv.ByteTrack()
+
+    def __call__(self, frame):
+        result = self.model.track(source=frame, persist=True, verbose=False, agnostic_nms=True)[0]
+        detections = sv.Detections.from_ultralytics(result)
+        if result.boxes.id is not None:
+            detections.tracker_id = result.boxes.id.cpu().numpy().astype(int)
+        return self.tracker.update_with_detections(detections)
+
+
+def id_stability(frames_per_id, n_frames):
+    """
+    Tracking quality without ground truth: fewer, longer tracks mean fewer ID switches.
+
+    Args:
+        frames_per_id: Dict tracker_id -> number of frames the ID was seen in.
+        n_frames: Number of processed frames.
+    """
+    lengths = np.array(list(frames_per_id.values()) or [0])
+    return {
+        'unique_ids': len(frames_per_id),
+        'mean_track_length': float(lengths.mean()),
+        'short_tracks': int((lengths < 10).sum()),
+        'new_ids_per_100_frames': 100 * len(frames_per_id) / max(n_frames, 1),
+    }
+
+
+def run(pipeline, source, max_frames):
+    cap = cv2.VideoCapture(source)
+    times = []
+    frames_per_id = {}
+    while len(times) < max_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        start = time.perf_counter()
+        detections = pipeline(frame)
+        times.append(time.perf_counter() - start)
+        for tracker_id in detections.tracker_id:
+            frames_per_id[int(tracker_id)] = frames_per_id.get(int(tracker_id), 0) + 1
+    cap.release()
+
+    # The first frames include model warm-up
+    ms = np.array(times[5:] or times) * 1000
+    report = {
+        'frames': len(times),
+        'ms_mean': float(ms.mean()),
+        'ms_p50': float(np.percentile(ms, 50)),
+        'ms_p95': float(np.percentile(ms, 95)),
+    }
+    report.update(id_stability(frames_per_id, len(times)))
+    return report
+
+
+def main():
+    source = sys.argv[1] if len(sys.argv) > 1 else "people-walking.mp4"
+    max_frames = int(sys.argv[2]) if len(sys.argv) > 2 else 300
+
+    # Every variant gets a fresh model so no tracker state is shared
+    variants = {
+        'double_pass': lambda: DoublePassPipeline(YOLO(weights)),
+        'bytetrack': lambda: TrackingPipeline(YOLO(weights), 'bytetrack'),
+        'ultralytics': lambda: TrackingPipeline(YOLO(weights), 'ultralytics'),
+    }
+    results = {}
+    for name, build in variants.items():
+        logging.info(f'Running {name}')
+        results[name] = run(build(), source, max_frames)
+
+    baseline = results['double_pass']['ms_mean']
+    for name, report in results.items():
+        report['saving_ms_per_frame'] = baseline - report['ms_mean']
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
+# cmd python bench_tracking.py people-walking.mp4 300
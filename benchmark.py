@@ -0,0 +1,334 @@
+import gc
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import resource
+import tempfile
+import subprocess
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+
+import utils
+import metrics
+from capture import VideoFileReader
+from frame_ring import FrameRingReader
+from ptz import PTZDispatcher
+from selection_bus import SelectionBus, SelectionView
+from storage import BackgroundWriter, TrackHistoryStore
+
+
+logging.basicConfig(level=logging.WARNING)
+
+PIPELINES = ('operator', 'uav', 'ip_cam')
+
+
+class StageTimer:
+    """
+    Stage hook of the frame steps: collects the time every stage took in every
+    frame, and the memory a stage allocated at its peak while tracemalloc is tracing.
+
+    A stage entered several times in a frame counts once with the sum of its times.
+    """
+
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.allocations = defaultdict(list)
+        self._frame = {}
+        self._frame_allocations = {}
+
+    @contextmanager
+    def __call__(self, stage):
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self._frame[stage] = self._frame.get(stage, 0) + time.perf_counter_ns() - start
+            if tracing:
+                peak = tracemalloc.get_traced_memory()[1] - before
+                self._frame_allocations[stage] = max(self._frame_allocations.get(stage, 0), peak)
+
+    def frame_done(self, frame_ns):
+        """
+        Records the stages of the finished frame and its total time in ns.
+        """
+        for stage, ns in self._frame.items():
+            self.samples[stage].append(ns)
+        for stage, peak in self._frame_allocations.items():
+            self.allocations[stage].append(peak)
+        self.samples['frame'].append(frame_ns)
+        self._frame.clear()
+        self._frame_allocations.clear()
+
+    def report(self):
+        report = {}
+        for stage, samples in self.samples.items():
+            ms = np.array(samples) / 1e6
+            report[stage] = {
+                'count': len(ms),
+                'mean_ms': float(ms.mean()),
+                'p50_ms': float(np.percentile(ms, 50)),
+                'p95_ms': float(np.percentile(ms, 95)),
+                'p99_ms': float(np.percentile(ms, 99)),
+            }
+            if self.allocations[stage]:
+                kb = np.array(self.allocations[stage]) / 1024
+                report[stage]['alloc_peak_kb_p50'] = float(np.percentile(kb, 50))
+                report[stage]['alloc_peak_kb_max'] = float(kb.max())
+        return report
+
+
+class BenchViewer:
+    """
+    Window stand-in that always counts as watched, so the steps annotate every frame;
+    with `display` the frames are shown too.
+    """
+
+    attached = True
+
+    def __init__(self, name, display=False):
+        self.name = name
+        self.display = display
+
+    def show(self, frame):
+        if self.display:
+            cv2.imshow(self.name, frame)
+            cv2.waitKey(1)
+
+
+def synthetic_clip(path, frames=300, size=(1280, 720), fps=30):
+    """
+    Writes a clip of moving rectangles, for machines without people-walking.mp4.
+    """
+    width, height = size
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, size)
+    rng = np.random.default_rng(0)
+    boxes = rng.integers(0, min(width, height) // 2, size=(8, 2))
+    speeds = rng.integers(-8, 9, size=(8, 2))
+    for i in range(frames):
+        frame = np.full((height, width, 3), 96, dtype=np.uint8)
+        for (x, y), (dx, dy) in zip(boxes, speeds):
+            x, y = (x + dx * i) % (width - 80), (y + dy * i) % (height - 160)
+            cv2.rectangle(frame, (int(x), int(y)), (int(x) + 80, int(y) + 160), (40, 60, 200), -1)
+        writer.write(frame)
+    writer.release()
+    return path
+
+
+def replay(name, source, max_frames, display=False, db_path=None, allocations=False):
+    """
+    Runs the frame step of one entry point over a video file and times every stage.
+
+    'operator' runs detect_mouse_select.OperatorStep, 'uav' the
+    inference_server.ServerStep and the uav.ViewStep behind it, 'ip_cam'
+    ip_cam.CameraStep with a dry-run PTZ dispatcher. They are the steps the
+    entry points run, so target lock, governor, ROI inference, motion gate and
+    PTZ controller follow the same environment settings. The first three tracks
+    that appear are bound to the positions, as an operator would do; the
+    selection reaches the steps through a SelectionBus of its own.
+
+    With `allocations` tracemalloc traces the loop; it slows every stage down,
+    so timings of such a run are not comparable with a normal one.
+
+    Returns:
+        Dict with the stage timings, the mean detector and tracker times, frames
+        per second, peak RSS, garbage collections per generation and, with
+        `allocations`, the tracemalloc peaks.
+    """
+    from tracking import build_pipeline
+
+    detect = build_pipeline()
+    timer = StageTimer()
+    viewer = BenchViewer(name, display)
+    db_path = db_path or os.path.join(tempfile.mkdtemp(), 'bench.db')
+    bus_name = f'dst_bench_selection_{os.getpid()}'
+    bus = SelectionBus.create(bus_name)
+    cap = VideoFileReader(source)
+    history = TrackHistoryStore(name, db_path=db_path)
+    tracked_objects = {}
+    closing = [cap.release, history.close, bus.close]
+
+    def select(tracker_id):
+        tracked_objects[len(tracked_objects) + 1] = tracker_id
+        bus.publish(tracked_objects)
+
+    if name == 'operator':
+        import detect_mouse_select as operator
+        from target_lock import TargetLock, lock_every
+
+        conn = operator.open_database(db_path)
+        writer = BackgroundWriter(db_path)
+        mouse_handler = operator.MouseClickHandler(writer, bus)
+        lock = TargetLock() if lock_every > 1 else None
+        step = operator.OperatorStep(detect, lock, mouse_handler, history, viewer, stage=timer)
+        # Selections go through the handler like clicks, into its own dict
+        tracked_objects = operator.tracked_objects
+        select = mouse_handler.add_remove_object
+
+        def run(frame_index, frame, captured_at):
+            step(frame_index, frame)
+            return mouse_handler.tracker_ids
+
+        closing += [writer.close, conn.close]
+    elif name == 'uav':
+        import uav
+        import inference_server
+
+        server_selection = SelectionView(dict, name=bus_name)
+        server = inference_server.ServerStep(detect, server_selection, source=source,
+                                             ring_name=f'dst_bench_{os.getpid()}', stage=timer)
+        view_selection = SelectionView(dict, name=bus_name)
+        view = uav.ViewStep(detect.names, view_selection, viewer, None, 1, stage=timer)
+        readers = []
+
+        def run(frame_index, frame, captured_at):
+            server(frame_index, frame)
+            # Hand-off from the inference server to the view
+            with timer('transport'):
+                if not readers:
+                    readers.append(FrameRingReader(server.ring))
+                frame, detections, _, _ = readers[0].read()
+            view(frame, detections)
+            return detections.tracker_id
+
+        closing += [server.close, server_selection.close, view_selection.close]
+    else:
+        import ip_cam
+        from ptz_control import ptz_continuous
+
+        dispatcher = PTZDispatcher(utils.commands, min_interval=ip_cam.ptz_min_interval, dry_run=True,
+                                   continuous=ptz_continuous).start()
+        selection = SelectionView(dict, name=bus_name)
+        step = ip_cam.CameraStep(detect, dispatcher, selection, history, viewer, None, 1, stage=timer)
+
+        def run(frame_index, frame, captured_at):
+            step(frame, captured_at)
+            return step.tracked.tracker_id
+
+        closing += [dispatcher.close, selection.close]
+
+    frames = 0
+    gc_before = [generation['collections'] for generation in gc.get_stats()]
+    if allocations:
+        tracemalloc.start()
+    start = time.perf_counter()
+    while frames < max_frames:
+        frame_start = time.perf_counter_ns()
+        with timer('decode'):
+            ret, frame, captured_at = cap.read()
+        if not ret:
+            break
+        frames += 1
+        tracker_ids = run(frames, frame, captured_at)
+        timer.frame_done(time.perf_counter_ns() - frame_start)
+
+        # The operator's clicks, not part of the timed frame
+        if tracker_ids is not None:
+            for tracker_id in tracker_ids.tolist():
+                if len(tracked_objects) >= 3:
+                    break
+                if tracker_id not in tracked_objects.values():
+                    select(tracker_id)
+
+    elapsed = time.perf_counter() - start
+    traced_peak = tracemalloc.get_traced_memory()[1] if allocations else None
+    tracemalloc.stop()
+    gc_collections = [generation['collections'] - before for generation, before in zip(gc.get_stats(), gc_before)]
+    for close in closing:
+        close()
+
+    report = {
+        'frames': frames,
+        'fps': frames / elapsed if elapsed else 0.0,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        # Collections of generation 0 count roughly every 700 container allocations
+        'gc_collections': gc_collections,
+        'stages': timer.report(),
+        # Measured inside the tracking pipeline, detect includes both
+        'inference_mean_ms': metrics.inference_ms.as_dict()['mean'],
+        'tracker_mean_ms': metrics.tracker_ms.as_dict()['mean'],
+    }
+    if allocations:
+        report['tracemalloc_peak_mb'] = traced_peak / 2 ** 20
+    return report
+
+
+def compare(results, baseline, max_drop):
+    """
+    Returns:
+        List of messages for every pipeline whose fps dropped by more than max_drop.
+    """
+    failures = []
+    for name, report in results['pipelines'].items():
+        before = baseline.get('pipelines', {}).get(name)
+        if before is None:
+            continue
+        if report['fps'] < before['fps'] * (1 - max_drop):
+            failures.append(f"{name}: {report['fps']:.1f} fps, baseline {before['fps']:.1f} fps")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Headless replay benchmark of the dst pipelines')
+    parser.add_argument('--pipeline', choices=PIPELINES + ('all',), default='all')
+    parser.add_argument('--source', default='people-walking.mp4')
+    parser.add_argument('--synthetic', action='store_true', help='replay a generated clip instead of --source')
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--display', action='store_true', help='also time cv2.imshow')
+    parser.add_argument('--allocations', action='store_true',
+                        help='trace allocations with tracemalloc (slower, report the peaks per stage)')
+    parser.add_argument('--output', help='write the JSON report to this file')
+    parser.add_argument('--baseline', help='JSON report of a previous run to compare against')
+    parser.add_argument('--max-drop', type=float, default=0.1, help='allowed relative fps drop')
+    args = parser.parse_args()
+
+    source = args.source
+    if args.synthetic:
+        source = synthetic_clip(os.path.join(tempfile.mkdtemp(), 'synthetic.mp4'), frames=args.frames)
+
+    if args.pipeline != 'all':
+        report = replay(args.pipeline, source, args.frames, args.display, allocations=args.allocations)
+        print(json.dumps(report))
+        return
+
+    # Every pipeline in its own process so peak RSS is not shared
+    results = {'source': source, 'frames': args.frames, 'pipelines': {}}
+    for name in PIPELINES:
+        command = [sys.executable, __file__, '--pipeline', name, '--source', source, '--frames', str(args.frames)]
+        if args.display:
+            command.append('--display')
+        if args.allocations:
+            command.append('--allocations')
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        results['pipelines'][name] = json.loads(output.strip().splitlines()[-1])
+
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures = compare(results, json.load(f), args.max_drop)
+        for failure in failures:
+            print(f'Throughput regression - {failure}', file=sys.stderr)
+        if failures:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
+# cmd python benchmark.py --synthetic --output bench.json
+# cmd python benchmark.py --baseline bench.json --max-drop 0.1
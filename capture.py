@@ -0,0 +1,179 @@
+import time
+import logging
+import threading
+
+import cv2
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class FramePool:
+    """
+    Small ring of frames that cv2.VideoCapture decodes into instead of allocating a new one.
+
+    A frame returned by read() stays valid until `size - 1` more frames were
+    read, so a sequential loop can annotate it in place instead of copying it.
+    """
+
+    def __init__(self, size=2):
+        self.buffers = [None] * size
+        self.index = 0
+
+    def read(self, cap):
+        """
+        Returns:
+            Tuple (ret, frame) like cap.read().
+        """
+        buffer = self.buffers[self.index]
+        ret, frame = cap.read(buffer) if buffer is not None else cap.read()
+        if ret:
+            # The first frame of a size (or a size change) becomes the buffer of this slot
+            self.buffers[self.index] = frame
+            self.index = (self.index + 1) % len(self.buffers)
+        return ret, frame
+
+
+class VideoFileReader:
+    """
+    Reads every frame of a file with cv2.VideoCapture into pooled buffers.
+
+    Same read() interface as LatestFrameReader, for loops that accept either.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.cap = cv2.VideoCapture(source)
+        self.pool = FramePool()
+        self.shape = (int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)), 3)
+
+    def read(self, timeout=None):
+        """
+        Returns:
+            Tuple (ret, frame, timestamp); ret is False at the end of the file.
+        """
+        ret, frame = self.pool.read(self.cap)
+        return ret, frame, time.monotonic() if ret else None
+
+    def release(self):
+        self.cap.release()
+
+
+class LatestFrameReader:
+    """
+    Reads a live stream in a background thread and keeps only the newest frame.
+
+    When the consumer is slower than the camera, older frames are dropped
+    instead of piling up in the OpenCV/FFmpeg buffer. Lost streams are
+    reopened with exponential backoff. Frames are decoded into three reused
+    buffers: the newest frame, the one the consumer holds and the one being
+    decoded; a frame stays valid until the next read().
+    """
+
+    def __init__(self, url, reconnect_delay=0.5, max_reconnect_delay=10.0):
+        """
+        Args:
+            url: Stream URL or camera index passed to cv2.VideoCapture.
+            reconnect_delay: First delay in seconds before reopening a lost stream.
+            max_reconnect_delay: Upper bound of the backoff delay.
+        """
+        self.url = url
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.dropped = 0
+        self.reconnects = 0
+
+        self._cond = threading.Condition()
+        self._buffers = [None] * 3
+        # Buffer of the newest frame and of the frame handed to the consumer
+        self._latest = None
+        self._held = None
+        self._timestamp = None
+        self._shape = None
+        self._index = 0
+        self._read_index = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f'capture-{url}', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        cap = None
+        delay = self.reconnect_delay
+        while not self._stop.is_set():
+            if cap is None:
+                cap = cv2.VideoCapture(self.url)
+                if not cap.isOpened():
+                    logger.warning(f'Cannot open {self.url}, retrying in {delay:.1f}s')
+                    cap.release()
+                    cap = None
+                    self._stop.wait(delay)
+                    delay = min(delay * 2, self.max_reconnect_delay)
+                    continue
+
+            with self._cond:
+                slot = next(i for i in range(len(self._buffers)) if i not in (self._latest, self._held))
+            buffer = self._buffers[slot]
+            ret, frame = cap.read(buffer) if buffer is not None else cap.read()
+            timestamp = time.monotonic()
+            if not ret:
+                logger.warning(f'Lost stream {self.url}, reconnecting in {delay:.1f}s')
+                cap.release()
+                cap = None
+                self.reconnects += 1
+                self._stop.wait(delay)
+                delay = min(delay * 2, self.max_reconnect_delay)
+                continue
+            delay = self.reconnect_delay
+
+            with self._cond:
+                if self._index > self._read_index:
+                    self.dropped += 1
+                    metrics.frames_dropped.inc()
+                self._buffers[slot] = frame
+                self._shape = frame.shape
+                self._latest = slot
+                self._timestamp = timestamp
+                self._index += 1
+                self._cond.notify_all()
+
+        if cap is not None:
+            cap.release()
+
+    @property
+    def shape(self):
+        """
+        Shape of the stream's frames; waits for the first frame of a stream that was just
+        opened, at most `max_reconnect_delay` seconds, and is None if none arrived.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._shape is not None, self.max_reconnect_delay)
+            return self._shape
+
+    def read(self, timeout=1.0):
+        """
+        Returns the newest frame that has not been read yet.
+
+        Args:
+            timeout: Seconds to wait for a new frame.
+
+        Returns:
+            Tuple (ret, frame, timestamp) where timestamp is the time.monotonic()
+            of the capture; ret is False if no new frame arrived in time. The
+            frame may be modified in place and is reused after the next read().
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._index > self._read_index, timeout):
+                return False, None, None
+            self._read_index = self._index
+            self._held = self._latest
+            return True, self._buffers[self._latest], self._timestamp
+
+    def release(self):
+        self._stop.set()
+        self._thread.join(timeout=self.max_reconnect_delay)
+        logger.info(f'Capture {self.url}: {self.dropped} frames dropped, {self.reconnects} reconnects')
@@ -1,11 +1,21 @@
+import startup
+import time
+import heapq
 import cv2
 import supervision as sv
 import numpy as np
-from ultralytics import YOLO
 import logging
 import sqlite3
 
 import utils
+import metrics
+import state_api
+from ingest import is_live, open_source
+from storage import DB_PATH, BackgroundWriter, TrackHistoryStore
+from display import open_viewer
+from selection_bus import SelectionBus
+from target_lock import TargetLock, lock_every
+from detection_log import DetectionLog, DetectionRecorder, ReplayDetector, detection_log, replay_log
 
 
 logging.basicConfig(level=logging.INFO)
@@ -16,87 +26,100 @@ max_objects = 3
 tracked_objects = {}
 free_positions = [i for i in range(1, max_objects + 1)]
 
-# Database connection and table creation (assuming 'tracker_data.db')
-conn = sqlite3.connect('tracker_data.db')
-c = conn.cursor()
 
-# Drop the tracked_objects table if it exists
-c.execute('''DROP TABLE IF EXISTS tracked_objects''')
-logging.info(f'DROP TABLE')
-# Create the tracked_objects table
-c.execute('''CREATE TABLE IF NOT EXISTS tracked_objects
-             (position INTEGER PRIMARY KEY, tracker_id INTEGER)''')
-logging.info(f'CREATE TABLE')
+def open_database(db_path=DB_PATH):
+    """
+    Connects to the database and starts the session with an empty tracked_objects table.
 
+    Returns:
+        The sqlite3 connection.
+    """
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
 
-class MyTracker(sv.ByteTrack):
-    def __init__(self):
-        super().__init__()
-        self.boxes = []
-
-    def update(self, detections):
-        self.boxes = detections.boxes.xywh.cpu().numpy()
-
-    def get_boxes(self):
-        return self.boxes
+    # Drop the tracked_objects table if it exists
+    c.execute('''DROP TABLE IF EXISTS tracked_objects''')
+    logging.info(f'DROP TABLE')
+    # Create the tracked_objects table
+    c.execute('''CREATE TABLE IF NOT EXISTS tracked_objects
+                 (position INTEGER PRIMARY KEY, tracker_id INTEGER)''')
+    logging.info(f'CREATE TABLE')
+    conn.commit()
+    return conn
 
 
 class MouseClickHandler:
-    def __init__(self, detections, tracker, max_tracked_objects=max_objects):
-        self.tracker = tracker
+    """
+    Selection engine of the operator window, created once for the whole session.
+
+    Clicks are resolved against the detections of the current frame in memory,
+    the database is only written in the background.
+    """
+
+    def __init__(self, writer, bus, max_tracked_objects=max_objects):
+        """
+        Args:
+            writer: storage.BackgroundWriter that persists the selection.
+            bus: SelectionBus that pushes selection changes to the uav/ip_cam views.
+            max_tracked_objects: Number of positions.
+        """
+        self.writer = writer
+        self.bus = bus
         self.max_tracked_objects = max_tracked_objects
-        self.detections = detections
+        self.xyxy = np.empty((0, 4))
+        self.tracker_ids = np.empty(0, dtype=int)
         self.selected_tracker_id = None
+        heapq.heapify(free_positions)
+
+    def update(self, detections):
+        """
+        Makes the tracked detections of the current frame clickable.
+        """
+        self.xyxy = detections.xyxy
+        self.tracker_ids = detections.tracker_id if detections.tracker_id is not None \
+            else np.empty(0, dtype=int)
+
+    def hit_test(self, x, y):
+        """
+        Finds the object under the cursor; of overlapping boxes the smallest one wins.
+
+        Returns:
+            The tracker ID or None if no box contains the point.
+        """
+        if not len(self.tracker_ids):
+            return None
+        x1, y1, x2, y2 = self.xyxy.T
+        inside = np.flatnonzero((x1 <= x) & (x <= x2) & (y1 <= y) & (y <= y2))
+        if not len(inside):
+            return None
+        areas = (x2[inside] - x1[inside]) * (y2[inside] - y1[inside])
+        # Equal areas are resolved by the lower tracker ID
+        best = inside[np.lexsort((self.tracker_ids[inside], areas))[0]]
+        return int(self.tracker_ids[best])
 
     def add_remove_object(self, tracker_id):
-        tracker_id = str(tracker_id)
-        # Check if tracker_id already exists
-        c.execute("SELECT * FROM tracked_objects WHERE tracker_id = ?", (tracker_id,))
-        existing_entry = c.fetchone()
-
-        if existing_entry:
-            logging.info(f'ID {tracker_id} is already being tracked (position: {existing_entry[0]})')
-            print(f'ID {tracker_id} is already being tracked (position: {existing_entry[0]}')
-            c.execute("DELETE FROM tracked_objects WHERE tracker_id = ?", (tracker_id,))
-            conn.commit()
-            self.update_tracked_objects()
-            logging.info(f"Object removed from position {tracker_id}")
-            return
+        tracker_id = int(tracker_id)
+        for position, tracked_id in tracked_objects.items():
+            if tracked_id == tracker_id:
+                logging.info(f'ID {tracker_id} is already being tracked (position: {position})')
+                del tracked_objects[position]
+                heapq.heappush(free_positions, position)
+                self.bus.publish(tracked_objects)
+                self.writer.execute("DELETE FROM tracked_objects WHERE position = ?", (position,))
+                logging.info(f"Object removed from position {position}")
+                return
 
         # Check for free positions and handle edge cases
-        free_position_id = self.get_next_position_id()
-        if free_position_id is None:
+        if not free_positions:
             logging.warning("No free positions available")
             return
 
-        # Add new object to database
-        c.execute("INSERT INTO tracked_objects (position, tracker_id) VALUES (?, ?)",
-                  (free_position_id, tracker_id))
-        conn.commit()
-
-        logging.info(f'ID {tracker_id} added to tracking at position {free_position_id}')
-        self.update_tracked_objects()
-
-    def update_tracked_objects(self):
-        # Fetch tracked objects from database
-        c.execute("SELECT * FROM tracked_objects")
-        tracked_objects.clear()
-        for row in c.fetchall():
-            tracked_objects[row[0]] = row[1]
-
-    def get_free_position_id(self):
-        # Check for empty positions in the database
-        c.execute("SELECT * FROM tracked_objects")
-        occupied_positions = [row[0] for row in c.fetchall()]
-        free_positions = [i for i in range(1, max_objects + 1) if i not in occupied_positions]
-        return free_positions[0] if free_positions else None
-
-    def get_next_position_id(self):
-        # Check if there are less than max_objects entries
-        c.execute("SELECT COUNT(*) FROM tracked_objects")
-        num_tracked_objects = c.fetchone()[0]
-        if num_tracked_objects < max_objects:
-            return self.get_free_position_id()
+        position = heapq.heappop(free_positions)
+        tracked_objects[position] = tracker_id
+        self.bus.publish(tracked_objects)
+        self.writer.execute("INSERT OR REPLACE INTO tracked_objects (position, tracker_id) VALUES (?, ?)",
+                            (position, tracker_id))
+        logging.info(f'ID {tracker_id} added to tracking at position {position}')
 
     def get_selected_tracker_id(self):
         return self.selected_tracker_id
@@ -104,114 +127,176 @@ class MouseClickHandler:
     def handle_click(self, event, x, y, flags, param):
         if event == cv2.EVENT_LBUTTONDOWN:
             # check whether one of the existing objects is clicked
-            for xyxy, tracker_id in zip(self.detections.xyxy, self.detections.tracker_id):
-                x1, y1, x2, y2 = xyxy
-                # check whether the mouse cursor is inside the object
-                if x1 <= x <= x2 and y1 <= y <= y2:
-                    # Save tracker-ID
-                    self.selected_tracker_id = tracker_id
-                    print(tracker_id)
-                    # add tracker id
-                    self.add_remove_object(self.selected_tracker_id)
-
-    def get_list_tracked_objects(self) -> list:
-        c.execute("SELECT * FROM tracked_objects")
-        data = [row[1] for row in c.fetchall()]
-        conn.commit()
-        logging.info(f'get list tracked objects - {data}')
-        return data
-
-    def get_tracked_objects(self) -> dict:
-        c.execute("SELECT * FROM tracked_objects")
-        # data = dict(c.fetchall())
-        data = {}
-        for row in c.fetchall():
-            data[row[0]] = row[1]
-        conn.commit()
-        logging.info(f'get dictionary tracked objects - {data}')
-        return data
+            tracker_id = self.hit_test(x, y)
+            if tracker_id is None:
+                return
+            # Save tracker-ID
+            self.selected_tracker_id = tracker_id
+            # add tracker id
+            self.add_remove_object(tracker_id)
+
+
+class OperatorStep:
+    """
+    Work of the operator loop on one frame: detection, history, selection and annotation.
+
+    main() and benchmark.py run the same step, the caller only reads the
+    frames and polls the window. `stage` wraps every stage of the frame.
+    """
+
+    def __init__(self, detect, lock, mouse_handler, history, viewer, recorder=None, state=None,
+                 stage=utils.no_stage):
+        """
+        Args:
+            detect: Tracking pipeline or ReplayDetector.
+            lock: TargetLock, or None to run the detector on every frame.
+            mouse_handler: MouseClickHandler of the window.
+            history: TrackHistoryStore of the session.
+            viewer: Viewer the annotated frames are shown in.
+            recorder: DetectionRecorder, or None.
+            state: state_api.TrackState, or None.
+            stage: Callable returning a context manager for a stage name.
+        """
+        self.detect = detect
+        self.lock = lock
+        self.mouse_handler = mouse_handler
+        self.history = history
+        self.viewer = viewer
+        self.recorder = recorder
+        self.state = state
+        self.stage = stage
+        self.hud = utils.HudOverlay()
+        self.label_cache = utils.LabelCache(detect.names)
+
+        self.corner_annotator = sv.BoxCornerAnnotator(
+            color=sv.Color(255, 0, 0),
+            thickness=3
+        )
+
+        self.trace_annotator = sv.TraceAnnotator(
+            trace_length=20,
+            color=sv.Color(255, 0, 0))
+
+        self.label_annotator = sv.LabelAnnotator(
+            text_color=sv.Color(0, 0, 255))
+
+    def __call__(self, frame_index, frame):
+        """
+        Processes and shows one frame.
+
+        Args:
+            frame_index: Index of the frame in the stream.
+            frame: Numpy image array, annotated in place.
+        """
+        stage = self.stage
+        frame_started = time.perf_counter()
+        with stage('detect'):
+            if self.lock is not None:
+                detections, _ = self.lock.step(frame, self.detect, tracked_objects.values())
+            else:
+                detections = self.detect(frame)
+
+        with stage('db'):
+            if self.recorder is not None:
+                self.recorder.record(frame_index, detections)
+            self.history.record(frame_index, detections, tracked_objects.values())
+            if self.state is not None:
+                self.state.update(frame_index, detections, tracked_objects)
+
+        with stage('selection'):
+            self.mouse_handler.update(detections)
+            detections = utils.select_tracks(detections, tracked_objects.values())
+
+        # Annotation only when somebody watches
+        if self.viewer.attached:
+            with stage('annotation'):
+                # # Visualization of the text of the selected object in the upper left corner
+                # The layer is drawn again only when the selection changes
+                if len(detections):
+                    self.hud.apply(frame, tuple(tracked_objects.items()),
+                                   lambda canvas: utils.draw_tracked_objects(canvas, tracked_objects))
+
+                # Visualization of frames
+                labels = self.label_cache(detections)
+
+                # The pooled capture buffer is annotated in place
+                annotated_frame = self.corner_annotator.annotate(
+                    scene=frame,
+                    detections=detections
+                )
+                annotated_frame = self.label_annotator.annotate(
+                    annotated_frame,
+                    detections=detections,
+                    labels=labels)
+                frame = self.trace_annotator.annotate(annotated_frame, detections=detections)
+
+            # Frame display
+            with stage('display'):
+                self.viewer.show(frame)
+        startup.first_frame()
+        metrics.frames.inc()
+        metrics.frame_ms.observe((time.perf_counter() - frame_started) * 1000)
 
 
 def main():
-    model = YOLO("yolov8n.pt")
+    startup.mark('imports')
+    metrics.start()
+    conn = open_database()
+    # Selection changes are pushed to the uav/ip_cam views through shared memory
+    selection_bus = SelectionBus.create()
     source = "people-walking.mp4"
-    tracker = MyTracker()
-
-    box_annotator = sv.BoxAnnotator(
-        thickness=2,
-        text_thickness=1,
-        text_scale=0.5
-    )
-    corner_annotator = sv.BoxCornerAnnotator(
-        color=sv.Color(255, 0, 0),
-        thickness=3
-    )
-
-    trace_annotator = sv.TraceAnnotator(
-        trace_length=20,
-        color=sv.Color(255, 0, 0))
-
-    label_annotator = sv.LabelAnnotator(
-        text_color=sv.Color(0, 0, 255))
+    if replay_log:
+        # Recorded detections instead of the model; they follow the frames one by one
+        detect = ReplayDetector(DetectionLog(replay_log))
+        lock = None
+    else:
+        # The model is only imported when it is used
+        from tracking import build_pipeline
+        detect = build_pipeline()
+        lock = TargetLock() if lock_every > 1 else None
+    startup.mark('model')
+    live = is_live(source)
+    cap = open_source(source, live)
+    recorder = None
+    if detection_log:
+        recorder = DetectionRecorder(detection_log, detect.names, cap.shape, source)
+    writer = BackgroundWriter()
+    history = TrackHistoryStore('operator')
+    # Live selection and targets for other programs, without queries on the database
+    state = state_api.start('operator')
+    mouse_handler = MouseClickHandler(writer, selection_bus)
+
+    viewer = open_viewer('Operator')
+    viewer.set_mouse_callback(mouse_handler.handle_click)
+    step = OperatorStep(detect, lock, mouse_handler, history, viewer, recorder, state)
 
     # Getting results from YOLO
-    for result in model.track(source=source,
-                              show=False,
-                              stream=True,
-                              agnostic_nms=True):
-
-        frame = result.orig_img
-        detections = sv.Detections.from_ultralytics(result)
-
-        if result.boxes.id is not None:
-            detections.tracker_id = result.boxes.id.cpu().numpy().astype(int)
-
-        detections = tracker.update_with_detections(detections)
-        mouse_handler = MouseClickHandler(detections, tracker)
-
-        cv2.namedWindow('Operator', cv2.WINDOW_NORMAL)
-        cv2.setMouseCallback('Operator', mouse_handler.handle_click)
-        # Using the ID selected by the cursor
-        selected_tracker_id = mouse_handler.get_selected_tracker_id()
-        if tracked_objects is not None:
-            detections = detections[
-                np.isin(detections.tracker_id,
-                        mouse_handler.get_list_tracked_objects())
-            ]
-
-        # # Visualization of the text of the selected object in the upper left corner
-        for tracker_id in zip(detections.tracker_id):
-            if tracker_id == selected_tracker_id:
-                utils.draw_tracked_objects(frame, tracker_id)
-            utils.draw_tracked_objects(frame, mouse_handler.get_tracked_objects())
-
-        # Visualization of frames
-        labels = [
-            f"#{tracker_id} {model.model.names[class_id]} {confidence:0.2f}"
-            for confidence, class_id, tracker_id
-            in zip(detections.confidence,
-                   detections.class_id,
-                   detections.tracker_id)
-        ]
-
-        annotated_frame = corner_annotator.annotate(
-            scene=frame.copy(),
-            detections=detections
-        )
-        annotated_frame = label_annotator.annotate(
-            annotated_frame,
-            detections=detections,
-            labels=labels)
-        frame = trace_annotator.annotate(annotated_frame, detections=detections)
-
-        # Frame display
-        cv2.imshow('Operator', frame)
-
-        # Processing of keyboard shortcuts
-        key = cv2.waitKey(1) & 0xFF
-        if key == ord('q'):
+    frame_index = 0
+    while True:
+        ret, frame, _ = cap.read()
+        if not ret and live and not (replay_log and detect.exhausted):
+            # No new frame yet, the reader reconnects lost streams by itself
+            if not viewer.poll():
+                break
+            continue
+        if not ret or (replay_log and detect.exhausted):
             break
+        frame_index += 1
+        step(frame_index, frame)
+
+        # Processing of keyboard shortcuts and shutdown signals
+        if not viewer.poll():
+            break
+
+    cap.release()
+    if recorder is not None:
+        recorder.close()
+    writer.close()
+    history.close()
+    viewer.close()
+    selection_bus.close()
+    conn.close()
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import logging
+
+import numpy as np
+import supervision as sv
+
+
+logger = logging.getLogger(__name__)
+
+# DETECTION_LOG=dir records every frame's detections, REPLAY_LOG=dir feeds them back without a model
+detection_log = os.getenv("DETECTION_LOG")
+replay_log = os.getenv("REPLAY_LOG")
+
+# Column files of a log directory; every detection is one row of each
+COLUMNS = {
+    'xyxy': (np.float32, 4),
+    'confidence': (np.float32, 1),
+    'class_id': (np.int32, 1),
+    'tracker_id': (np.int32, 1),
+}
+# int64 row per frame: frame_index, end row of its detections, timestamp_ns
+INDEX_FIELDS = 3
+
+
+class DetectionRecorder:
+    """
+    Appends the detections of every frame to a columnar binary log.
+
+    Every column is a flat file of fixed-size rows and index.i64 holds the end
+    row of each frame, so the log is read back with np.memmap without parsing.
+    All files are append-only and the index row is written last: a log cut
+    short by a crash still replays up to its last complete frame.
+    """
+
+    def __init__(self, path, names, shape=None, source=None):
+        """
+        Args:
+            path: Log directory, created if needed; an existing log is replaced.
+            names: Dict of class names of the model.
+            shape: Shape of the frames, used for blank frames when replaying without video.
+            source: Video file or stream the detections belong to.
+        """
+        self.path = path
+        self.rows = 0
+        self.frames = 0
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({
+                'names': {int(k): v for k, v in names.items()},
+                'shape': list(shape) if shape is not None else None,
+                'source': source,
+            }, f)
+        self._files = {name: open(os.path.join(path, f'{name}.bin'), 'wb') for name in COLUMNS}
+        self._index = open(os.path.join(path, 'index.i64'), 'wb')
+        logger.info(f'Recording detections to {path}')
+
+    def record(self, frame_index, detections):
+        """
+        Appends the detections of one frame.
+        """
+        n = len(detections)
+        columns = {
+            'xyxy': detections.xyxy,
+            'confidence': detections.confidence if detections.confidence is not None else np.zeros(n),
+            'class_id': detections.class_id if detections.class_id is not None else np.full(n, -1),
+            'tracker_id': detections.tracker_id if detections.tracker_id is not None else np.full(n, -1),
+        }
+        for name, (dtype, _) in COLUMNS.items():
+            self._files[name].write(np.ascontiguousarray(columns[name], dtype=dtype).tobytes())
+        self.rows += n
+        self.frames += 1
+        self._index.write(np.array([frame_index, self.rows, time.time_ns()], dtype=np.int64).tobytes())
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._index.close()
+        logger.info(f'Detection log {self.path}: {self.frames} frames, {self.rows} detections')
+
+
+def _memmap(path, dtype, width):
+    size = os.path.getsize(path) // (np.dtype(dtype).itemsize * width)
+    if not size:
+        return np.empty((0, width), dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r', shape=(size, width))
+
+
+class DetectionLog:
+    """
+    Memory-mapped view of a log written by DetectionRecorder.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        self.names = {int(k): v for k, v in meta['names'].items()}
+        self.shape = tuple(meta['shape']) if meta['shape'] else None
+        self.source = meta['source']
+
+        index = _memmap(os.path.join(path, 'index.i64'), np.int64, INDEX_FIELDS)
+        columns = {name: _memmap(os.path.join(path, f'{name}.bin'), dtype, width)
+                   for name, (dtype, width) in COLUMNS.items()}
+        # Only frames whose rows reached every column file are complete
+        rows = min(len(column) for column in columns.values())
+        self.index = index[:np.searchsorted(index[:, 1], rows, side='right')]
+        self.columns = columns
+        self.starts = np.concatenate(([0], self.index[:-1, 1]))
+        logger.info(f'Replaying {len(self)} frames from {path}')
+
+    def __len__(self):
+        return len(self.index)
+
+    def frame_index(self, i):
+        return int(self.index[i, 0])
+
+    def detections(self, i):
+        """
+        Returns:
+            sv.Detections of the i-th recorded frame.
+        """
+        start, end = int(self.starts[i]), int(self.index[i, 1])
+        return sv.Detections(
+            xyxy=np.asarray(self.columns['xyxy'][start:end], dtype=float),
+            confidence=np.asarray(self.columns['confidence'][start:end, 0], dtype=float),
+            class_id=np.asarray(self.columns['class_id'][start:end, 0], dtype=int),
+            tracker_id=np.asarray(self.columns['tracker_id'][start:end, 0], dtype=int),
+        )
+
+
+class ReplayDetector:
+    """
+    Stands in for a TrackingPipeline: every call returns the next recorded frame's detections.
+    """
+
+    separable = False
+
+    def __init__(self, log):
+        self.log = log
+        self.names = log.names
+        self.position = 0
+
+    @property
+    def exhausted(self):
+        return self.position >= len(self.log)
+
+    def __call__(self, frame):
+        if self.exhausted:
+            return sv.Detections.empty()
+        detections = self.log.detections(self.position)
+        self.position += 1
+        return detections
+
+
+class ReplayReader:
+    """
+    Stands in for a FrameRingReader: yields recorded detections with the frames
+    of the source video, or with blank frames when the video is not available.
+    """
+
+    def __init__(self, log, source=None):
+        self.log = log
+        self.names = log.names
+        self.position = 0
+        self.dropped = 0
+        # True at the end of the log, like a closed FrameRing
+        self.closed = False
+        source = source or log.source
+        self._cap = None
+        if source is not None and os.path.exists(str(source)):
+            import cv2
+            from capture import FramePool
+            self._cap = cv2.VideoCapture(source)
+            self._pool = FramePool()
+        elif log.shape is None:
+            raise ValueError(f'{log.path} has no frame shape and {source} cannot be read')
+        self._frame = None
+
+    def read(self, timeout=None):
+        """
+        Returns:
+            Tuple (frame, detections, frame_index, timestamp_ns) like FrameRingReader.read,
+            or None at the end of the log.
+        """
+        if self.position >= len(self.log):
+            self.closed = True
+            return None
+        frame = None
+        if self._cap is not None:
+            ret, frame = self._pool.read(self._cap)
+            if not ret:
+                self.closed = True
+                return None
+        else:
+            if self._frame is None:
+                self._frame = np.zeros(self.log.shape, dtype=np.uint8)
+            # Annotation draws on the frame, every read gets a clean one
+            frame = self._frame
+            frame.fill(0)
+        i = self.position
+        self.position += 1
+        return frame, self.log.detections(i), self.log.frame_index(i), int(self.log.index[i, 2])
+
+    def close(self):
+        if self._cap is not None:
+            self._cap.release()
@@ -0,0 +1,103 @@
+import os
+import signal
+import logging
+import threading
+
+import cv2
+
+
+logger = logging.getLogger(__name__)
+
+# HEADLESS=1 runs the workers without windows; frames are annotated only while a viewer is attached
+headless = os.getenv("HEADLESS") == "1"
+
+# STREAM_PORT=<port> also streams every view to remote viewers, see streaming.py
+stream_port = int(os.getenv("STREAM_PORT", "0"))
+
+# Set by SIGINT/SIGTERM, every loop stops at the next poll()
+shutdown = threading.Event()
+
+
+def _request_shutdown(signum, frame):
+    logger.info(f'Received signal {signum}, shutting down')
+    shutdown.set()
+
+
+def install_signal_handlers():
+    # Signal handlers can only be installed from the main thread
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGINT, _request_shutdown)
+        signal.signal(signal.SIGTERM, _request_shutdown)
+
+
+class Viewer:
+    """
+    Local OpenCV window, created once.
+    """
+
+    attached = True
+
+    def __init__(self, name):
+        self.name = name
+        cv2.namedWindow(name, cv2.WINDOW_NORMAL)
+
+    def set_mouse_callback(self, callback):
+        cv2.setMouseCallback(self.name, callback)
+
+    def show(self, frame):
+        cv2.imshow(self.name, frame)
+
+    def poll(self):
+        """
+        Processes window events.
+
+        Returns:
+            False when the user pressed 'q' or a shutdown signal arrived.
+        """
+        key = cv2.waitKey(1) & 0xFF
+        return key != ord('q') and not shutdown.is_set()
+
+    def close(self):
+        cv2.destroyWindow(self.name)
+
+
+class HeadlessViewer:
+    """
+    No window and nobody watching: the loops skip annotation entirely.
+    """
+
+    attached = False
+
+    def __init__(self, name):
+        self.name = name
+
+    def set_mouse_callback(self, callback):
+        pass
+
+    def show(self, frame):
+        pass
+
+    def poll(self):
+        return not shutdown.is_set()
+
+    def close(self):
+        pass
+
+
+def open_viewer(name):
+    """
+    Returns:
+        A Viewer, or a HeadlessViewer when HEADLESS=1; wrapped in a
+        streaming.StreamViewer when STREAM_PORT is set.
+    """
+    install_signal_handlers()
+    if headless:
+        logger.info(f'{name}: headless')
+        viewer = HeadlessViewer(name)
+    else:
+        viewer = Viewer(name)
+    if stream_port:
+        # asyncio and the HTTP server are only loaded when streaming is used
+        from streaming import StreamViewer
+        viewer = StreamViewer(viewer)
+    return viewer
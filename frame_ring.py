@@ -0,0 +1,276 @@
+import json
+import time
+import logging
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+import supervision as sv
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+RING_NAME = "dst_frames"
+RING_SLOTS = 8
+MAX_DETECTIONS = 256
+
+# int64 header: write_count, slots, height, width, max_detections, names_len, closed, reserved
+HEADER_FIELDS = 8
+NAMES_BYTES = 16384
+# int64 slot metadata: seq, frame_index, n_detections, timestamp_ns
+SLOT_META = 4
+# float64 detection row: x1, y1, x2, y2, confidence, class_id, tracker_id
+DET_FIELDS = 7
+
+
+def _align(size, alignment=8):
+    return (size + alignment - 1) // alignment * alignment
+
+
+def _slot_size(height, width, max_detections):
+    return _align(SLOT_META * 8 + max_detections * DET_FIELDS * 8 + height * width * 3)
+
+
+class FrameRing:
+    """
+    Shared-memory ring buffer of frames and their detections.
+
+    One writer (the inference server) publishes every frame together with its
+    tracked detections, any number of readers (uav views) attach by name.
+    Every slot is guarded by a sequence counter: odd while it is written,
+    2 * index + 2 once frame `index` is complete.
+    """
+
+    def __init__(self, shm, owner=False):
+        self.shm = shm
+        self.owner = owner
+
+        self._header = np.ndarray((HEADER_FIELDS,), dtype=np.int64, buffer=shm.buf)
+        self.slots = int(self._header[1])
+        self.height = int(self._header[2])
+        self.width = int(self._header[3])
+        self.max_detections = int(self._header[4])
+
+        names_offset = HEADER_FIELDS * 8
+        names_len = int(self._header[5])
+        names = bytes(shm.buf[names_offset:names_offset + names_len])
+        self.names = {int(k): v for k, v in json.loads(names or b"{}").items()}
+
+        self._meta = []
+        self._dets = []
+        self._frames = []
+        offset = names_offset + NAMES_BYTES
+        slot_size = _slot_size(self.height, self.width, self.max_detections)
+        for _ in range(self.slots):
+            self._meta.append(np.ndarray((SLOT_META,), dtype=np.int64, buffer=shm.buf, offset=offset))
+            dets_offset = offset + SLOT_META * 8
+            self._dets.append(np.ndarray((self.max_detections, DET_FIELDS), dtype=np.float64,
+                                         buffer=shm.buf, offset=dets_offset))
+            frame_offset = dets_offset + self.max_detections * DET_FIELDS * 8
+            self._frames.append(np.ndarray((self.height, self.width, 3), dtype=np.uint8,
+                                           buffer=shm.buf, offset=frame_offset))
+            offset += slot_size
+
+    @classmethod
+    def create(cls, shape, names, slots=RING_SLOTS, max_detections=MAX_DETECTIONS, name=RING_NAME):
+        """
+        Creates a new ring, replacing a stale one left behind by a crashed server.
+
+        Args:
+            shape: Shape of the frames that will be published (height, width, 3).
+            names: Dict of class names of the model.
+            slots: Number of frames kept in the ring.
+            max_detections: Maximum number of detections stored per frame.
+            name: Name of the shared memory block.
+
+        Returns:
+            The FrameRing owned by the caller.
+        """
+        height, width = shape[:2]
+        names = json.dumps({int(k): v for k, v in names.items()}).encode()
+        if len(names) > NAMES_BYTES:
+            raise ValueError(f"Class names do not fit into {NAMES_BYTES} bytes")
+
+        size = HEADER_FIELDS * 8 + NAMES_BYTES + slots * _slot_size(height, width, max_detections)
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            logger.warning(f'Removing stale shared memory block {name}')
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+
+        header = np.ndarray((HEADER_FIELDS,), dtype=np.int64, buffer=shm.buf)
+        header[:] = (0, slots, height, width, max_detections, len(names), 0, 0)
+        names_offset = HEADER_FIELDS * 8
+        shm.buf[names_offset:names_offset + len(names)] = names
+        logger.info(f'Created frame ring {name}: {slots} slots of {width}x{height}')
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name=RING_NAME, timeout=None):
+        """
+        Attaches to a ring created by the inference server.
+
+        Args:
+            name: Name of the shared memory block.
+            timeout: Seconds to wait for the server, None waits forever.
+
+        Returns:
+            The attached FrameRing or None if the server did not show up in time.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        waiting_logged = False
+        while True:
+            try:
+                shm = shared_memory.SharedMemory(name=name)
+                break
+            except FileNotFoundError:
+                if deadline is not None and time.monotonic() > deadline:
+                    return None
+                if not waiting_logged:
+                    logger.info(f'Waiting for inference server ({name})')
+                    waiting_logged = True
+                time.sleep(0.2)
+        # Readers must not unlink the block when they exit, only the server does.
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return cls(shm)
+
+    @property
+    def write_count(self):
+        return int(self._header[0])
+
+    @property
+    def closed(self):
+        return bool(self._header[6])
+
+    def publish(self, frame, detections, frame_index):
+        """
+        Writes a frame and its detections into the next slot.
+
+        Args:
+            frame: Numpy image array of the ring's shape.
+            detections: sv.Detections of the frame.
+            frame_index: Index of the frame in the source.
+        """
+        if frame.shape != (self.height, self.width, 3):
+            raise ValueError(f"Frame shape {frame.shape} does not match ring "
+                             f"({self.height}, {self.width}, 3)")
+
+        index = self.write_count
+        slot = index % self.slots
+        meta = self._meta[slot]
+        meta[0] = 2 * index + 1
+
+        n = min(len(detections), self.max_detections)
+        dets = self._dets[slot]
+        dets[:n, :4] = detections.xyxy[:n]
+        dets[:n, 4] = detections.confidence[:n] if detections.confidence is not None else 0
+        dets[:n, 5] = detections.class_id[:n] if detections.class_id is not None else -1
+        dets[:n, 6] = detections.tracker_id[:n] if detections.tracker_id is not None else -1
+        self._frames[slot][...] = frame
+
+        meta[1] = frame_index
+        meta[2] = n
+        meta[3] = time.time_ns()
+        meta[0] = 2 * index + 2
+        self._header[0] = index + 1
+
+    def read(self, index, out=None):
+        """
+        Copies frame `index` out of the ring.
+
+        Args:
+            index: Frame number to read.
+            out: Array of the ring's frame shape to copy the frame into, a new one when None.
+
+        Returns:
+            Tuple (frame, detections, frame_index, timestamp_ns) or None if the
+            slot does not hold that frame (not yet written or already overwritten).
+        """
+        meta = self._meta[index % self.slots]
+        seq = int(meta[0])
+        if seq != 2 * index + 2:
+            return None
+
+        n = int(meta[2])
+        if out is None:
+            frame = self._frames[index % self.slots].copy()
+        else:
+            frame = out
+            np.copyto(frame, self._frames[index % self.slots])
+        dets = self._dets[index % self.slots][:n].copy()
+        frame_index = int(meta[1])
+        timestamp_ns = int(meta[3])
+        if int(meta[0]) != seq:
+            return None
+
+        detections = sv.Detections(
+            xyxy=dets[:, :4],
+            confidence=dets[:, 4],
+            class_id=dets[:, 5].astype(int),
+            tracker_id=dets[:, 6].astype(int),
+        )
+        return frame, detections, frame_index, timestamp_ns
+
+    def close(self):
+        """
+        Detaches from the ring. The owner also marks it closed and removes it.
+        """
+        if self.owner:
+            self._header[6] = 1
+        self._header = None
+        self._meta, self._dets, self._frames = [], [], []
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class FrameRingReader:
+    """
+    Sequential reader of a FrameRing that skips ahead when it falls behind.
+
+    Frames are copied into one reused buffer, so a frame is valid until the next read().
+    """
+
+    def __init__(self, ring):
+        self.ring = ring
+        self._frame = np.empty((ring.height, ring.width, 3), dtype=np.uint8)
+        self.next_index = max(ring.write_count - 1, 0)
+        self.dropped = 0
+
+    def read(self, timeout=5.0):
+        """
+        Returns the next frame from the ring.
+
+        Args:
+            timeout: Seconds to wait for a new frame.
+
+        Returns:
+            Tuple (frame, detections, frame_index, timestamp_ns), or None when the
+            server closed the ring or published nothing within `timeout`.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            count = self.ring.write_count
+            if self.next_index < count:
+                # Keep one slot of margin so the writer does not overwrite the frame we copy
+                behind = count - self.next_index
+                if behind >= self.ring.slots:
+                    self.dropped += behind - 1
+                    metrics.frames_dropped.inc(behind - 1)
+                    self.next_index = count - 1
+
+                item = self.ring.read(self.next_index, out=self._frame)
+                self.next_index += 1
+                if item is None:
+                    self.dropped += 1
+                    metrics.frames_dropped.inc()
+                    continue
+                return item
+
+            if self.ring.closed or time.monotonic() > deadline:
+                return None
+            time.sleep(0.002)
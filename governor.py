@@ -0,0 +1,223 @@
+import os
+import time
+import logging
+
+import metrics
+from roi import STRIDE
+
+
+logger = logging.getLogger(__name__)
+
+# Target time of one frame loop iteration in ms, e.g. 66 for a 15 fps camera; 0 disables the governor
+latency_budget_ms = float(os.getenv("LATENCY_BUDGET_MS", "0"))
+# Smallest detector input size the governor goes down to
+min_imgsz = int(os.getenv("GOVERNOR_MIN_IMGSZ", "320"))
+# Largest number of frames between two detector runs while targets are selected
+max_detect_every = int(os.getenv("GOVERNOR_MAX_DETECT_EVERY", "4"))
+
+
+def build_levels(imgsz, min_imgsz=min_imgsz, max_detect_every=max_detect_every):
+    """
+    Builds the quality ladder, from full quality to the cheapest level.
+
+    Resolution is given up first, then the work on objects nobody follows,
+    then detector runs between which the selected targets are predicted.
+
+    Args:
+        imgsz: Full detector input size, None when the worker does not run the detector.
+        min_imgsz: Smallest input size.
+        max_detect_every: Largest number of frames between two detector runs.
+
+    Returns:
+        List of dicts with imgsz, detect_every and selected_only.
+    """
+    if imgsz is None:
+        sizes = [None]
+    else:
+        sizes = []
+        for scale in (1.0, 0.75, 0.5):
+            size = max(int(imgsz * scale) // STRIDE * STRIDE, min(min_imgsz, imgsz))
+            if size not in sizes:
+                sizes.append(size)
+
+    levels = [{'imgsz': sizes[0], 'detect_every': 1, 'selected_only': False}]
+    if len(sizes) > 1:
+        levels.append({'imgsz': sizes[1], 'detect_every': 1, 'selected_only': False})
+    levels.append({'imgsz': sizes[min(1, len(sizes) - 1)], 'detect_every': 1, 'selected_only': True})
+    if len(sizes) > 2:
+        levels.append({'imgsz': sizes[2], 'detect_every': 1, 'selected_only': True})
+    for detect_every in range(2, max_detect_every + 1):
+        levels.append({'imgsz': sizes[-1], 'detect_every': detect_every, 'selected_only': True})
+    return levels
+
+
+class _Stage:
+    __slots__ = ('governor', 'name', 'start')
+
+    def __init__(self, governor, name):
+        self.governor = governor
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        stages = self.governor.frame_stages
+        stages[self.name] = stages.get(self.name, 0.0) + (time.perf_counter() - self.start) * 1000
+
+
+class LatencyGovernor:
+    """
+    Keeps the frame loop within a latency budget by trading detection quality for time.
+
+    The smoothed frame time is compared with the budget after every frame. The
+    governor steps down the quality ladder (build_levels) when the budget was
+    exceeded for `degrade_after` frames in a row, and steps back up only after
+    `upgrade_after` frames well below it (`upgrade_margin`). A level that had to
+    be left again right after an upgrade doubles the wait before the next
+    upgrade attempt, so a load close to the budget does not make it oscillate.
+    Every stream has its own governor; streams that share a host slow each
+    other down and every governor reacts to its own frame times.
+    """
+
+    def __init__(self, budget_ms=latency_budget_ms, imgsz=None, levels=None, smoothing=0.2,
+                 degrade_after=5, upgrade_after=60, upgrade_margin=0.7, settle=15, name=''):
+        """
+        Args:
+            budget_ms: Target frame time in ms, 0 keeps full quality.
+            imgsz: Full detector input size, None for workers that only render.
+            levels: Quality ladder, build_levels(imgsz) by default.
+            smoothing: Weight of the newest frame time in the moving average.
+            degrade_after: Frames over budget before stepping down.
+            upgrade_after: Frames below upgrade_margin * budget before stepping up.
+            upgrade_margin: Fraction of the budget the frame time must stay below to step up.
+            settle: Frames after a level change before the next decision.
+            name: Stream name in the log.
+        """
+        self.budget_ms = budget_ms
+        self.levels = levels or build_levels(imgsz)
+        self.smoothing = smoothing
+        self.degrade_after = degrade_after
+        self.upgrade_after = upgrade_after
+        self.upgrade_margin = upgrade_margin
+        self.settle = settle
+        self.name = name
+        self.level = 0
+        self.frame_ms = None
+        # Smoothed time of every stage of the frame loop, e.g. detect and render
+        self.stage_ms = {}
+        self.frame_stages = {}
+        self.changes = 0
+        self._over = 0
+        self._under = 0
+        self._settling = 0
+        self._last_upgrade = None
+        self._frame_index = 0
+        # level -> frames to wait before upgrading to it
+        self._upgrade_wait = {}
+
+    @property
+    def enabled(self):
+        return self.budget_ms > 0
+
+    @property
+    def imgsz(self):
+        return self.levels[self.level]['imgsz']
+
+    @property
+    def detect_every(self):
+        return self.levels[self.level]['detect_every']
+
+    @property
+    def selected_only(self):
+        return self.levels[self.level]['selected_only']
+
+    def overrides(self, selected_classes=()):
+        """
+        Returns:
+            predict arguments of the current level: the input size and, when only
+            the selected targets count, their classes.
+        """
+        overrides = {}
+        if self.imgsz is not None and self.level:
+            overrides['imgsz'] = self.imgsz
+        if self.selected_only and len(selected_classes):
+            overrides['classes'] = sorted({int(class_id) for class_id in selected_classes})
+        return overrides
+
+    def stage(self, name):
+        """
+        Returns:
+            Context manager that adds its duration to the stage `name` of this frame.
+        """
+        return _Stage(self, name)
+
+    def frame_done(self, frame_ms):
+        """
+        Records the time of one frame loop iteration and adapts the level.
+
+        Args:
+            frame_ms: Duration of the iteration in ms.
+
+        Returns:
+            True when the level changed.
+        """
+        self._frame_index += 1
+        for name, ms in self.frame_stages.items():
+            previous = self.stage_ms.get(name)
+            self.stage_ms[name] = ms if previous is None else previous + self.smoothing * (ms - previous)
+        self.frame_stages.clear()
+        self.frame_ms = frame_ms if self.frame_ms is None else self.frame_ms + self.smoothing * (frame_ms - self.frame_ms)
+        if not self.enabled:
+            return False
+
+        if self._settling:
+            self._settling -= 1
+            return False
+        if self.frame_ms > self.budget_ms:
+            self._over += 1
+            self._under = 0
+        elif self.frame_ms < self.budget_ms * self.upgrade_margin:
+            self._under += 1
+            self._over = 0
+        else:
+            self._over = self._under = 0
+
+        if self._over >= self.degrade_after and self.level < len(self.levels) - 1:
+            # Leaving a level right after reaching it makes the next attempt wait longer
+            if self._last_upgrade is not None and self._frame_index - self._last_upgrade < 2 * self.upgrade_after:
+                self._upgrade_wait[self.level] = 2 * self._upgrade_wait.get(self.level, self.upgrade_after)
+            self._set_level(self.level + 1)
+            return True
+        if (self.level and self._under >= self._upgrade_wait.get(self.level - 1, self.upgrade_after)
+                and self.predicted_ms(self.level - 1) < self.budget_ms):
+            self._set_level(self.level - 1)
+            self._last_upgrade = self._frame_index
+            return True
+        return False
+
+    def predicted_ms(self, level):
+        """
+        Estimates the frame time at another level from the measured detect stage:
+        detector time grows with the input area and shrinks with the cadence.
+        """
+        detect_ms = self.stage_ms.get('detect')
+        if detect_ms is None:
+            return self.frame_ms
+        current, target = self.levels[self.level], self.levels[level]
+        scale = current['detect_every'] / target['detect_every']
+        if current['imgsz'] and target['imgsz']:
+            scale *= (target['imgsz'] / current['imgsz']) ** 2
+        return self.frame_ms + detect_ms * (scale - 1)
+
+    def _set_level(self, level):
+        stages = ', '.join(f'{name} {ms:.0f} ms' for name, ms in self.stage_ms.items())
+        logger.info(f'Governor{" " + self.name if self.name else ""}: level {self.level} -> {level} '
+                    f'{self.levels[level]} at {self.frame_ms:.0f} ms per frame '
+                    f'(budget {self.budget_ms:.0f} ms{", " + stages if stages else ""})')
+        self.level = level
+        self.changes += 1
+        self._over = self._under = 0
+        self._settling = self.settle
+        metrics.governor_level.set(level)
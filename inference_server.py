@@ -0,0 +1,177 @@
+import startup
+import sys
+import time
+import logging
+import numpy as np
+
+import utils
+import metrics
+import state_api
+from detection_log import DetectionRecorder, detection_log
+from display import install_signal_handlers, shutdown
+from ingest import ingest_full_res, is_live, open_source
+from frame_ring import FrameRing, RING_NAME, RING_SLOTS
+from backends import imgsz
+from governor import LatencyGovernor
+from roi import RoiDetector, roi_inference
+from selection_bus import SelectionView
+from target_lock import TargetLock, lock_every
+from tracking import build_pipeline
+
+
+logging.basicConfig(level=logging.INFO)
+
+
+class ServerStep:
+    """
+    Work of the inference server on one frame: detection and tracking, and the
+    hand-off to the views through the frame ring.
+
+    serve() and benchmark.py run the same step. `stage` wraps every stage of the frame.
+    """
+
+    def __init__(self, detect, selection, state=None, source=None, ring_name=RING_NAME, slots=RING_SLOTS,
+                 governor=None, stage=utils.no_stage):
+        """
+        Args:
+            detect: Tracking pipeline.
+            selection: SelectionView with the operator's selection.
+            state: state_api.TrackState, or None.
+            source: Name of the video source, recorded in the detection log.
+            ring_name: Name of the shared memory block.
+            slots: Number of frames kept in the ring.
+            governor: LatencyGovernor of the server.
+            stage: Callable returning a context manager for a stage name.
+        """
+        self.detect = detect
+        self.selection = selection
+        self.governor = governor or LatencyGovernor(imgsz=imgsz, name='server')
+        # The governor thins out detector runs through the target lock
+        self.lock = TargetLock() if lock_every > 1 or self.governor.enabled else None
+        self.roi = RoiDetector(detect) if roi_inference else None
+        self.state = state
+        self.source = source
+        self.ring_name = ring_name
+        self.slots = slots
+        self.stage = stage
+        self.selected_classes = ()
+        self.ring = None
+        self.recorder = None
+
+    def __call__(self, frame_index, frame, full_frame=None):
+        """
+        Detects and tracks the objects of one frame and publishes both to the ring.
+
+        Args:
+            frame_index: Index of the frame in the stream.
+            frame: Numpy image array.
+            full_frame: Callable returning the full-resolution picture of a downscaled frame, for ROI windows.
+        """
+        stage, governor = self.stage, self.governor
+        frame_started = time.perf_counter()
+
+        with stage('selection'):
+            tracked_objects = self.selection.get()
+            selected_ids = list(tracked_objects.values())
+        overrides = governor.overrides(self.selected_classes)
+        if self.roi is not None:
+            track = lambda frame: self.roi(frame, selected_ids, full_frame, **overrides)
+        else:
+            track = lambda frame: self.detect(frame, **overrides)
+        with stage('detect'), governor.stage('detect'):
+            if self.lock is not None:
+                self.lock.detect_every = max(lock_every, governor.detect_every)
+                detections, _ = self.lock.step(frame, track, selected_ids)
+            else:
+                detections = track(frame)
+
+        with stage('selection'):
+            # Classes of the selected targets, the only ones detected when the governor is at its lower levels
+            if not selected_ids:
+                self.selected_classes = ()
+            elif detections.tracker_id is not None:
+                found = detections.class_id[np.isin(detections.tracker_id, selected_ids)]
+                if len(found):
+                    self.selected_classes = found
+            if governor.selected_only and selected_ids:
+                detections = utils.select_tracks(detections, selected_ids)
+
+        with stage('transport'):
+            if self.ring is None:
+                self.ring = FrameRing.create(frame.shape, self.detect.names, slots=self.slots, name=self.ring_name)
+                if detection_log:
+                    self.recorder = DetectionRecorder(detection_log, self.detect.names, frame.shape, self.source)
+            self.ring.publish(frame, detections, frame_index)
+        with stage('db'):
+            if self.state is not None:
+                self.state.update(frame_index, detections, tracked_objects)
+            if self.recorder is not None:
+                self.recorder.record(frame_index, detections)
+        startup.first_frame()
+        metrics.frames.inc()
+        frame_ms = (time.perf_counter() - frame_started) * 1000
+        metrics.frame_ms.observe(frame_ms)
+        governor.frame_done(frame_ms)
+
+    def close(self):
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.ring is not None:
+            self.ring.close()
+            logging.info(f'Frame ring {self.ring_name} closed')
+
+
+def serve(source="people-walking.mp4", ring_name=RING_NAME, slots=RING_SLOTS):
+    """
+    Runs detection and tracking once and publishes every frame to the frame ring.
+
+    All uav views attach to the same ring, so the model is loaded once and the
+    tracker IDs are the same in every view. With LOCK_EVERY > 1 the selected
+    targets are predicted between detector runs, with ROI_INFERENCE=1 the
+    detector runs on a window around them.
+
+    Args:
+        source: Video file or stream to process.
+        ring_name: Name of the shared memory block.
+        slots: Number of frames kept in the ring.
+    """
+    detect = build_pipeline()
+    startup.mark('model')
+    # ROI windows are cut from the full-resolution frames when the ingest scales them down
+    live = is_live(source)
+    cap = open_source(source, live, full_resolution=roi_inference or ingest_full_res)
+    full_frame = getattr(cap, 'full_frame', None)
+    # The server has no database of its own, selections arrive over the bus
+    selection = SelectionView(dict)
+    state = state_api.start('server')
+    step = ServerStep(detect, selection, state, source, ring_name, slots)
+
+    frame_index = 0
+    try:
+        while not shutdown.is_set():
+            ret, frame, _ = cap.read()
+            if not ret:
+                # A live reader reconnects lost streams by itself, only a file ends
+                if live:
+                    continue
+                break
+            step(frame_index, frame, full_frame)
+            frame_index += 1
+    finally:
+        cap.release()
+        selection.close()
+        if step.roi is not None:
+            logging.info(f'ROI inference: {step.roi.roi_frames} of {frame_index} frames detected in a window')
+        step.close()
+
+
+def main():
+    startup.mark('imports')
+    install_signal_handlers()
+    metrics.start()
+    serve(sys.argv[1] if len(sys.argv) > 1 else "people-walking.mp4")
+
+
+if __name__ == "__main__":
+    main()
+# cmd python inference_server.py
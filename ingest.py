@@ -0,0 +1,356 @@
+import os
+import time
+import shutil
+import logging
+import threading
+import subprocess
+
+import cv2
+import numpy as np
+
+import metrics
+from capture import LatestFrameReader, VideoFileReader
+
+
+logger = logging.getLogger(__name__)
+
+# opencv: cv2.VideoCapture at full resolution, ffmpeg: FFmpeg subprocess that scales while decoding
+INGESTS = ('opencv', 'ffmpeg')
+ingest = os.getenv("INGEST", "opencv")
+ffmpeg_binary = os.getenv("FFMPEG", "ffmpeg")
+# Longest side of the decoded frames, the detector input size by default
+ingest_size = int(os.getenv("INGEST_SIZE", os.getenv("IMGSZ", "640")))
+# INGEST_FULL_RES=1 also passes full-resolution frames, converted to BGR only on request
+ingest_full_res = os.getenv("INGEST_FULL_RES") == "1"
+
+
+def scaled_size(width, height, longest):
+    """
+    Returns:
+        (width, height) with the longest side at most `longest`, even, aspect ratio kept.
+    """
+    scale = min(longest / max(width, height), 1.0)
+    return max(int(width * scale) // 2 * 2, 2), max(int(height * scale) // 2 * 2, 2)
+
+
+def probe(source):
+    """
+    Returns:
+        Tuple (width, height, fps) of a video file or stream.
+    """
+    cap = cv2.VideoCapture(source)
+    try:
+        if not cap.isOpened():
+            raise OSError(f'Cannot open {source}')
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        fps = cap.get(cv2.CAP_PROP_FPS)
+    finally:
+        cap.release()
+    # Streams often report no or absurd rates
+    return width, height, fps if 1 <= fps <= 240 else 25.0
+
+
+def _read_exact(stream, buffer):
+    view = memoryview(buffer).cast('B')
+    received = 0
+    while received < len(view):
+        n = stream.readinto(view[received:])
+        if not n:
+            return False
+        received += n
+    return True
+
+
+class FFmpegReader:
+    """
+    Decodes a file or stream in an FFmpeg subprocess, scaled to the detector size on the way out.
+
+    FFmpeg decodes, scales and converts to BGR in one pass, so Python only
+    reads finished small frames from a pipe into reused buffers. With
+    `full_resolution` the decoded YUV 4:2:0 picture comes through a second
+    pipe as well and is converted to BGR only when full_frame() asks for it.
+
+    Live sources keep only the newest frame, like LatestFrameReader. When the
+    consumer needs longer per frame than the source's frame interval, FFmpeg
+    is restarted to decode keyframes only, and restarted for every frame again
+    once the consumer has enough headroom. Files are read completely unless
+    `realtime` paces them like a camera.
+    """
+
+    def __init__(self, source, size=ingest_size, full_resolution=ingest_full_res, live=True, realtime=False,
+                 keyframe_fallback=True, min_dwell=10.0, reconnect_delay=0.5, max_reconnect_delay=10.0,
+                 ffmpeg=ffmpeg_binary):
+        """
+        Args:
+            source: File path or stream URL.
+            size: Longest side of the decoded frames.
+            full_resolution: Also pass the full-resolution frames for full_frame().
+            live: Drop frames the consumer did not read in time; files are read completely otherwise.
+            realtime: Read a file at its frame rate, standing in for a camera.
+            keyframe_fallback: Decode only keyframes while a live consumer falls behind.
+            min_dwell: Minimum seconds between two switches of the decoding mode.
+            reconnect_delay: First delay in seconds before restarting a lost stream.
+            max_reconnect_delay: Upper bound of the backoff delay.
+            ffmpeg: FFmpeg executable.
+        """
+        if shutil.which(ffmpeg) is None:
+            raise FileNotFoundError(f'FFmpeg executable {ffmpeg!r} not found, install FFmpeg or set FFMPEG')
+        self.source = source
+        self.full_resolution = full_resolution
+        self.live = live
+        self.realtime = realtime
+        self.keyframe_fallback = keyframe_fallback and live
+        self.min_dwell = min_dwell
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.ffmpeg = ffmpeg
+
+        source_width, source_height, self.fps = probe(source)
+        self.source_shape = (source_height, source_width, 3)
+        width, height = scaled_size(source_width, source_height, size)
+        self.shape = (height, width, 3)
+        self.keyframes_only = False
+        self.decoded = 0
+        self.dropped = 0
+        self.reconnects = 0
+        self.mode_switches = 0
+        # Smoothed seconds the consumer spends between two read() calls
+        self.busy = None
+
+        self._buffers = [np.empty(self.shape, dtype=np.uint8) for _ in range(3)]
+        self._yuv = ([np.empty((source_height * 3 // 2, source_width), dtype=np.uint8) for _ in range(3)]
+                     if full_resolution else None)
+        self._cond = threading.Condition()
+        self._latest = None
+        self._held = None
+        self._timestamp = None
+        self._index = 0
+        self._read_index = 0
+        self._returned_at = None
+        self._finished = False
+        self._restart = False
+        self._mode_since = time.monotonic()
+        # Media position of a realtime file when FFmpeg is restarted
+        self._position = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f'ingest-{source}', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _command(self, full_fd=None):
+        command = [self.ffmpeg, '-hide_banner', '-loglevel', 'error', '-nostdin']
+        if self.keyframes_only:
+            command += ['-skip_frame', 'nokey']
+        if self.realtime:
+            command += ['-re', '-ss', f'{self._position:.3f}']
+        if str(self.source).startswith('rtsp://'):
+            command += ['-rtsp_transport', 'tcp']
+        height, width = self.shape[:2]
+        command += ['-i', str(self.source),
+                    '-map', '0:v:0', '-vf', f'scale={width}:{height}:flags=fast_bilinear',
+                    '-pix_fmt', 'bgr24', '-vsync', '0', '-f', 'rawvideo', 'pipe:1']
+        if full_fd is not None:
+            command += ['-map', '0:v:0', '-pix_fmt', 'yuv420p', '-vsync', '0', '-f', 'rawvideo', f'pipe:{full_fd}']
+        return command
+
+    def _spawn(self):
+        if not self.full_resolution:
+            return subprocess.Popen(self._command(), stdout=subprocess.PIPE), None
+        # The full-resolution frames go through a second pipe, FFmpeg writes to it by its fd number
+        full_read, full_write = os.pipe()
+        try:
+            process = subprocess.Popen(self._command(full_write), stdout=subprocess.PIPE, pass_fds=(full_write,))
+        finally:
+            os.close(full_write)
+        return process, os.fdopen(full_read, 'rb')
+
+    def _run(self):
+        try:
+            self._decode()
+        finally:
+            # Also when FFmpeg could not run, so read() does not wait for frames that never come
+            with self._cond:
+                self._finished = True
+                self._cond.notify_all()
+
+    def _decode(self):
+        delay = self.reconnect_delay
+        while not self._stop.is_set():
+            started = time.monotonic()
+            process, full = self._spawn()
+            logger.info(f'Ingest {self.source}: FFmpeg at {self.shape[1]}x{self.shape[0]}'
+                        f'{", keyframes only" if self.keyframes_only else ""}')
+            try:
+                delivered = self._pump(process, full)
+            finally:
+                process.kill()
+                process.wait()
+                process.stdout.close()
+                if full is not None:
+                    full.close()
+            if self.realtime:
+                self._position += time.monotonic() - started
+            if self._stop.is_set():
+                break
+            if self._restart:
+                self._restart = False
+                continue
+            if not self.live:
+                break
+            if delivered:
+                delay = self.reconnect_delay
+            logger.warning(f'Lost stream {self.source}, restarting FFmpeg in {delay:.1f}s')
+            self.reconnects += 1
+            self._stop.wait(delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+    def _pump(self, process, full):
+        """
+        Reads frames until FFmpeg ends, the reader stops or the decoding mode changes.
+
+        Returns:
+            True if at least one frame was read.
+        """
+        delivered = False
+        while not self._stop.is_set():
+            with self._cond:
+                slot = next(i for i in range(len(self._buffers)) if i not in (self._latest, self._held))
+            if not _read_exact(process.stdout, self._buffers[slot]):
+                return delivered
+            if full is not None and not _read_exact(full, self._yuv[slot]):
+                return delivered
+            timestamp = time.monotonic()
+            delivered = True
+            self.decoded += 1
+
+            with self._cond:
+                if not self.live:
+                    # Files are not dropped: wait until the consumer took the previous frame
+                    self._cond.wait_for(lambda: self._index == self._read_index or self._stop.is_set())
+                elif self._index > self._read_index:
+                    self.dropped += 1
+                    metrics.frames_dropped.inc()
+                self._latest = slot
+                self._timestamp = timestamp
+                self._index += 1
+                self._cond.notify_all()
+
+            if self.keyframe_fallback and self._switch_mode():
+                self._restart = True
+                return delivered
+        return delivered
+
+    def _switch_mode(self):
+        """
+        Returns:
+            True when the decoding mode has to change because of the consumer's speed.
+        """
+        now = time.monotonic()
+        if self.busy is None or now - self._mode_since < self.min_dwell:
+            return False
+        interval = 1 / self.fps
+        if not self.keyframes_only and self.busy > 1.5 * interval:
+            self.keyframes_only = True
+        elif self.keyframes_only and self.busy < 0.7 * interval:
+            self.keyframes_only = False
+        else:
+            return False
+        self.mode_switches += 1
+        self._mode_since = now
+        logger.info(f'Ingest {self.source}: consumer needs {self.busy * 1000:.0f} ms per frame, '
+                    f'{"keyframes only" if self.keyframes_only else "every frame"} from now on')
+        return True
+
+    def read(self, timeout=None):
+        """
+        Returns the newest frame that has not been read yet.
+
+        Args:
+            timeout: Seconds to wait for a new frame; None waits 1 s for live
+                sources and until the next frame of a file.
+
+        Returns:
+            Tuple (ret, frame, timestamp) like LatestFrameReader.read; the frame
+            is reused after the next read(). ret is False when no frame arrived
+            in time or a file ended.
+        """
+        if timeout is None and self.live:
+            timeout = 1.0
+        called_at = time.monotonic()
+        if self._returned_at is not None:
+            busy = called_at - self._returned_at
+            # Keyframes are seconds apart, the average has to follow them faster to switch back in time
+            weight = 0.5 if self.keyframes_only else 0.1
+            self.busy = busy if self.busy is None else self.busy + weight * (busy - self.busy)
+        with self._cond:
+            if (not self._cond.wait_for(lambda: self._index > self._read_index or self._finished, timeout)
+                    or self._index == self._read_index):
+                # Waiting is not the consumer's time
+                self._returned_at = time.monotonic()
+                return False, None, None
+            self._read_index = self._index
+            self._held = self._latest
+            self._cond.notify_all()
+            frame, timestamp = self._buffers[self._latest], self._timestamp
+        self._returned_at = time.monotonic()
+        return True, frame, timestamp
+
+    @property
+    def finished(self):
+        """
+        True once a file was read completely (or the reader stopped) and every frame was read.
+        """
+        return self._finished and self._index == self._read_index
+
+    def full_frame(self):
+        """
+        Returns:
+            The full-resolution BGR frame of the last read() frame, or None without `full_resolution`.
+        """
+        if self._yuv is None or self._held is None:
+            return None
+        return cv2.cvtColor(self._yuv[self._held], cv2.COLOR_YUV2BGR_I420)
+
+    def release(self):
+        self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
+        self._thread.join(timeout=self.max_reconnect_delay)
+        logger.info(f'Ingest {self.source}: {self.decoded} frames decoded, {self.dropped} dropped, '
+                    f'{self.reconnects} restarts, {self.mode_switches} mode switches')
+
+
+def is_live(source):
+    """
+    Returns:
+        True for camera indices and stream URLs, False for video files.
+    """
+    return isinstance(source, int) or '://' in str(source)
+
+
+def open_source(source, live=None, full_resolution=ingest_full_res):
+    """
+    Opens a video source with the decoder chosen by INGEST.
+
+    Args:
+        source: File path, stream URL or camera index.
+        live: Keep only the newest frame and reconnect lost streams instead of
+            reading every frame; guessed from the source when None.
+        full_resolution: Keep the full-resolution frames of a scaling reader for its full_frame().
+
+    Returns:
+        A started reader with read() -> (ret, frame, timestamp), `shape` and release().
+    """
+    if ingest not in INGESTS:
+        raise ValueError(f"Unknown ingest {ingest!r}, expected one of {INGESTS}")
+    if live is None:
+        live = is_live(source)
+    # Camera indices are opened by OpenCV, FFmpeg needs a device path for them
+    if ingest == 'ffmpeg' and not isinstance(source, int):
+        return FFmpegReader(source, live=live, full_resolution=full_resolution).start()
+    if live:
+        return LatestFrameReader(source).start()
+    return VideoFileReader(source)
@@ -1,11 +1,26 @@
-import cv2
+import startup
+import os
+import time
+import functools
 import supervision as sv
 import numpy as np
-from ultralytics import YOLO
 import logging
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 
 import utils
+import metrics
+from backends import imgsz
+from ingest import ingest_full_res, open_source
+from display import open_viewer
+from governor import LatencyGovernor
+from motion import MotionGate, motion_gate
+from ptz_control import build_controller, ptz_continuous
+from target_lock import TargetLock, lock_every
+from tracking import BatchCollector, build_pipeline
+from roi import RoiDetector, roi_inference
+from selection_bus import SelectionView
+from storage import TrackHistoryStore
 
 
 logging.basicConfig(filename='ip_cam.log', filemode='w', level=logging.INFO)
@@ -76,93 +91,296 @@ def select_id(n):
         return None
 
 
-# url = f'http://{utils.ip_cam}/videostream.cgi?loginuse={utils.login}&loginpas={utils.password}'
+# url = utils.cam_stream_url(utils.ip_cam)
 url = 0
 logging.info(f"{url}")
 
+# Several PTZ cameras, e.g. IP_CAMS=192.168.0.10,192.168.0.11 - camera i serves position i
+ip_cams = [ip.strip() for ip in os.getenv("IP_CAMS", "").split(",") if ip.strip()]
 
-def device(tracker_id, n):
-    model = YOLO("yolov8n.pt")
-    cap = cv2.VideoCapture(url)
-    frame_count = 0  # Initialize frame counter
-    cadr = 5
-    tracker = sv.ByteTrack()  # lost_track_buffer=40, frame_rate=30
-
-    box_annotator = sv.BoxAnnotator(
-        thickness=2,
-        text_thickness=1,
-        text_scale=0.5
-    )
-    corner_annotator = sv.BoxCornerAnnotator(
-        color=sv.Color(255, 0, 0),
-        thickness=3
-    )
-
-    label_annotator = sv.LabelAnnotator(
-        text_color=sv.Color(0, 0, 255))
+# PTZ commands are only logged unless PTZ_ENABLED=1
+ptz_enabled = os.getenv("PTZ_ENABLED") == "1"
+ptz_min_interval = float(os.getenv("PTZ_MIN_INTERVAL", "0.2"))
 
-    # Getting results from YOLO
-    while True:
-        ret, frame = cap.read()
-        frame_count += 1
-        for result in model.track(source=frame,
-                                  show=False,
-                                  stream=True,
-                                  agnostic_nms=True):
 
-            frame = result.orig_img
-            detections = sv.Detections.from_ultralytics(result)
+def draw_hud(frame, tracked_objects, n):
+    utils.draw_object_for_tracking(frame, tracked_objects, n)
+    utils.draw_center(frame)
 
-            if result.boxes.id is not None:
-                detections.tracker_id = result.boxes.id.cpu().numpy().astype(int)
 
-            detections = tracker.update_with_detections(detections)
+class CameraStep:
+    """
+    Work of one PTZ camera on one frame: detection, history, camera control and annotation.
 
-            cv2.namedWindow(f'Drone-{n}', cv2.WINDOW_NORMAL)
+    device(), multi_device() and benchmark.py run the same step, the caller only reads the
+    frames and polls the window. `stage` wraps every stage of the frame.
+    """
 
+    def __init__(self, detect, dispatcher, selection, history, viewer, tracker_id, n, governor=None,
+                 stage=utils.no_stage):
+        """
+        Args:
+            detect: Tracking pipeline.
+            dispatcher: PTZDispatcher of the camera.
+            selection: SelectionView with the operator's selection.
+            history: TrackHistoryStore of the camera.
+            viewer: Viewer the annotated frames are shown in.
+            tracker_id: Tracker ID selected at startup, None shows every track.
+            n: Position the camera follows.
+            governor: LatencyGovernor of the camera.
+            stage: Callable returning a context manager for a stage name.
+        """
+        self.detect = detect
+        self.dispatcher = dispatcher
+        self.controller = build_controller(dispatcher)
+        self.selection = selection
+        self.history = history
+        self.viewer = viewer
+        self.tracker_id = tracker_id
+        self.n = n
+        self.governor = governor or LatencyGovernor(imgsz=imgsz, name=f'camera-{n}')
+        self.stage = stage
+        self.frame_count = 0
+        self.cadr = 5
+        # The governor thins out detector runs through the target lock
+        self.lock = TargetLock() if lock_every > 1 or self.governor.enabled else None
+        self.roi = RoiDetector(detect) if roi_inference else None
+        self.gate = MotionGate() if motion_gate else None
+        self.selected_classes = ()
+        self.tracked = None
+        self.hud = utils.HudOverlay()
+        self.label_cache = utils.LabelCache(detect.names)
+
+        self.corner_annotator = sv.BoxCornerAnnotator(
+            color=sv.Color(255, 0, 0),
+            thickness=3
+        )
+
+        self.label_annotator = sv.LabelAnnotator(
+            text_color=sv.Color(0, 0, 255))
+
+    def __call__(self, frame, captured_at, full_frame=None):
+        """
+        Processes and shows one frame.
+
+        Args:
+            frame: Numpy image array, annotated in place.
+            captured_at: time.monotonic() of the capture.
+            full_frame: Callable returning the full-resolution picture of a downscaled frame, for ROI windows.
+        """
+        stage, governor, n = self.stage, self.governor, self.n
+        dispatcher = self.dispatcher
+        self.frame_count += 1
+        frame_started = time.perf_counter()
+
+        with stage('selection'):
+            tracked_objects = self.selection.get()
+            selected_ids = get_list_tracked_object(tracked_objects, n) or []
+        overrides = governor.overrides(self.selected_classes)
+        if self.roi is not None:
+            track = lambda frame: self.roi(frame, selected_ids, full_frame, **overrides)
+        else:
+            track = lambda frame: self.detect(frame, **overrides)
+        with stage('detect'), governor.stage('detect'):
+            # A parked camera and a still scene keep the last detections and tracks
+            if self.gate is None or self.gate.check(frame, dispatcher.moving):
+                if self.lock is not None:
+                    self.lock.detect_every = max(lock_every, governor.detect_every)
+                    self.tracked, _ = self.lock.step(frame, track, selected_ids)
+                else:
+                    self.tracked = track(frame)
+        detections = self.tracked
+
+        with stage('selection'):
+            # Classes of the selected targets, the only ones detected when the governor is at its lower levels
+            if not selected_ids:
+                self.selected_classes = ()
+            elif detections.tracker_id is not None:
+                found = detections.class_id[np.isin(detections.tracker_id, selected_ids)]
+                if len(found):
+                    self.selected_classes = found
+            if governor.selected_only and selected_ids:
+                detections = utils.select_tracks(detections, selected_ids)
+        with stage('db'):
+            self.history.record(self.frame_count, detections, tracked_objects.values())
+
+        with stage('selection'):
             # Filter detections based on selected tracker ID
-            if tracker_id is not None:
-                detections = detections[
-                    np.isin(detections.tracker_id,
-                            get_list_tracked_object(get_tracked_objects(), n))
-                ]
+            if self.tracker_id is not None:
+                detections = utils.select_tracks(detections, get_list_tracked_object(tracked_objects, n))
                 # detections = detections[detections.tracker_id == get_tracked_objects()[1]]
 
-            # # Visualization of the text of the selected object in the upper left corner
-            for tracker_id in zip(detections.tracker_id):
-                utils.draw_object_for_tracking(frame, get_tracked_objects(), n)
-                utils.draw_center(frame)
-            ######
-            # Coordinate analysis and camera control every cadr=20 frames
-            if frame_count % cadr == 0:
-                utils.move_cam(frame, detections)
-
-            # Visualization of frames
-            labels = [
-                f"#{tracker_id} {model.model.names[class_id]} {confidence:0.2f}"
-                for confidence, class_id, tracker_id
-                in zip(detections.confidence,
-                       detections.class_id,
-                       detections.tracker_id)
-            ]
-
-            annotated_frame = corner_annotator.annotate(
-                scene=frame.copy(),
-                detections=detections
-            )
-            frame = label_annotator.annotate(
-                annotated_frame,
-                detections=detections,
-                labels=labels)
-
-            cv2.imshow(f'Drone-{n}', frame)
-
-            # Processing of keyboard shortcuts
-        key = cv2.waitKey(1) & 0xFF
-        if key == ord('q'):
+        with stage('ptz'):
+            # Camera control: proportional on every frame, or the grid rule every cadr frames
+            if self.controller is not None:
+                dispatcher.move(*self.controller.update(frame.shape, detections, captured_at,
+                                                        command_latency=dispatcher.command_latency))
+            elif self.frame_count % self.cadr == 0:
+                utils.move_cam(frame, detections, dispatcher=dispatcher)
+
+        # Annotation only when somebody watches
+        if self.viewer.attached:
+            with stage('annotation'):
+                # # Visualization of the text of the selected object in the upper left corner
+                if len(detections):
+                    self.hud.apply(frame, tracked_objects.get(n), lambda canvas: draw_hud(canvas, tracked_objects, n))
+
+                # Visualization of frames
+                labels = self.label_cache(detections)
+
+                # The capture buffer is annotated in place, the reader reuses it after the next read
+                annotated_frame = self.corner_annotator.annotate(
+                    scene=frame,
+                    detections=detections
+                )
+                frame = self.label_annotator.annotate(
+                    annotated_frame,
+                    detections=detections,
+                    labels=labels)
+
+            with stage('display'):
+                self.viewer.show(frame)
+            metrics.latency_ms.observe((time.monotonic() - captured_at) * 1000)
+        startup.first_frame()
+        metrics.frames.inc()
+        frame_ms = (time.perf_counter() - frame_started) * 1000
+        metrics.frame_ms.observe(frame_ms)
+        governor.frame_done(frame_ms)
+
+
+def device(tracker_id, n):
+    # requests is only imported once a camera is controlled
+    from ptz import PTZDispatcher
+
+    detect = build_pipeline()
+    startup.mark('model')
+    # ROI windows are cut from the full-resolution frames when the ingest scales them down
+    cap = open_source(url, live=True, full_resolution=roi_inference or ingest_full_res)
+    full_frame = getattr(cap, 'full_frame', None)
+    dispatcher = PTZDispatcher(utils.commands, min_interval=ptz_min_interval, dry_run=not ptz_enabled,
+                               continuous=ptz_continuous).start()
+    selection = SelectionView(get_tracked_objects)
+    history = TrackHistoryStore(f'camera-{n}')
+    viewer = open_viewer(f'Drone-{n}')
+    step = CameraStep(detect, dispatcher, selection, history, viewer, tracker_id, n)
+
+    # Getting results from YOLO
+    while True:
+        ret, frame, captured_at = cap.read()
+        if not ret:
+            # No new frame yet, the reader reconnects lost streams by itself
+            if not viewer.poll():
+                break
+            continue
+        step(frame, captured_at, full_frame)
+
+        # Processing of keyboard shortcuts and shutdown signals
+        if not viewer.poll():
             break
+    if step.gate is not None:
+        logging.info(f'Motion gate: detector skipped on {step.gate.skipped} of {step.gate.checked} frames')
     cap.release()
-    cv2.destroyAllWindows()
+    dispatcher.close()
+    history.close()
+    viewer.close()
+    selection.close()
+
+    # Close database connection after processing
+    conn.close()
+    logging.info(f'Database connection closed')
+
+
+class _DeferredViewer:
+    """
+    Viewer of a camera step running in a worker thread; the frame is shown later from the main thread.
+    """
+
+    def __init__(self, viewer):
+        self.viewer = viewer
+        self.frame = None
+
+    @property
+    def attached(self):
+        return self.viewer.attached
+
+    def show(self, frame):
+        self.frame = frame
+
+    def flush(self):
+        if self.frame is not None:
+            self.viewer.show(self.frame)
+            self.frame = None
+
+
+def multi_device(cameras):
+    """
+    Runs the CameraStep of several cameras with their detector calls batched into one predict.
+
+    Every camera keeps its own ByteTrack state, target lock, ROI window,
+    motion gate, governor, PTZ commands and window, exactly as in device().
+    The steps of the cameras that delivered a new frame run in parallel
+    threads, and tracking.BatchCollector runs the detections they ask for
+    together.
+
+    Args:
+        cameras: List of (stream url, PTZ command dict); camera i serves position i + 1.
+    """
+    from ptz import PTZDispatcher
+
+    # Every camera needs its own tracker, so the batch always uses the separable backend
+    batch = BatchCollector(build_pipeline(backend='bytetrack'))
+    startup.mark('model')
+    # ROI windows are cut from the full-resolution frames when the ingest scales them down
+    caps = [open_source(stream, live=True, full_resolution=roi_inference or ingest_full_res) for stream, _ in cameras]
+    full_frames = [getattr(cap, 'full_frame', None) for cap in caps]
+    dispatchers = [PTZDispatcher(commands, min_interval=ptz_min_interval, dry_run=not ptz_enabled,
+                                 continuous=ptz_continuous).start()
+                   for _, commands in cameras]
+    # One view per camera, the steps read the selection in parallel
+    selections = [SelectionView(get_tracked_objects) for _ in cameras]
+    histories = [TrackHistoryStore(f'camera-{i + 1}') for i in range(len(cameras))]
+    viewers = [open_viewer(f'Drone-{i + 1}') for i in range(len(cameras))]
+    deferred = [_DeferredViewer(viewer) for viewer in viewers]
+    steps = [CameraStep(batch.member(), dispatchers[i], selections[i], histories[i], deferred[i],
+                        select_id(i + 1), i + 1)
+             for i in range(len(cameras))]
+    executor = ThreadPoolExecutor(max_workers=len(cameras), thread_name_prefix='camera')
+
+    while True:
+        # Gather the latest new frame of every camera that delivered one
+        calls = []
+        for i, cap in enumerate(caps):
+            ret, frame, captured_at = cap.read(timeout=0)
+            if ret:
+                calls.append(functools.partial(steps[i], frame, captured_at, full_frames[i]))
+        if calls:
+            batch.run(executor, calls)
+            for viewer in deferred:
+                viewer.flush()
+        else:
+            # Nothing new from any camera, do not spin
+            time.sleep(0.002)
+
+        # Processing of keyboard shortcuts and shutdown signals of every window
+        if not all([viewer.poll() for viewer in viewers]):
+            break
+
+    for i, step in enumerate(steps):
+        if step.gate is not None:
+            logging.info(f'Camera {i + 1} motion gate: detector skipped on {step.gate.skipped} '
+                         f'of {step.gate.checked} frames')
+    logging.info(f'{batch.batches} batched predicts')
+    executor.shutdown()
+    for cap in caps:
+        cap.release()
+    for dispatcher in dispatchers:
+        dispatcher.close()
+    for history in histories:
+        history.close()
+    for viewer in viewers:
+        viewer.close()
+    for selection in selections:
+        selection.close()
 
     # Close database connection after processing
     conn.close()
@@ -170,6 +388,15 @@ def device(tracker_id, n):
 
 
 def main():
+    utils.load_env()
+    startup.mark('imports')
+    metrics.start()
+    if not ptz_enabled:
+        logging.warning('PTZ dry run: commands are only logged, set PTZ_ENABLED=1 to move the cameras')
+    if len(ip_cams) > 1:
+        multi_device([(utils.cam_stream_url(ip), utils.cam_commands(ip)) for ip in ip_cams])
+        return
+
     # n = int(sys.argv[1])
     n = 1
     device(select_id(n), n)
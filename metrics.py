@@ -0,0 +1,227 @@
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+logger = logging.getLogger(__name__)
+
+# FRAME_LOG=0 switches off every log line that would be written once per frame
+frame_log = os.getenv("FRAME_LOG", "1") != "0"
+# Prometheus text endpoint on http://127.0.0.1:METRICS_PORT/metrics, 0 disables it
+metrics_port = int(os.getenv("METRICS_PORT", "0"))
+# JSON snapshot written to METRICS_DUMP every METRICS_DUMP_INTERVAL seconds
+metrics_dump = os.getenv("METRICS_DUMP")
+metrics_dump_interval = float(os.getenv("METRICS_DUMP_INTERVAL", "10"))
+
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000)
+
+
+class Counter:
+    """
+    Monotonic counter. Increments are not locked: a lost update under
+    contention is cheaper than a lock on every frame.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def prometheus(self):
+        return [f'{self.name} {self.value}']
+
+    def as_dict(self):
+        return self.value
+
+
+class Gauge:
+    """
+    Value that goes up and down, e.g. a queue length or a quality level.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def prometheus(self):
+        return [f'{self.name} {self.value}']
+
+    def as_dict(self):
+        return self.value
+
+
+class Histogram:
+    """
+    Latency histogram with fixed bucket bounds in milliseconds.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS_MS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return Timer(self)
+
+    def prometheus(self):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f'{self.name}_sum {self.sum}')
+        lines.append(f'{self.name}_count {self.count}')
+        return lines
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else 0.0,
+            'buckets': dict(zip([str(b) for b in self.buckets] + ['+Inf'], self.counts)),
+        }
+
+
+class Timer:
+    """
+    Context manager that observes the elapsed monotonic time in milliseconds.
+    """
+
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe((time.perf_counter_ns() - self.start) / 1e6)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help):
+        metric = self.metrics.get(name)
+        if metric is None:
+            with self._lock:
+                metric = self.metrics.setdefault(name, cls(name, help))
+        return metric
+
+    def counter(self, name, help=''):
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help=''):
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name, help=''):
+        return self._get(Histogram, name, help)
+
+    def prometheus(self):
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(metric.prometheus())
+        return '\n'.join(lines) + '\n'
+
+    def as_dict(self):
+        return {name: metric.as_dict() for name, metric in list(self.metrics.items())}
+
+
+registry = Registry()
+
+frames = registry.counter('dst_frames_total', 'Frames processed')
+frames_dropped = registry.counter('dst_frames_dropped_total', 'Frames skipped because a stage fell behind')
+db_queries = registry.counter('dst_db_queries_total', 'SQLite statements executed')
+ptz_commands = registry.counter('dst_ptz_commands_total', 'PTZ commands sent to the camera')
+governor_level = registry.gauge('dst_governor_level', 'Quality level of the latency governor, 0 is full quality')
+frame_ms = registry.histogram('dst_frame_ms', 'Time of one frame loop iteration')
+inference_ms = registry.histogram('dst_inference_ms', 'Detector time per frame')
+tracker_ms = registry.histogram('dst_tracker_ms', 'Tracker time per frame')
+latency_ms = registry.histogram('dst_latency_ms', 'Capture to display latency')
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/metrics':
+            body = registry.prometheus().encode()
+            content_type = 'text/plain; version=0.0.4'
+        elif self.path == '/metrics.json':
+            body = json.dumps(registry.as_dict()).encode()
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port):
+    """
+    Serves /metrics (Prometheus text) and /metrics.json from a background thread.
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    logger.info(f'Metrics on http://127.0.0.1:{server.server_address[1]}/metrics')
+    return server
+
+
+def dump_periodically(path, interval):
+    """
+    Writes a JSON snapshot of all metrics to `path` every `interval` seconds.
+    """
+    def run():
+        while True:
+            time.sleep(interval)
+            tmp = f'{path}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(registry.as_dict(), f)
+            os.replace(tmp, path)
+
+    threading.Thread(target=run, name='metrics-dump', daemon=True).start()
+
+
+def start():
+    """
+    Starts the endpoint and the JSON dump configured in the environment.
+    """
+    if metrics_port:
+        serve(metrics_port)
+    if metrics_dump:
+        dump_periodically(metrics_dump, metrics_dump_interval)
@@ -0,0 +1,81 @@
+import os
+import logging
+
+import cv2
+
+
+logger = logging.getLogger(__name__)
+
+# MOTION_GATE=1 skips the detector in ip_cam.py while the camera is parked and the scene is still
+motion_gate = os.getenv("MOTION_GATE") == "1"
+# Fraction of the downsampled pixels that must change to run the detector
+motion_threshold = float(os.getenv("MOTION_THRESHOLD", "0.002"))
+# The detector runs at least every MOTION_REFRESH frames
+motion_refresh = int(os.getenv("MOTION_REFRESH", "30"))
+
+
+class MotionGate:
+    """
+    Decides per frame whether the detector has to run, by frame differencing on a tiny copy.
+
+    Every frame is shrunk to `width` pixels (nearest neighbour, so only the
+    sampled pixels are read) and compared with the copy taken at the last
+    detector run, not with the previous frame, so slow changes add up until
+    they count. A pixel's difference is the largest one of its color
+    channels: a red target on a grey background has almost the same
+    grayscale value. While the camera moves or every `refresh_every` frames
+    the detector runs anyway.
+    """
+
+    def __init__(self, threshold=motion_threshold, refresh_every=motion_refresh, width=160, pixel_threshold=20):
+        """
+        Args:
+            threshold: Fraction of changed pixels above which the scene counts as changed.
+            refresh_every: Maximum number of frames between two detector runs.
+            width: Width of the small copy; the height keeps the aspect ratio.
+            pixel_threshold: Channel difference above which a pixel counts as changed.
+        """
+        self.threshold = threshold
+        self.refresh_every = refresh_every
+        self.width = width
+        self.pixel_threshold = pixel_threshold
+        self.reference = None
+        self.since_detection = 0
+        self.skipped = 0
+        self.checked = 0
+
+    def _small(self, frame):
+        height, width = frame.shape[:2]
+        size = (self.width, max(round(height * self.width / width), 1))
+        small = cv2.resize(frame, size, interpolation=cv2.INTER_NEAREST)
+        # Sensor noise must not count as motion
+        return cv2.GaussianBlur(small, (3, 3), 0)
+
+    def check(self, frame, camera_moving=False):
+        """
+        Args:
+            frame: Numpy image array.
+            camera_moving: True while a PTZ movement runs, the gate is open then.
+
+        Returns:
+            True when the detector has to run on this frame.
+        """
+        self.checked += 1
+        small = self._small(frame)
+        if (camera_moving or self.reference is None or self.reference.shape != small.shape
+                or self.since_detection + 1 >= self.refresh_every or self._changed(small)):
+            self.reference = small
+            self.since_detection = 0
+            return True
+        self.since_detection += 1
+        self.skipped += 1
+        return False
+
+    def _changed(self, small):
+        difference = cv2.absdiff(small, self.reference)
+        if difference.ndim == 3:
+            # Much faster than numpy's max over the channel axis
+            blue, green, red = cv2.split(difference)
+            difference = cv2.max(cv2.max(blue, green), red)
+        changed = cv2.countNonZero(cv2.threshold(difference, self.pixel_threshold, 255, cv2.THRESH_BINARY)[1])
+        return changed > self.threshold * difference.size
@@ -0,0 +1,419 @@
+import os
+import sys
+import time
+import queue
+import signal
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+PIPELINE_NAME = "dst_pipeline"
+# Frames in flight between decode and render; every one owns a shared-memory slot
+pipeline_slots = int(os.getenv("PIPELINE_SLOTS", "6"))
+# Capacity of the metadata queue between two stages
+pipeline_queue = int(os.getenv("PIPELINE_QUEUE", "2"))
+
+# What a stage does when the queue to the next stage is full:
+# block waits, drop_newest discards the frame being handed over, drop_oldest replaces the oldest queued one
+DROP_POLICIES = ('block', 'drop_newest', 'drop_oldest')
+
+# float64 detection row: x1, y1, x2, y2, confidence, class_id, tracker_id (same layout as frame_ring)
+DET_FIELDS = 7
+
+
+def pack_detections(detections):
+    """
+    Returns:
+        The sv.Detections as one (n, DET_FIELDS) float64 array, cheap to send through a queue.
+    """
+    rows = np.empty((len(detections), DET_FIELDS))
+    rows[:, :4] = detections.xyxy
+    rows[:, 4] = detections.confidence if detections.confidence is not None else 0
+    rows[:, 5] = detections.class_id if detections.class_id is not None else -1
+    rows[:, 6] = detections.tracker_id if detections.tracker_id is not None else -1
+    return rows
+
+
+def unpack_detections(rows, tracked=True):
+    import supervision as sv
+
+    return sv.Detections(
+        xyxy=rows[:, :4],
+        confidence=rows[:, 4],
+        class_id=rows[:, 5].astype(int),
+        tracker_id=rows[:, 6].astype(int) if tracked else None,
+    )
+
+
+class SlotPool:
+    """
+    Fixed set of frame-sized shared-memory slots.
+
+    A slot belongs to exactly one stage at a time: decode takes a free one and
+    writes the frame into it, the slot index travels with the metadata through
+    the queues and render gives it back. The frame itself is never copied
+    between processes.
+    """
+
+    def __init__(self, shm, shape, slots, owner=False):
+        self.shm = shm
+        self.shape = tuple(shape)
+        self.slots = slots
+        self.owner = owner
+        size = int(np.prod(self.shape))
+        self.frames = [np.ndarray(self.shape, dtype=np.uint8, buffer=shm.buf, offset=i * size)
+                       for i in range(slots)]
+
+    @classmethod
+    def create(cls, shape, slots=pipeline_slots, name=PIPELINE_NAME):
+        size = int(np.prod(shape)) * slots
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            logger.warning(f'Removing stale shared memory block {name}')
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        return cls(shm, shape, slots, owner=True)
+
+    @classmethod
+    def attach(cls, shape, slots, name=PIPELINE_NAME):
+        # The stage processes are spawned by the runner and share its resource tracker,
+        # so the block stays registered once and is unlinked by the runner only
+        shm = shared_memory.SharedMemory(name=name)
+        return cls(shm, shape, slots)
+
+    def close(self):
+        self.frames = []
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class Stage:
+    """
+    Worker side of one pipeline stage: its input and output queues, drop
+    accounting and the shared stop event.
+    """
+
+    def __init__(self, name, inbox, outbox, free, stop, policy='block'):
+        if policy not in DROP_POLICIES:
+            raise ValueError(f"Unknown drop policy {policy!r}, expected one of {DROP_POLICIES}")
+        self.name = name
+        self.inbox = inbox
+        self.outbox = outbox
+        self.free = free
+        self.stop = stop
+        self.policy = policy
+        self.processed = 0
+        self.dropped = 0
+        self.busy = 0.0
+
+    def get(self):
+        """
+        Returns:
+            The next item, or None at the end of the stream or on shutdown.
+        """
+        while not self.stop.is_set():
+            try:
+                return self.inbox.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
+
+    def put(self, item):
+        """
+        Hands an item (slot, ...) to the next stage according to the drop policy.
+        Slots of dropped items go back to the free pool.
+        """
+        if self.policy == 'block':
+            while not self.stop.is_set():
+                try:
+                    self.outbox.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+            self.free.put(item[0])
+            return
+
+        try:
+            self.outbox.put_nowait(item)
+            return
+        except queue.Full:
+            pass
+        self.dropped += 1
+        if self.policy == 'drop_newest':
+            self.free.put(item[0])
+            return
+        # drop_oldest: the consumer may take the oldest item meanwhile, then the put simply succeeds
+        try:
+            oldest = self.outbox.get_nowait()
+            self.free.put(oldest[0])
+        except queue.Empty:
+            pass
+        try:
+            self.outbox.put_nowait(item)
+        except queue.Full:
+            self.free.put(item[0])
+
+    def finish(self):
+        """
+        Passes the end of the stream on; never dropped.
+        """
+        if self.outbox is not None:
+            while not self.stop.is_set():
+                try:
+                    self.outbox.put(None, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+        busy_ms = self.busy / self.processed * 1000 if self.processed else 0.0
+        logger.info(f'Stage {self.name}: {self.processed} frames, {self.dropped} dropped, {busy_ms:.1f} ms/frame')
+
+
+def _worker(target, *args):
+    # Ctrl+C reaches the whole process group, only the runner handles it
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=logging.INFO)
+    target(*args)
+
+
+def _decode(source, shape, slots, stage, live):
+    import cv2
+    from ingest import open_source
+
+    pool = SlotPool.attach(shape, slots)
+    # The reader of the other entry points: INGEST decoder, live frame dropping and reconnects
+    cap = open_source(source, live)
+    frame_index = 0
+    resized = False
+    try:
+        while not stage.stop.is_set():
+            try:
+                # A live reader keeps only the newest frame while every slot is in flight
+                slot = stage.free.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            started = time.perf_counter()
+            ret, frame, _ = cap.read()
+            if not ret:
+                stage.free.put(slot)
+                if live:
+                    # No new frame yet, the reader reconnects lost streams by itself
+                    continue
+                break
+            view = pool.frames[slot]
+            if frame.shape == view.shape:
+                view[...] = frame
+            else:
+                # The slots keep the size of the first frame when a stream changes its resolution
+                if not resized:
+                    logger.warning(f'{source} changed to {frame.shape[1]}x{frame.shape[0]}, '
+                                   f'frames are scaled to {view.shape[1]}x{view.shape[0]}')
+                    resized = True
+                cv2.resize(frame, (view.shape[1], view.shape[0]), dst=view)
+            stage.busy += time.perf_counter() - started
+            stage.processed += 1
+            stage.put((slot, frame_index, time.time_ns()))
+            frame_index += 1
+    finally:
+        stage.dropped += getattr(cap, 'dropped', 0)
+        cap.release()
+        stage.finish()
+        pool.close()
+
+
+def _infer(shape, slots, stage):
+    from tracking import build_pipeline
+
+    pool = SlotPool.attach(shape, slots)
+    detect = build_pipeline()
+    try:
+        while True:
+            item = stage.get()
+            if item is None:
+                break
+            slot, frame_index, captured_ns = item
+            started = time.perf_counter()
+            frame = pool.frames[slot]
+            if detect.separable:
+                detections = detect.detect(frame)
+            else:
+                # The ultralytics tracker cannot run on its own, it tracks here already
+                detections = detect(frame)
+            stage.busy += time.perf_counter() - started
+            stage.processed += 1
+            stage.put((slot, frame_index, captured_ns, pack_detections(detections), not detect.separable,
+                       detect.names))
+    finally:
+        stage.finish()
+        pool.close()
+
+
+def _track(stage):
+    import supervision as sv
+    from selection_bus import SelectionView
+
+    tracker = sv.ByteTrack()
+    selection = SelectionView(dict)
+    try:
+        while True:
+            item = stage.get()
+            if item is None:
+                break
+            slot, frame_index, captured_ns, rows, tracked, names = item
+            started = time.perf_counter()
+            detections = unpack_detections(rows, tracked)
+            if not tracked:
+                with metrics.tracker_ms.time():
+                    detections = tracker.update_with_detections(detections)
+            tracked_objects = selection.get()
+            selected = np.isin(detections.tracker_id, list(tracked_objects.values()))
+            stage.busy += time.perf_counter() - started
+            stage.processed += 1
+            stage.put((slot, frame_index, captured_ns, pack_detections(detections), selected, tracked_objects,
+                       names))
+    finally:
+        stage.finish()
+        selection.close()
+
+
+def _render(shape, slots, stage):
+    from governor import LatencyGovernor
+    from display import open_viewer
+    from uav import ViewStep
+
+    pool = SlotPool.attach(shape, slots)
+    viewer = open_viewer('Pipeline')
+    step = None
+    try:
+        while True:
+            item = stage.get()
+            if item is None:
+                break
+            slot, frame_index, captured_ns, rows, selected, tracked_objects, names = item
+            if step is None:
+                # The annotation of the drone views, over every position
+                step = ViewStep(names, None, viewer, None, None, LatencyGovernor(name='pipeline'))
+            started = time.perf_counter()
+            detections = unpack_detections(rows)
+            # With targets selected only they are shown
+            if selected.any():
+                detections = detections[selected]
+            # The slot is ours until it is freed, annotate it in place
+            step(pool.frames[slot], detections, tracked_objects)
+            stage.free.put(slot)
+            stage.busy += time.perf_counter() - started
+            stage.processed += 1
+            if not viewer.poll():
+                stage.stop.set()
+                break
+    finally:
+        stage.finish()
+        viewer.close()
+        pool.close()
+
+
+def _probe(source, live):
+    from ingest import open_source
+
+    # The reader decides the frame size, e.g. the scaled frames of INGEST=ffmpeg
+    cap = open_source(source, live)
+    try:
+        shape = cap.shape
+    finally:
+        cap.release()
+    if not shape or not shape[0]:
+        raise RuntimeError(f'Cannot read {source}')
+    return tuple(shape)
+
+
+def run(source="people-walking.mp4", slots=pipeline_slots, queue_size=pipeline_queue, live=None, policies=None):
+    """
+    Runs decode, inference, tracking + selection and rendering in four processes.
+
+    Frames stay in a SlotPool, the queues only carry slot indices and detection
+    arrays. Tracking needs every detected frame, so its input always blocks;
+    decode and render follow the drop policies, by default the newest frame
+    wins for live sources and a file is processed completely.
+
+    Args:
+        source: Video file or stream.
+        slots: Number of shared-memory frame slots.
+        queue_size: Capacity of every queue between two stages.
+        live: Whether the source is a live stream; guessed from the source when None.
+        policies: Dict stage name -> drop policy of its output queue ('decode', 'infer', 'track').
+    """
+    if live is None:
+        from ingest import is_live
+
+        live = is_live(source)
+    drop = 'drop_oldest' if live else 'block'
+    policies = {'decode': drop, 'infer': 'block', 'track': drop, **(policies or {})}
+
+    shape = _probe(source, live)
+    pool = SlotPool.create(shape, slots)
+    ctx = multiprocessing.get_context('spawn')
+    stop = ctx.Event()
+    free = ctx.Queue()
+    for slot in range(slots):
+        free.put(slot)
+    decoded, inferred, tracked = (ctx.Queue(queue_size) for _ in range(3))
+
+    stages = [
+        (_decode, (source, shape, slots, Stage('decode', None, decoded, free, stop, policies['decode']), live)),
+        (_infer, (shape, slots, Stage('infer', decoded, inferred, free, stop, policies['infer']))),
+        (_track, (Stage('track', inferred, tracked, free, stop, policies['track']),)),
+        (_render, (shape, slots, Stage('render', tracked, None, free, stop))),
+    ]
+    processes = [ctx.Process(target=_worker, args=(target, *args), name=f'pipeline-{target.__name__[1:]}')
+                 for target, args in stages]
+    logger.info(f'Pipeline {source}: {slots} slots of {shape[1]}x{shape[0]}, policies {policies}')
+
+    def _request_stop(signum, frame):
+        logger.info(f'Received signal {signum}, stopping the pipeline')
+        stop.set()
+
+    previous = signal.signal(signal.SIGINT, _request_stop), signal.signal(signal.SIGTERM, _request_stop)
+    started = time.perf_counter()
+    for process in processes:
+        process.start()
+    try:
+        # Render exits last, after the end-of-stream marker passed every stage
+        while processes[-1].is_alive() and not stop.is_set():
+            failed = [process.name for process in processes if process.exitcode not in (None, 0)]
+            if failed:
+                logger.error(f'{", ".join(failed)} failed, stopping the pipeline')
+                stop.set()
+                break
+            processes[-1].join(timeout=0.2)
+        for process in processes:
+            process.join(timeout=5.0)
+            if process.is_alive():
+                logger.warning(f'{process.name} did not stop, terminating')
+                process.terminate()
+    finally:
+        signal.signal(signal.SIGINT, previous[0])
+        signal.signal(signal.SIGTERM, previous[1])
+        pool.close()
+    logger.info(f'Pipeline finished in {time.perf_counter() - started:.1f}s')
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    source = sys.argv[1] if len(sys.argv) > 1 else "people-walking.mp4"
+    run(int(source) if source.isdigit() else source)
+
+
+if __name__ == "__main__":
+    main()
+# cmd python pipeline.py people-walking.mp4
@@ -0,0 +1,212 @@
+import math
+import time
+import logging
+import threading
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+
+class PTZDispatcher:
+    """
+    Sends PTZ commands from a background thread so the frame loop never waits for HTTP.
+
+    Only the newest movement is kept: a movement that was not sent yet is
+    replaced by the next one. Commands go out through one keep-alive session
+    and never more often than every `min_interval` seconds.
+
+    submit() sends one step per axis, move() a movement proportional to its
+    magnitude: a number of steps `min_interval` apart, or with `continuous` a
+    start command followed by the stop command after a proportional time. A
+    newer movement cuts a continuous one short and waits for the steps of one
+    in progress.
+
+    The latency of a movement is measured once, on its first command.
+    """
+
+    def __init__(self, commands, min_interval=0.2, timeout=2.0, dry_run=False, continuous=False,
+                 move_duration=1.0, max_steps=4, settle=0.5):
+        """
+        Args:
+            commands: Dict of command URLs from utils.cam_commands.
+            min_interval: Minimum seconds between two movements.
+            timeout: HTTP timeout in seconds.
+            dry_run: Only log the commands instead of sending them.
+            continuous: Send move() as timed continuous movements instead of steps.
+            move_duration: Seconds of continuous movement for a magnitude of 1.
+            max_steps: Number of steps for a magnitude of 1.
+            settle: Seconds the camera is assumed to keep moving after the last command.
+        """
+        self.commands = commands
+        self.min_interval = min_interval
+        self.timeout = timeout
+        self.dry_run = dry_run
+        self.continuous = continuous
+        self.move_duration = move_duration
+        self.max_steps = max_steps
+        self.settle = settle
+        self.sent = 0
+        self.dropped = 0
+        self.failed = 0
+        # Seconds from submit() to the camera's reply to the first command of a movement
+        self.latencies = deque(maxlen=1000)
+
+        self._session = requests.Session()
+        self._session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self._pending = None
+        self._sending = False
+        self._last_command = None
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='ptz-dispatcher', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    @property
+    def command_latency(self):
+        """
+        Median seconds from submitting a movement to the camera's reply, 0 before the first one.
+        """
+        latencies = sorted(self.latencies)
+        return latencies[len(latencies) // 2] if latencies else 0.0
+
+    @property
+    def moving(self):
+        """
+        True while a movement is queued or sent, and for `settle` seconds after the last command.
+        """
+        if self._pending is not None or self._sending:
+            return True
+        return self._last_command is not None and time.monotonic() - self._last_command < self.settle
+
+    def submit(self, horizontal, vertical):
+        """
+        Queues a movement, replacing a stale one.
+
+        Args:
+            horizontal: -1 for the 'left' command, 1 for 'right', 0 for none.
+            vertical: -1 for the 'up' command, 1 for 'down', 0 for none.
+        """
+        self._queue(horizontal, vertical, False)
+
+    def move(self, horizontal, vertical):
+        """
+        Queues a proportional movement, replacing a stale one.
+
+        Args:
+            horizontal: -1..1, negative for the 'left' command, positive for 'right'.
+            vertical: -1..1, negative for the 'up' command, positive for 'down'.
+        """
+        self._queue(horizontal, vertical, True)
+
+    def _queue(self, horizontal, vertical, proportional):
+        if not horizontal and not vertical:
+            return
+        with self._cond:
+            if self._pending is not None:
+                self.dropped += 1
+            self._pending = (horizontal, vertical, time.monotonic(), proportional)
+            self._cond.notify()
+
+    def _run(self):
+        next_allowed = 0.0
+        while not self._stop.is_set():
+            with self._cond:
+                self._cond.wait_for(lambda: self._pending is not None or self._stop.is_set())
+            if self._stop.is_set():
+                break
+
+            # Rate limit; movements submitted meanwhile replace the pending one
+            delay = next_allowed - time.monotonic()
+            if delay > 0 and self._stop.wait(delay):
+                break
+
+            with self._cond:
+                movement, self._pending = self._pending, None
+                self._sending = movement is not None
+            if movement is None:
+                continue
+            try:
+                self._send(*movement)
+            finally:
+                self._sending = False
+            next_allowed = time.monotonic() + self.min_interval
+
+    def _send(self, horizontal, vertical, submitted_at, proportional=False):
+        axes = []
+        if horizontal:
+            axes.append(('right' if horizontal > 0 else 'left', min(abs(horizontal), 1.0)))
+        if vertical:
+            axes.append(('down' if vertical > 0 else 'up', min(abs(vertical), 1.0)))
+
+        if proportional and self.continuous:
+            self._send_continuous(axes, submitted_at)
+            return
+        first = True
+        for name, magnitude in axes:
+            steps = max(math.ceil(magnitude * self.max_steps), 1) if proportional else 1
+            for _ in range(steps):
+                # Every step keeps the rate limit
+                if not first and self._stop.wait(self.min_interval):
+                    return
+                sent = self._command(name, submitted_at if first else None)
+                first = False
+                if not sent:
+                    break
+
+    def _send_continuous(self, axes, submitted_at):
+        moving = []
+        for name, _ in axes:
+            if self._command(f'{name}_start', submitted_at):
+                moving.append(name)
+            submitted_at = None
+        started = time.monotonic()
+        # Stop every axis after its own duration, the shortest first
+        for name, magnitude in sorted(axes, key=lambda axis: axis[1]):
+            if name not in moving:
+                continue
+            remaining = started + magnitude * self.move_duration - time.monotonic()
+            if remaining > 0:
+                with self._cond:
+                    # A newer movement or close() ends the current one early
+                    self._cond.wait_for(lambda: self._pending is not None or self._stop.is_set(), remaining)
+            self._command(f'{name}_stop', None)
+
+    def _command(self, name, submitted_at):
+        """
+        Sends one command URL.
+
+        Returns:
+            False if the request failed.
+        """
+        if self.dry_run:
+            logger.debug(f'turn {name}')
+        else:
+            try:
+                self._session.get(self.commands[name], timeout=self.timeout)
+            except requests.RequestException as e:
+                self.failed += 1
+                logger.warning(f'PTZ command {name} failed: {e}')
+                return False
+        self.sent += 1
+        self._last_command = time.monotonic()
+        metrics.ptz_commands.inc()
+        if submitted_at is not None:
+            self.latencies.append(time.monotonic() - submitted_at)
+        return True
+
+    def close(self):
+        self._stop.set()
+        with self._cond:
+            self._cond.notify()
+        self._thread.join(timeout=self.timeout)
+        self._session.close()
+        logger.info(f'PTZ: {self.sent} commands sent, {self.dropped} stale dropped, {self.failed} failed')
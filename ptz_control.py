@@ -0,0 +1,463 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+from collections import deque
+
+import numpy as np
+import supervision as sv
+
+
+logger = logging.getLogger(__name__)
+
+# proportional: PTZController, grid: the 3x3 rule of utils.move_cam every `cadr` frames
+ptz_control = os.getenv("PTZ_CONTROL", "proportional")
+# PTZ_CONTINUOUS=1 sends timed continuous movements instead of one-step commands
+ptz_continuous = os.getenv("PTZ_CONTINUOUS") == "1"
+# Offset in half frames that a full movement corrects; calibrate per camera with the simulator
+ptz_reach = float(os.getenv("PTZ_REACH", "0.5"))
+
+
+def target_error(shape, detections):
+    """
+    Offset of the targets from the frame center.
+
+    Args:
+        shape: Frame shape (height, width, ...).
+        detections: sv.Detections of the targets; several targets are merged into their mean center.
+
+    Returns:
+        Tuple (x, y) in -1..1 of the half frame size, positive right/below of the center,
+        or None without detections.
+    """
+    if not len(detections):
+        return None
+    height, width = shape[:2]
+    xyxy = detections.xyxy
+    cx = float((xyxy[:, 0] + xyxy[:, 2]).mean()) / 2
+    cy = float((xyxy[:, 1] + xyxy[:, 3]).mean()) / 2
+    return (cx - width / 2) / (width / 2), (cy - height / 2) / (height / 2)
+
+
+class PTZController:
+    """
+    Proportional, latency-compensated pan/tilt controller.
+
+    Every target position is stored relative to where the camera was pointing
+    when the frame was captured, so the fitted velocity is the target's own
+    and not the camera's. The target is extrapolated to the moment a new
+    command takes effect (the frame's age plus the measured command latency),
+    the movements already sent are subtracted, and the camera moves in
+    proportion to what is left. Offsets inside the deadband are left alone.
+    Step movements are spread over their steps, which the dispatcher sends
+    `min_interval` apart, pan before tilt.
+    """
+
+    proportional = True
+
+    def __init__(self, gain=0.8, deadband=0.08, history=6, reach=(1.0, 1.0), move_duration=0.0,
+                 min_interval=0.2, max_steps=4):
+        """
+        Args:
+            gain: Fraction of the predicted offset corrected by one movement.
+            deadband: Offset (fraction of the half frame) below which the camera does not move.
+            history: Number of target positions used for the velocity fit.
+            reach: Offset (x, y) in half frames that a movement of magnitude 1 corrects.
+            move_duration: Seconds a movement of magnitude 1 takes, 0 for steps.
+            min_interval: Minimum seconds between two commands, as in ptz.PTZDispatcher.
+            max_steps: Number of steps for a magnitude of 1, as in ptz.PTZDispatcher.
+        """
+        self.gain = gain
+        self.deadband = deadband
+        self.reach = reach
+        self.move_duration = move_duration
+        self.min_interval = min_interval
+        self.max_steps = max_steps
+        # (timestamp, x, y) of the target relative to the initial camera direction
+        self.samples = deque(maxlen=history)
+        # (start, end, dx, dy) camera movements in half frames, start == end for steps
+        self.moves = []
+        self.settled = np.zeros(2)
+        self.next_command = 0.0
+
+    def camera_offset(self, t):
+        """
+        Returns:
+            How far (x, y) the commanded movements have turned the camera by time t, in half frames.
+        """
+        offset = self.settled.copy()
+        for start, end, dx, dy in self.moves:
+            if t <= start:
+                continue
+            done = 1.0 if end <= start else min((t - start) / (end - start), 1.0)
+            offset += (dx * done, dy * done)
+        return offset
+
+    def velocity(self):
+        """
+        Returns:
+            Least-squares velocity (x, y) of the target per second, in half frames.
+        """
+        if len(self.samples) < 2:
+            return np.zeros(2)
+        samples = np.array(self.samples)
+        t = samples[:, 0] - samples[:, 0].mean()
+        denominator = float((t * t).sum())
+        if denominator <= 0:
+            return np.zeros(2)
+        return (t[:, None] * (samples[:, 1:] - samples[:, 1:].mean(axis=0))).sum(axis=0) / denominator
+
+    def update(self, shape, detections, captured_at, now=None, command_latency=0.0):
+        """
+        Decides the movement for the newest frame.
+
+        Args:
+            shape: Frame shape.
+            detections: sv.Detections of the selected targets in this frame.
+            captured_at: time.monotonic() of the frame's capture.
+            now: Current time.monotonic(), defaults to the actual time.
+            command_latency: Seconds from sending a command to the camera acting on it.
+
+        Returns:
+            Tuple (horizontal, vertical) in -1..1 with the sign convention of
+            utils.move_cam and ptz.PTZDispatcher.move; (0, 0) for no movement.
+        """
+        now = time.monotonic() if now is None else now
+        error = target_error(shape, detections)
+        if error is None:
+            self.samples.clear()
+            return 0, 0
+        position = np.array(error) + self.camera_offset(captured_at)
+        self.samples.append((captured_at, *position))
+        if now < self.next_command:
+            return 0, 0
+
+        # Where the target will be in the image when the next command takes effect
+        effective = now + command_latency
+        predicted = position + self.velocity() * (effective - captured_at) - self.camera_offset(effective)
+        pan, tilt = (0.0 if abs(offset) < self.deadband else float(np.clip(self.gain * offset / reach, -1, 1))
+                     for offset, reach in zip(predicted, self.reach))
+        if not pan and not tilt:
+            return 0, 0
+
+        busy = self._plan(effective, pan, tilt)
+        self.next_command = now + busy + self.min_interval
+        # move_cam's convention: a target left of the center is the 'right' command
+        return -pan, tilt
+
+    def _steps(self, magnitude):
+        return max(int(np.ceil(abs(magnitude) * self.max_steps)), 1) if magnitude else 0
+
+    def _plan(self, start, pan, tilt):
+        """
+        Returns:
+            Seconds the dispatcher needs to send the steps of the new movement.
+        """
+        moves = []
+        for move in self.moves:
+            begin, end, dx, dy = move
+            if end <= start - 5.0:
+                # Long finished, only its displacement matters
+                self.settled += (dx, dy)
+            elif self.move_duration and end > start:
+                # A new continuous movement cuts the running one short
+                done = max(start - begin, 0.0) / (end - begin)
+                if done:
+                    moves.append((begin, start, dx * done, dy * done))
+            else:
+                moves.append(move)
+        if self.move_duration:
+            # Every axis stops after its own time, like in the dispatcher
+            if pan:
+                moves.append((start, start + abs(pan) * self.move_duration, pan * self.reach[0], 0.0))
+            if tilt:
+                moves.append((start, start + abs(tilt) * self.move_duration, 0.0, tilt * self.reach[1]))
+            self.moves = moves
+            return 0.0
+        # The steps of both axes follow each other min_interval apart
+        pan_steps, tilt_steps = self._steps(pan), self._steps(tilt)
+        if pan:
+            moves.append((start, start + (pan_steps - 1) * self.min_interval, pan * self.reach[0], 0.0))
+        if tilt:
+            tilt_start = start + pan_steps * self.min_interval
+            moves.append((tilt_start, tilt_start + (tilt_steps - 1) * self.min_interval, 0.0, tilt * self.reach[1]))
+        self.moves = moves
+        return (pan_steps + tilt_steps - 1) * self.min_interval
+
+
+def build_controller(dispatcher):
+    """
+    Returns:
+        The PTZController configured for the dispatcher, or None for the grid rule.
+    """
+    if ptz_control == 'grid':
+        return None
+    return PTZController(reach=(ptz_reach, ptz_reach),
+                         move_duration=dispatcher.move_duration if dispatcher.continuous else 0.0,
+                         min_interval=dispatcher.min_interval, max_steps=dispatcher.max_steps)
+
+
+class GridController:
+    """
+    The previous rule for comparison: utils.move_cam every `cadr` frames.
+    """
+
+    proportional = False
+
+    def __init__(self, cadr=5):
+        self.cadr = cadr
+        self.frame_count = 0
+
+    def update(self, shape, detections, captured_at, now=None, command_latency=0.0):
+        import utils
+
+        self.frame_count += 1
+        if self.frame_count % self.cadr:
+            return 0, 0
+        return utils.move_cam(np.empty(shape, dtype=np.uint8), detections, commands={}, dispatcher=_Discard())
+
+
+class _Discard:
+    def submit(self, horizontal, vertical):
+        pass
+
+
+class SimulatedPTZ:
+    """
+    Virtual pan/tilt camera: a crop window moving over recorded full-size frames.
+
+    Commands take effect `latency` seconds after they are sent. A step moves
+    the window by `step` pixels, a continuous movement at `speed` pixels per
+    second for `move_duration` seconds per unit of magnitude. Like the
+    dispatcher, steps go out `min_interval` apart and a newer movement waits
+    for them. The sign
+    convention is the real camera's: 'right' moves the view to the left.
+    """
+
+    def __init__(self, shape, window, latency=0.15, step=40, speed=480, move_duration=1.0, max_steps=4,
+                 continuous=False, min_interval=0.2):
+        """
+        Args:
+            shape: Shape of the recorded frames.
+            window: (width, height) of the simulated camera image.
+            latency: Seconds from a command to the start of the movement.
+            step: Pixels of one step.
+            speed: Pixels per second of a continuous movement.
+            move_duration: Seconds of continuous movement for a magnitude of 1.
+            max_steps: Number of steps for a magnitude of 1.
+            continuous: Carry out proportional movements continuously instead of in steps.
+            min_interval: Seconds between two steps.
+        """
+        self.height, self.width = shape[:2]
+        self.window = window
+        self.latency = latency
+        self.step = step
+        self.speed = speed
+        self.move_duration = move_duration
+        self.max_steps = max_steps
+        self.continuous = continuous
+        self.min_interval = min_interval
+        # When the steps of the previous movement are all sent
+        self.free_at = 0.0
+        self.x = (self.width - window[0]) / 2
+        self.y = (self.height - window[1]) / 2
+        # (start, end, velocity x, velocity y) of commanded movements; steps have start == end
+        self.moves = []
+        self.commands = 0
+
+    def calibration(self):
+        """
+        Returns:
+            PTZController arguments matching this camera: the reach of a movement
+            of magnitude 1 in half windows and its duration.
+        """
+        pixels = self.speed * self.move_duration if self.continuous else self.step * self.max_steps
+        return {
+            'reach': (pixels / (self.window[0] / 2), pixels / (self.window[1] / 2)),
+            'move_duration': self.move_duration if self.continuous else 0.0,
+            'min_interval': self.min_interval,
+            'max_steps': self.max_steps,
+        }
+
+    def move(self, horizontal, vertical, now, proportional=True):
+        """
+        Sends a movement with the sign convention of ptz.PTZDispatcher.move,
+        or of PTZDispatcher.submit (one step per axis) when not proportional.
+        """
+        start = now + self.latency
+        sent = max(now, self.free_at)
+        if proportional and self.continuous and (horizontal or vertical):
+            # Like the dispatcher, a new movement stops the running one
+            self.moves = [(begin, min(end, start) if end > begin else end, vx, vy)
+                          for begin, end, vx, vy in self.moves if begin < start or end == begin]
+        for magnitude, axis in ((-horizontal, 0), (vertical, 1)):
+            if not magnitude:
+                continue
+            self.commands += 1
+            direction = np.sign(magnitude)
+            if proportional and self.continuous:
+                velocity = [0.0, 0.0]
+                velocity[axis] = direction * self.speed
+                self.moves.append((start, start + abs(magnitude) * self.move_duration, *velocity))
+            else:
+                steps = max(int(np.ceil(abs(magnitude) * self.max_steps)), 1) if proportional else 1
+                offset = [0.0, 0.0]
+                offset[axis] = direction * self.step
+                for _ in range(steps):
+                    self.moves.append((sent + self.latency, sent + self.latency, *offset))
+                    sent += self.min_interval
+                self.free_at = sent
+
+    def advance(self, now):
+        """
+        Applies the movements up to `now` and returns the window (x1, y1, x2, y2).
+        """
+        remaining = []
+        for start, end, vx, vy in self.moves:
+            if start > now:
+                remaining.append((start, end, vx, vy))
+                continue
+            if start == end:
+                self.x += vx
+                self.y += vy
+                continue
+            # Continuous: integrate up to now, keep the rest
+            until = min(now, end)
+            self.x += vx * (until - start)
+            self.y += vy * (until - start)
+            if until < end:
+                remaining.append((until, end, vx, vy))
+        self.moves = remaining
+        self.x = float(np.clip(self.x, 0, self.width - self.window[0]))
+        self.y = float(np.clip(self.y, 0, self.height - self.window[1]))
+        x1, y1 = int(self.x), int(self.y)
+        return x1, y1, x1 + self.window[0], y1 + self.window[1]
+
+    def view(self, detections, window):
+        """
+        Returns:
+            The detections inside the window, in window coordinates.
+        """
+        x1, y1, x2, y2 = window
+        centers = detections.get_anchors_coordinates(anchor=sv.Position.CENTER)
+        inside = (centers[:, 0] >= x1) & (centers[:, 0] < x2) & (centers[:, 1] >= y1) & (centers[:, 1] < y2)
+        detections = detections[inside]
+        detections.xyxy = detections.xyxy - np.array([x1, y1, x1, y1], dtype=detections.xyxy.dtype)
+        return detections
+
+
+def simulate(log, controller, target_id, fps=30.0, window=None, pipeline_latency=0.1, **camera_args):
+    """
+    Replays a detection log through a controller and a SimulatedPTZ.
+
+    The controller sees every frame `pipeline_latency` seconds late, as behind
+    the real detector.
+
+    Args:
+        log: detection_log.DetectionLog recorded on the full-size video.
+        controller: PTZController or GridController.
+        target_id: Tracker ID of the followed target.
+        fps: Frame rate of the recording.
+        window: (width, height) of the simulated camera, half the recording by default.
+        pipeline_latency: Seconds from capture to the controller's decision.
+        camera_args: Further SimulatedPTZ arguments.
+
+    Returns:
+        Dict with the time until the target is first centered, the overshoot after
+        that, the mean offset, the share of frames with the target in view and the
+        number of commands.
+    """
+    height, width = log.shape[:2]
+    window = window or (width // 2, height // 2)
+    camera = SimulatedPTZ(log.shape, window, **camera_args)
+    command_latency = camera.latency
+    delay = max(int(round(pipeline_latency * fps)), 0)
+    views = deque()
+
+    errors = []
+    seen_from = None
+    centered_at = None
+    visible = 0
+    tracked = 0
+    overshoot = 0.0
+    side = None
+    deadband = getattr(controller, 'deadband', 0.08)
+    for i in range(len(log)):
+        now = i / fps
+        frame_window = camera.advance(now)
+        detections = log.detections(i)
+        target = detections[detections.tracker_id == target_id]
+        if not len(target):
+            views.append((now, None))
+        else:
+            tracked += 1
+            seen_from = now if seen_from is None else seen_from
+            in_view = camera.view(target, frame_window)
+            views.append((now, in_view))
+            error = target_error((window[1], window[0], 3), in_view)
+            if error is not None:
+                visible += 1
+                errors.append(np.hypot(*error))
+                if centered_at is None and abs(error[0]) < deadband and abs(error[1]) < deadband:
+                    centered_at = now
+                    side = np.sign(error)
+                elif centered_at is not None:
+                    # Swinging past the center to the other side
+                    overshoot = max([overshoot] + [abs(e) for e, s in zip(error, side) if s and np.sign(e) == -s])
+
+        # The controller decides on the frame captured `delay` frames ago
+        if len(views) > delay:
+            captured_at, seen = views.popleft()
+            if seen is not None:
+                horizontal, vertical = controller.update((window[1], window[0], 3), seen, captured_at, now,
+                                                         command_latency)
+                camera.move(horizontal, vertical, now, controller.proportional)
+
+    return {
+        'time_to_center_s': None if centered_at is None or seen_from is None else centered_at - seen_from,
+        'overshoot': overshoot,
+        'mean_offset': float(np.mean(errors)) if errors else None,
+        'in_view': visible / tracked if tracked else 0.0,
+        'commands': camera.commands,
+    }
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Offline PTZ benchmark on a recorded detection log')
+    parser.add_argument('log', help='detection log recorded with DETECTION_LOG on the full-size video')
+    parser.add_argument('--target', type=int, help='tracker ID to follow, the longest track by default')
+    parser.add_argument('--fps', type=float, default=30.0)
+    parser.add_argument('--pipeline-latency', type=float, default=0.1)
+    parser.add_argument('--command-latency', type=float, default=0.15)
+    parser.add_argument('--continuous', action='store_true')
+    args = parser.parse_args()
+
+    from detection_log import DetectionLog
+
+    log = DetectionLog(args.log)
+    if log.shape is None:
+        sys.exit(f'{args.log} has no frame shape')
+    target = args.target
+    if target is None:
+        ids = np.asarray(log.columns['tracker_id'][:, 0])
+        ids = ids[ids >= 0]
+        if not len(ids):
+            sys.exit(f'{args.log} has no tracked detections')
+        values, counts = np.unique(ids, return_counts=True)
+        target = int(values[counts.argmax()])
+
+    camera_args = dict(latency=args.command_latency, continuous=args.continuous)
+    window = (log.shape[1] // 2, log.shape[0] // 2)
+    calibration = SimulatedPTZ(log.shape, window, **camera_args).calibration()
+    results = {'target': target}
+    for name, controller in (('grid', GridController()), ('proportional', PTZController(**calibration))):
+        results[name] = simulate(log, controller, target, args.fps, window, args.pipeline_latency, **camera_args)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
+# cmd python ptz_control.py detections/ --continuous
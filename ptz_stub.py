@@ -0,0 +1,123 @@
+import sys
+import time
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import utils
+from ptz import PTZDispatcher
+
+
+logging.basicConfig(level=logging.INFO)
+
+
+class StubCamera(ThreadingHTTPServer):
+    """
+    Local stand-in for the camera's decoder_control.cgi.
+
+    Records (time.monotonic(), command) of every request so the dispatcher's
+    command rate and latency can be checked without a camera.
+    """
+
+    def __init__(self, port=0, delay=0.0):
+        """
+        Args:
+            port: Port to listen on, 0 picks a free one.
+            delay: Seconds the stub waits before replying, to mimic a slow camera.
+        """
+        self.delay = delay
+        self.received = []
+        self.lock = threading.Lock()
+        super().__init__(('127.0.0.1', port), _StubHandler)
+        self._thread = threading.Thread(target=self.serve_forever, name='ptz-stub', daemon=True)
+
+    @property
+    def address(self):
+        return f'127.0.0.1:{self.server_address[1]}'
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path != '/decoder_control.cgi':
+            self.send_error(404)
+            return
+        command = parse_qs(url.query).get('command', [''])[0]
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        with self.server.lock:
+            self.server.received.append((time.monotonic(), command))
+
+        body = b'ok.\r\n'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def check_dispatcher(duration=3.0, fps=30, min_interval=0.2, delay=0.05):
+    """
+    Feeds the dispatcher one movement per frame and reports what reached the stub camera.
+
+    Returns:
+        Dict with the submitted and received command counts, the received rate
+        and the submit-to-reply latency percentiles in milliseconds.
+    """
+    camera = StubCamera(delay=delay).start()
+    dispatcher = PTZDispatcher(utils.cam_commands(camera.address), min_interval=min_interval).start()
+
+    submitted = 0
+    start = time.monotonic()
+    while time.monotonic() - start < duration:
+        # Alternate targets to produce conflicting movements frame after frame
+        dispatcher.submit(1 if submitted % 2 else -1, 1)
+        submitted += 1
+        time.sleep(1 / fps)
+    dispatcher.close()
+    camera.stop()
+
+    latencies = sorted(dispatcher.latencies)
+    report = {
+        'submitted': submitted,
+        'received': len(camera.received),
+        'stale_dropped': dispatcher.dropped,
+        'commands_per_second': len(camera.received) / duration,
+        'latency_p50_ms': latencies[len(latencies) // 2] * 1000 if latencies else None,
+        'latency_max_ms': latencies[-1] * 1000 if latencies else None,
+    }
+    return report
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == 'serve':
+        camera = StubCamera(port=int(sys.argv[2]) if len(sys.argv) > 2 else 8080).start()
+        logging.info(f'Stub camera listening on {camera.address}')
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            camera.stop()
+        return
+
+    for key, value in check_dispatcher().items():
+        print(f'{key}: {value}')
+
+
+if __name__ == "__main__":
+    main()
+# cmd python ptz_stub.py          - dispatcher check against the stub
+# cmd python ptz_stub.py serve 8080 - stub camera for IP_CAM=127.0.0.1:8080
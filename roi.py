@@ -0,0 +1,171 @@
+import os
+import logging
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+# ROI_INFERENCE=1 runs the detector on a crop around the selected targets instead of the whole frame
+roi_inference = os.getenv("ROI_INFERENCE") == "1"
+# Padding around the targets, as a multiple of their box size
+roi_padding = float(os.getenv("ROI_PADDING", "1.0"))
+
+# Stride of the YOLO models, imgsz must be a multiple of it
+STRIDE = 32
+
+
+class RoiDetector:
+    """
+    Runs the detector on a padded window around the last known boxes of the selected targets.
+
+    The window is cut from the full-resolution frame and detected at its native
+    scale, so small and distant targets keep their detail while the rest of the
+    scene costs nothing. When the frame loop works on a downscaled copy
+    (INGEST=ffmpeg), the window is cut from the full-resolution picture of the
+    reader instead. Boxes are mapped back to frame coordinates before the
+    tracker sees them. The whole frame is detected when no target is selected,
+    when the targets were lost in the window, and every `full_every` frames so
+    the tracks of the other objects stay alive.
+    """
+
+    def __init__(self, pipeline, padding=roi_padding, min_size=320, max_size=1280, max_area=0.5,
+                 lost_after=3, full_every=30):
+        """
+        Args:
+            pipeline: tracking.TrackingPipeline; ROI mode needs a separable backend.
+            padding: Padding around the targets as a multiple of their box width/height.
+            min_size: Minimum width and height of the window in pixels.
+            max_size: Upper bound of the detector input size for the window.
+            max_area: Fraction of the frame above which the whole frame is detected instead.
+            lost_after: Number of window frames without a target before falling back to the whole frame.
+            full_every: Maximum number of frames between two full-frame detections.
+        """
+        self.pipeline = pipeline
+        self.padding = padding
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_area = max_area
+        self.lost_after = lost_after
+        self.full_every = full_every
+        self.frame_index = 0
+        self.last_full = None
+        self.missed = 0
+        self.roi_frames = 0
+        # tracker_id -> last box of a selected target in frame coordinates
+        self.boxes = {}
+        if not pipeline.separable:
+            logger.warning(f'Backend {pipeline.backend} cannot detect a window, ROI inference disabled')
+
+    def __call__(self, frame, target_ids, full_frame=None, **overrides):
+        """
+        Detects and tracks the objects of the next frame.
+
+        Args:
+            frame: Numpy image array.
+            target_ids: Tracker IDs of the selected targets.
+            full_frame: Callable returning the full-resolution picture of a downscaled
+                `frame`, e.g. ingest.FFmpegReader.full_frame; called only when a window
+                is detected. None, or a None result, means `frame` is at full resolution.
+            overrides: predict arguments of this frame; an imgsz caps the window's input size.
+
+        Returns:
+            sv.Detections with tracker IDs in `frame` coordinates.
+        """
+        self.frame_index += 1
+        target_ids = {int(tracker_id) for tracker_id in target_ids}
+        window = None
+        if self._wants_window(target_ids):
+            full = full_frame() if full_frame is not None else None
+            if full is None:
+                full = frame
+            height, width = frame.shape[:2]
+            # Frame coordinates to full-resolution coordinates, per axis
+            scale = np.array([full.shape[1] / width, full.shape[0] / height] * 2)
+            window = self._window(full.shape, target_ids, scale)
+
+        if window is None:
+            detections = self.pipeline(frame, **overrides)
+            self.last_full = self.frame_index
+        else:
+            x1, y1, x2, y2 = window
+            crop = full[y1:y2, x1:x2]
+            imgsz = min(-(-max(crop.shape[:2]) // STRIDE) * STRIDE, overrides.get('imgsz', self.max_size),
+                        self.max_size)
+            detections = self.pipeline.detect(crop, **{**overrides, 'imgsz': imgsz})
+            detections = detections[self._inside(detections.xyxy, window, full.shape)]
+            detections.xyxy = ((detections.xyxy + np.array([x1, y1, x1, y1])) / scale).astype(detections.xyxy.dtype)
+            detections = self.pipeline.associate(detections)
+            self.roi_frames += 1
+
+        self._remember(detections, target_ids, window is not None)
+        return detections
+
+    def _wants_window(self, target_ids):
+        """
+        Returns:
+            False when the whole frame has to be detected whatever the targets' boxes are.
+        """
+        if not self.pipeline.separable or not target_ids:
+            return False
+        if self.last_full is None or self.frame_index - self.last_full >= self.full_every:
+            return False
+        if self.missed >= self.lost_after:
+            return False
+        return any(tracker_id in self.boxes for tracker_id in target_ids)
+
+    def _window(self, shape, target_ids, scale):
+        """
+        Args:
+            shape: Shape of the full-resolution picture.
+            target_ids: Tracker IDs of the selected targets.
+            scale: Factors from frame to full-resolution coordinates (x, y, x, y).
+
+        Returns:
+            The window (x1, y1, x2, y2) to detect in full-resolution coordinates, or None for the whole frame.
+        """
+        height, width = shape[:2]
+        boxes = np.array([self.boxes[tracker_id] for tracker_id in target_ids if tracker_id in self.boxes]) * scale
+        x1, y1 = boxes[:, :2].min(axis=0)
+        x2, y2 = boxes[:, 2:].max(axis=0)
+        pad_x = max((x2 - x1) * self.padding, (self.min_size - (x2 - x1)) / 2, 0)
+        pad_y = max((y2 - y1) * self.padding, (self.min_size - (y2 - y1)) / 2, 0)
+        x1, x2 = int(max(x1 - pad_x, 0)), int(min(x2 + pad_x, width))
+        y1, y2 = int(max(y1 - pad_y, 0)), int(min(y2 + pad_y, height))
+        if x2 <= x1 or y2 <= y1 or (x2 - x1) * (y2 - y1) > self.max_area * width * height:
+            return None
+        return x1, y1, x2, y2
+
+    @staticmethod
+    def _inside(xyxy, window, shape, margin=2):
+        """
+        Drops objects cut by the window border; borders of the frame itself do not count.
+        """
+        x1, y1, x2, y2 = window
+        height, width = shape[:2]
+        keep = np.ones(len(xyxy), dtype=bool)
+        if x1 > 0:
+            keep &= xyxy[:, 0] > margin
+        if y1 > 0:
+            keep &= xyxy[:, 1] > margin
+        if x2 < width:
+            keep &= xyxy[:, 2] < x2 - x1 - margin
+        if y2 < height:
+            keep &= xyxy[:, 3] < y2 - y1 - margin
+        return keep
+
+    def _remember(self, detections, target_ids, in_window):
+        found = set()
+        if detections.tracker_id is not None:
+            for box, tracker_id in zip(detections.xyxy, detections.tracker_id):
+                tracker_id = int(tracker_id)
+                if tracker_id in target_ids:
+                    self.boxes[tracker_id] = box.astype(float)
+                    found.add(tracker_id)
+
+        # Forget deselected targets; a target missing from a full frame is lost
+        for tracker_id in list(self.boxes):
+            if tracker_id not in target_ids or (not in_window and tracker_id not in found):
+                del self.boxes[tracker_id]
+
+        self.missed = self.missed + 1 if in_window and not found else 0
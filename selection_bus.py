@@ -0,0 +1,218 @@
+import time
+import logging
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+BUS_NAME = "dst_selection"
+MAX_POSITIONS = 16
+# int64 layout: seq, version, generation, closed, tracker_id of position 1..MAX_POSITIONS (-1 if free)
+HEADER_FIELDS = 4
+SIZE = (HEADER_FIELDS + MAX_POSITIONS) * 8
+EMPTY = -1
+
+# Buses created by this process; attaching to them must keep the creator's registration
+_created = set()
+
+
+class SelectionBus:
+    """
+    Shared-memory copy of the position -> tracker_id map with a version counter.
+
+    The operator (detect_mouse_select.py) publishes every selection change,
+    the views only compare the version once per frame and copy the map when
+    it changed. `seq` is odd while the publisher writes. Every create() writes
+    a new `generation` and close() sets `closed`, so views notice when the
+    operator went away or the block was replaced by a new operator.
+    """
+
+    def __init__(self, shm, owner=False):
+        self.shm = shm
+        self.owner = owner
+        self._data = np.ndarray((HEADER_FIELDS + MAX_POSITIONS,), dtype=np.int64, buffer=shm.buf)
+
+    @classmethod
+    def create(cls, name=BUS_NAME):
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=SIZE)
+        except FileExistsError:
+            # Left behind by a previous operator, keep the version counter going
+            shm = shared_memory.SharedMemory(name=name)
+            if shm.size < SIZE:
+                # Older layout, views attached to it see the new generation under the name
+                shm.close()
+                shm.unlink()
+                shm = shared_memory.SharedMemory(name=name, create=True, size=SIZE)
+        _created.add(name)
+        bus = cls(shm, owner=True)
+        bus._data[2] = time.time_ns()
+        bus._data[3] = 0
+        bus.publish({})
+        logger.info(f'Selection bus {name} created')
+        return bus
+
+    @classmethod
+    def attach(cls, name=BUS_NAME):
+        """
+        Attaches to the operator's bus.
+
+        Returns:
+            The SelectionBus or None if no operator has created it.
+        """
+        try:
+            shm = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            return None
+        # Readers must not unlink the block when they exit
+        if name not in _created:
+            resource_tracker.unregister(shm._name, "shared_memory")
+        if shm.size < SIZE:
+            shm.close()
+            return None
+        return cls(shm)
+
+    @classmethod
+    def current_generation(cls, name=BUS_NAME):
+        """
+        Returns:
+            Generation of the block now registered under `name`, or None if there is none.
+        """
+        bus = cls.attach(name)
+        if bus is None:
+            return None
+        generation = bus.generation
+        bus.close()
+        return generation
+
+    @property
+    def version(self):
+        return int(self._data[1])
+
+    @property
+    def generation(self):
+        return int(self._data[2])
+
+    @property
+    def closed(self):
+        return bool(self._data[3])
+
+    def publish(self, tracked_objects):
+        """
+        Broadcasts the current selection.
+
+        Args:
+            tracked_objects: Dict of monitored objects (position -> tracker_id).
+        """
+        seq = int(self._data[0])
+        self._data[0] = seq + 1
+        ids = self._data[HEADER_FIELDS:]
+        ids[:] = EMPTY
+        for position, tracker_id in tracked_objects.items():
+            if 1 <= int(position) <= MAX_POSITIONS:
+                ids[int(position) - 1] = int(tracker_id)
+        self._data[1] = self.version + 1
+        self._data[0] = seq + 2
+
+    def read(self):
+        """
+        Returns:
+            Tuple (version, tracked_objects dict).
+        """
+        while True:
+            seq = int(self._data[0])
+            if seq % 2 == 0:
+                version = int(self._data[1])
+                ids = self._data[HEADER_FIELDS:].copy()
+                if int(self._data[0]) == seq:
+                    break
+            time.sleep(0)
+        return version, {i + 1: int(tracker_id) for i, tracker_id in enumerate(ids) if tracker_id != EMPTY}
+
+    def close(self):
+        if self.owner:
+            # Views still mapping the block fall back to the database
+            self._data[3] = 1
+        self._data = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+            _created.discard(self.shm.name)
+
+
+class SelectionView:
+    """
+    In-memory selection of a consumer process, kept in sync with the bus.
+
+    SQLite is read on cold start and whenever the operator's bus goes away;
+    while no operator is running the view keeps that copy and retries
+    attaching to the bus. Every `retry_interval` the view also checks that the
+    block under the bus name is still the one it maps, since a restarted
+    operator creates a new block.
+    """
+
+    def __init__(self, load_tracked_objects, name=BUS_NAME, retry_interval=1.0):
+        """
+        Args:
+            load_tracked_objects: Callable that reads the selection from the database.
+            name: Name of the shared memory block.
+            retry_interval: Seconds between attempts to attach to the bus.
+        """
+        self.name = name
+        self.retry_interval = retry_interval
+        self.load_tracked_objects = load_tracked_objects
+        self.version = None
+        self.tracked_objects = load_tracked_objects()
+        self.bus = None
+        self._next_attach = 0.0
+        self._next_check = 0.0
+
+    def get(self) -> dict:
+        """
+        Returns:
+            Dict of monitored objects (position -> tracker_id).
+        """
+        now = time.monotonic()
+        if self.bus is not None and self._stale(now):
+            self.bus.close()
+            self.bus = None
+            self.version = None
+            self.tracked_objects = self.load_tracked_objects()
+            self._next_attach = 0.0
+
+        if self.bus is None:
+            if now < self._next_attach:
+                return self.tracked_objects
+            self._next_attach = now + self.retry_interval
+            self.bus = SelectionBus.attach(self.name)
+            if self.bus is None:
+                return self.tracked_objects
+            self._next_check = now + self.retry_interval
+            logger.info(f'Attached to selection bus {self.name}')
+
+        if self.bus.version != self.version:
+            self.version, self.tracked_objects = self.bus.read()
+            logger.debug(f'Selection changed: {self.tracked_objects}')
+        return self.tracked_objects
+
+    def _stale(self, now):
+        """
+        Returns:
+            True when the operator closed the bus or replaced it with a new block.
+        """
+        if self.bus.closed:
+            logger.info(f'Selection bus {self.name} closed, selection read from the database')
+            return True
+        if now < self._next_check:
+            return False
+        self._next_check = now + self.retry_interval
+        if SelectionBus.current_generation(self.name) != self.bus.generation:
+            logger.info(f'Selection bus {self.name} replaced, attaching again')
+            return True
+        return False
+
+    def close(self):
+        if self.bus is not None:
+            self.bus.close()
@@ -0,0 +1,60 @@
+import os
+import json
+import time
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# STARTUP_REPORT=path writes the phase timings as JSON once the first frame is shown,
+# STARTUP_EXIT=1 then stops the worker (used by bench_startup.py)
+startup_report = os.getenv("STARTUP_REPORT")
+startup_exit = os.getenv("STARTUP_EXIT") == "1"
+
+# Entry points import this module first, so the clock starts right after the interpreter
+_started = time.perf_counter()
+_last = _started
+phases = []
+_reported = False
+
+
+def reset():
+    """
+    Restarts the clock, e.g. in a view forked from the warm daemon.
+    """
+    global _started, _last, _reported
+    _started = _last = time.perf_counter()
+    phases.clear()
+    _reported = False
+
+
+def mark(name):
+    """
+    Ends a startup phase: the time since the previous mark is recorded under `name`.
+    """
+    global _last
+    now = time.perf_counter()
+    phases.append((name, (now - _last) * 1000))
+    _last = now
+
+
+def first_frame():
+    """
+    Reports the time to the first frame once per process, call it after every shown frame.
+    """
+    global _reported
+    if _reported:
+        return
+    _reported = True
+    mark('first frame')
+    total_ms = (time.perf_counter() - _started) * 1000
+    summary = ', '.join(f'{name} {ms:.0f} ms' for name, ms in phases)
+    logger.info(f'First frame after {total_ms:.0f} ms ({summary})')
+
+    if startup_report:
+        with open(startup_report, 'w') as f:
+            json.dump({'pid': os.getpid(), 'first_frame_at': time.time(), 'total_ms': total_ms,
+                       'phases': dict(phases)}, f)
+    if startup_exit:
+        from display import shutdown
+        shutdown.set()
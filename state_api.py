@@ -0,0 +1,238 @@
+import os
+import json
+import time
+import errno
+import logging
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+# Read-only JSON API over the live tracking state on STATE_HOST:STATE_PORT, 0 disables it.
+# Every process serves its own state; when the port is taken the next free one is used
+state_port = int(os.getenv("STATE_PORT", "0"))
+state_host = os.getenv("STATE_HOST", "127.0.0.1")
+# Number of frames with selected targets kept in the history window
+state_history = int(os.getenv("STATE_HISTORY", "150"))
+
+# Ports tried after STATE_PORT when it is taken
+PORT_ATTEMPTS = 16
+
+
+class TrackState:
+    """
+    In-memory snapshot of the selection and the selected targets, for readers outside the frame loop.
+
+    The frame loop calls update() once per frame; it only builds small new
+    dicts and swaps them in, so readers never see a half-written state and
+    never wait for the frame loop. Every part has its own version, which is
+    only increased when the part changed: pollers send it back as ETag and
+    get 304 Not Modified while nothing moved. The JSON is built on the first
+    request of a version and shared by all readers of it.
+    """
+
+    def __init__(self, source, history=state_history, smoothing=0.5):
+        """
+        Args:
+            source: Name of the stream, e.g. 'operator' or 'server'.
+            history: Number of frames kept in the history window.
+            smoothing: Weight of the newest velocity measurement.
+        """
+        self.source = source
+        self.smoothing = smoothing
+        # (selection version, position -> tracker_id, targets version, tracker_id -> target), replaced as a whole
+        self._snapshot = (0, {}, 0, {})
+        self._history = deque(maxlen=history)
+        self._history_lock = threading.Lock()
+        # path -> (version, body)
+        self._bodies = {}
+
+    def update(self, frame_index, detections, tracked_objects):
+        """
+        Publishes the state of one frame.
+
+        Args:
+            frame_index: Index of the frame in the stream.
+            detections: Tracked sv.Detections of the frame.
+            tracked_objects: Dict of monitored objects (position -> tracker_id).
+        """
+        selection_version, selection, targets_version, targets = self._snapshot
+        if tracked_objects != selection:
+            selection = {int(position): int(tracker_id) for position, tracker_id in tracked_objects.items()}
+            selection_version += 1
+        positions = {tracker_id: position for position, tracker_id in selection.items()}
+
+        # Deselected targets are dropped, the others keep their last box until they are seen again
+        updated = {tracker_id: target for tracker_id, target in targets.items() if tracker_id in positions}
+        seen = {}
+        if positions and detections.tracker_id is not None and len(detections):
+            now = time.time()
+            mask = np.isin(detections.tracker_id, list(positions))
+            for (x1, y1, x2, y2), confidence, class_id, tracker_id in zip(
+                    detections.xyxy[mask].tolist(),
+                    detections.confidence[mask].tolist(),
+                    detections.class_id[mask].tolist(),
+                    detections.tracker_id[mask].tolist()):
+                box = [round(x1, 1), round(y1, 1), round(x2, 1), round(y2, 1)]
+                updated[tracker_id] = {
+                    'position': positions[tracker_id],
+                    'tracker_id': tracker_id,
+                    'class_id': class_id,
+                    'confidence': round(confidence, 3),
+                    'box': box,
+                    'velocity': self._velocity(targets.get(tracker_id), box, now),
+                    'frame': frame_index,
+                    'timestamp': now,
+                }
+                seen[tracker_id] = box
+
+        if seen or updated.keys() != targets.keys():
+            targets = updated
+            targets_version += 1
+            if seen:
+                with self._history_lock:
+                    self._history.append({'frame': frame_index, 'timestamp': now, 'boxes': seen})
+        self._snapshot = (selection_version, selection, targets_version, targets)
+
+    def _velocity(self, previous, box, now):
+        """
+        Returns:
+            Smoothed velocity [vx, vy] of the box center in pixels per second.
+        """
+        if previous is None or now <= previous['timestamp']:
+            return [0.0, 0.0]
+        dt = now - previous['timestamp']
+        (px1, py1, px2, py2), (x1, y1, x2, y2) = previous['box'], box
+        measured = ((x1 + x2 - px1 - px2) / 2 / dt, (y1 + y2 - py1 - py2) / 2 / dt)
+        return [round(old + self.smoothing * (new - old), 1) for old, new in zip(previous['velocity'], measured)]
+
+    def _version(self, path, snapshot):
+        selection_version, _, targets_version, _ = snapshot
+        if path == '/selection':
+            return f'{selection_version}'
+        if path == '/state':
+            return f'{selection_version}.{targets_version}'
+        if path in ('/targets', '/history'):
+            return f'{targets_version}'
+        return None
+
+    def etag(self, path, snapshot=None):
+        """
+        Returns:
+            ETag of the current version of an endpoint, or None for an unknown path.
+        """
+        version = self._version(path, snapshot or self._snapshot)
+        return None if version is None else f'"{self.source}-{path[1:]}-{version}"'
+
+    def render(self, path, since=None):
+        """
+        Returns the JSON of one endpoint.
+
+        Args:
+            path: '/state', '/selection', '/targets' or '/history'.
+            since: Only history entries after this frame index.
+
+        Returns:
+            Tuple (etag, body) or None for an unknown path.
+        """
+        snapshot = self._snapshot
+        _, selection, _, targets = snapshot
+        version = self._version(path, snapshot)
+        if version is None:
+            return None
+        etag = self.etag(path, snapshot)
+
+        cached = self._bodies.get(path)
+        if since is None and cached is not None and cached[0] == etag:
+            return cached
+        if path == '/selection':
+            data = {'selection': selection}
+        elif path == '/targets':
+            data = {'targets': list(targets.values())}
+        else:
+            with self._history_lock:
+                history = list(self._history)
+            if since is not None:
+                history = [entry for entry in history if entry['frame'] > since]
+            data = {'history': history}
+            if path == '/state':
+                data = {'selection': selection, 'targets': list(targets.values()), **data}
+        body = json.dumps({'source': self.source, 'version': version, **data}).encode()
+        if since is None:
+            self._bodies[path] = (etag, body)
+        return etag, body
+
+
+class _StateHandler(BaseHTTPRequestHandler):
+    state = None
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        since = parse_qs(url.query).get('since')
+        try:
+            since = int(since[0]) if since else None
+        except ValueError:
+            self.send_error(400, 'since must be a frame index')
+            return
+        etag = self.state.etag(url.path)
+        if etag is None:
+            self.send_error(404)
+            return
+        # Pollers that have the current version are answered without building the JSON
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        etag, body = self.state.render(url.path, since)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(state, host=state_host, port=state_port):
+    """
+    Serves /state, /selection, /targets and /history of `state` from a background thread.
+
+    Returns:
+        The HTTPServer; its port is the first free one from `port` on.
+    """
+    handler = type('StateHandler', (_StateHandler,), {'state': state})
+    for attempt in range(PORT_ATTEMPTS):
+        try:
+            server = ThreadingHTTPServer((host, port + attempt), handler)
+            break
+        except OSError as e:
+            if e.errno != errno.EADDRINUSE:
+                raise
+    else:
+        raise OSError(errno.EADDRINUSE, f'No free state port in {port}..{port + PORT_ATTEMPTS - 1}')
+    threading.Thread(target=server.serve_forever, name='state-http', daemon=True).start()
+    logger.info(f'Tracking state of {state.source} on http://{host}:{server.server_address[1]}/state')
+    return server
+
+
+def start(source):
+    """
+    Starts the state API configured in the environment.
+
+    Returns:
+        The TrackState to update once per frame, or None when STATE_PORT is not set.
+    """
+    if not state_port:
+        return None
+    state = TrackState(source)
+    serve(state)
+    return state
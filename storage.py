@@ -0,0 +1,193 @@
+import os
+import time
+import queue
+import logging
+import sqlite3
+import threading
+
+import numpy as np
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = 'tracker_data.db'
+
+
+class BackgroundWriter:
+    """
+    Runs SQL writes on its own connection in a background thread.
+
+    Statements are executed in the order they were queued; everything queued
+    while the previous batch was written is committed together.
+    """
+
+    def __init__(self, db_path=DB_PATH):
+        self.db_path = db_path
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='db-writer', daemon=True)
+        self._thread.start()
+
+    def execute(self, sql, params=()):
+        self._queue.put((sql, params))
+
+    def _run(self):
+        conn = sqlite3.connect(self.db_path)
+        while True:
+            item = self._queue.get()
+            batch = [item]
+            while item is not None:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                batch.append(item)
+
+            for statement in batch:
+                if statement is None:
+                    continue
+                try:
+                    conn.execute(*statement)
+                    metrics.db_queries.inc()
+                except sqlite3.Error as e:
+                    logger.error(f'Database write failed: {e} ({statement[0]})')
+            conn.commit()
+            if batch[-1] is None:
+                break
+        conn.close()
+
+    def close(self):
+        """
+        Writes everything still queued and stops the thread.
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+
+# selected: only tracks bound to a position, all: every track, off: no history
+track_history = os.getenv("TRACK_HISTORY", "selected")
+
+
+class TrackHistoryStore:
+    """
+    Write-behind store of where the tracks were, frame by frame.
+
+    The frame loop only converts the detections to rows and queues them; a
+    background thread inserts them with executemany and commits every
+    `commit_interval` seconds. The database runs in WAL mode so readers do
+    not block the writer.
+    """
+
+    def __init__(self, source, db_path=DB_PATH, mode=track_history, commit_interval=1.0, max_queue=1000,
+                 max_retries=3):
+        """
+        Args:
+            source: Name of the stream, e.g. 'operator' or 'camera-1'.
+            db_path: SQLite database file.
+            mode: 'selected', 'all' or 'off'.
+            commit_interval: Seconds between commits.
+            max_queue: Frames that may wait for the writer before new ones are dropped.
+            max_retries: Failed writes of the same rows before they are dropped.
+        """
+        self.source = source
+        self.db_path = db_path
+        self.mode = mode
+        self.commit_interval = commit_interval
+        self.max_retries = max_retries
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        if mode != 'off':
+            self._thread = threading.Thread(target=self._run, name='track-history', daemon=True)
+            self._thread.start()
+
+    def record(self, frame_index, detections, selected_ids=()):
+        """
+        Queues the tracks of one frame.
+
+        Args:
+            frame_index: Index of the frame in the stream.
+            detections: Tracked sv.Detections of the frame.
+            selected_ids: Tracker IDs bound to a position, used in 'selected' mode.
+        """
+        if self._thread is None or detections.tracker_id is None or not len(detections):
+            return
+        if self.mode == 'selected':
+            detections = detections[np.isin(detections.tracker_id, list(selected_ids))]
+            if not len(detections):
+                return
+
+        timestamp = time.time()
+        rows = [
+            (self.source, frame_index, timestamp, tracker_id, class_id, confidence, x1, y1, x2, y2)
+            for (x1, y1, x2, y2), confidence, class_id, tracker_id
+            in zip(detections.xyxy.tolist(),
+                   detections.confidence.tolist(),
+                   detections.class_id.tolist(),
+                   detections.tracker_id.tolist())
+        ]
+        try:
+            self._queue.put_nowait(rows)
+        except queue.Full:
+            self.dropped += len(rows)
+
+    def _run(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('''CREATE TABLE IF NOT EXISTS track_history
+                        (source TEXT, frame INTEGER, timestamp REAL, tracker_id INTEGER, class_id INTEGER,
+                         confidence REAL, x1 REAL, y1 REAL, x2 REAL, y2 REAL)''')
+        # Every query is per source
+        conn.execute('DROP INDEX IF EXISTS track_history_tracker_frame')
+        conn.execute('''CREATE INDEX IF NOT EXISTS track_history_source_tracker_frame
+                        ON track_history (source, tracker_id, frame)''')
+        conn.commit()
+
+        pending = []
+        failures = 0
+        last_commit = time.monotonic()
+        stop = False
+        # After close() the rows of a failed write are still retried
+        while not stop or pending:
+            try:
+                rows = self._queue.get(timeout=self.commit_interval)
+                if rows is None:
+                    stop = True
+                else:
+                    pending.extend(rows)
+            except queue.Empty:
+                pass
+
+            if pending and (stop or time.monotonic() - last_commit >= self.commit_interval):
+                try:
+                    conn.executemany('INSERT INTO track_history VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', pending)
+                    metrics.db_queries.inc()
+                    conn.commit()
+                    pending = []
+                    failures = 0
+                except sqlite3.Error as e:
+                    # A locked database is retried at the next commit, a full disk soon gives up
+                    conn.rollback()
+                    failures += 1
+                    if failures < self.max_retries:
+                        logger.warning(f'Track history write failed, retrying: {e}')
+                    else:
+                        logger.error(f'Track history write failed, {len(pending)} rows dropped: {e}')
+                        self.dropped += len(pending)
+                        pending = []
+                        failures = 0
+                last_commit = time.monotonic()
+        conn.close()
+
+    def close(self):
+        """
+        Writes the queued rows and stops the thread.
+        """
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        if self.dropped:
+            logger.warning(f'Track history: {self.dropped} rows dropped')
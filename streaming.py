@@ -0,0 +1,304 @@
+import os
+import html
+import errno
+import asyncio
+import logging
+import threading
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+import cv2
+import numpy as np
+
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# MJPEG server for remote viewers on STREAM_HOST:STREAM_PORT, 0 disables it.
+# Every process serves its own views; when the port is taken the next free one is used
+stream_port = int(os.getenv("STREAM_PORT", "0"))
+stream_host = os.getenv("STREAM_HOST", "127.0.0.1")
+# name:jpeg quality:scale of every quality level, the first one is the default
+stream_qualities = os.getenv("STREAM_QUALITIES", "high:80:1.0,low:50:0.5")
+
+BOUNDARY = b'frame'
+# Ports tried after STREAM_PORT when it is taken
+PORT_ATTEMPTS = 16
+# Transport buffer of a client; above it the client waits and misses frames instead of queueing them
+CLIENT_BUFFER = 64 * 1024
+
+frames_skipped = metrics.registry.counter('dst_stream_frames_skipped_total',
+                                          'Streamed frames a remote viewer did not get because it was too slow')
+
+
+def parse_qualities(spec):
+    """
+    Returns:
+        Dict of quality name -> (JPEG quality, scale), in the order of the spec.
+    """
+    qualities = {}
+    for item in spec.split(','):
+        name, quality, scale = item.strip().split(':')
+        qualities[name] = (int(quality), float(scale))
+    return qualities
+
+
+class Channel:
+    """
+    One annotated view streamed to any number of remote viewers.
+
+    The frame loop only copies the frame into a buffer. An encoder thread
+    encodes the newest frame once per quality level that has viewers, and all
+    viewers of a level are sent the same JPEG bytes. Frames published while the
+    encoder is busy are replaced, and a viewer that is still sending gets the
+    newest frame when it is done, so slow viewers skip frames and nothing piles up.
+    """
+
+    def __init__(self, name, qualities, loop):
+        self.name = name
+        self.qualities = qualities
+        self.loop = loop
+        # Viewers per quality level, only changed in the event loop
+        self.clients = dict.fromkeys(qualities, 0)
+        self.published = 0
+        self.encoded = 0
+        # Number of the frame in _working, the encoder only swaps for a newer one
+        self._working_number = 0
+        self.closed = False
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._pending = None
+        self._working = None
+        # quality -> (frame number, JPEG bytes) and the event set for every new one, used in the event loop
+        self._latest = {}
+        self._new_frame = {quality: asyncio.Event() for quality in qualities}
+        self._thread = threading.Thread(target=self._encode_loop, name=f'stream-{name}', daemon=True)
+        self._thread.start()
+
+    @property
+    def watched(self):
+        return any(self.clients.values())
+
+    def publish(self, frame):
+        """
+        Hands the next annotated frame to the encoder; returns at once.
+        """
+        if not self.watched:
+            return
+        with self._lock:
+            if self._pending is None or self._pending.shape != frame.shape:
+                self._pending = np.empty_like(frame)
+            np.copyto(self._pending, frame)
+            self.published += 1
+            # Inside the lock, so the encoder cannot take this frame between the two and wake once more for nothing
+            self._ready.set()
+
+    def close(self):
+        self.closed = True
+        self._ready.set()
+        self.loop.call_soon_threadsafe(self._wake_all)
+
+    def _encode_loop(self):
+        while True:
+            self._ready.wait()
+            self._ready.clear()
+            if self.closed:
+                return
+            with self._lock:
+                if self.published == self._working_number:
+                    continue
+                self._pending, self._working = self._working, self._pending
+                number = self._working_number = self.published
+            for quality, (jpeg_quality, scale) in self.qualities.items():
+                if not self.clients[quality]:
+                    continue
+                image = self._working
+                if scale != 1.0:
+                    image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+                ok, jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+                if ok:
+                    self.encoded += 1
+                    self.loop.call_soon_threadsafe(self._deliver, quality, number, jpeg.tobytes())
+
+    def _deliver(self, quality, number, jpeg):
+        self._latest[quality] = (number, jpeg)
+        # set() wakes every waiting viewer, clear() makes the next wait() block again
+        self._new_frame[quality].set()
+        self._new_frame[quality].clear()
+
+    def _wake_all(self):
+        for event in self._new_frame.values():
+            event.set()
+
+    async def stream(self, quality, writer):
+        """
+        Sends the frames of one quality level to a viewer as multipart/x-mixed-replace.
+        """
+        writer.transport.set_write_buffer_limits(high=CLIENT_BUFFER)
+        writer.write(b'HTTP/1.1 200 OK\r\n'
+                     b'Content-Type: multipart/x-mixed-replace; boundary=' + BOUNDARY + b'\r\n'
+                     b'Cache-Control: no-cache, no-store\r\n'
+                     b'Connection: close\r\n\r\n')
+        self.clients[quality] += 1
+        logger.info(f'{self.name}: {quality} viewer connected, {sum(self.clients.values())} watching')
+        sent = None
+        try:
+            while not self.closed:
+                latest = self._latest.get(quality)
+                if latest is None or latest[0] == sent:
+                    await self._new_frame[quality].wait()
+                    continue
+                number, jpeg = latest
+                if sent is not None and number - sent > 1:
+                    frames_skipped.inc(number - sent - 1)
+                sent = number
+                writer.write(b'--' + BOUNDARY + b'\r\nContent-Type: image/jpeg\r\n'
+                             b'Content-Length: ' + str(len(jpeg)).encode() + b'\r\n\r\n' + jpeg + b'\r\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.clients[quality] -= 1
+            logger.info(f'{self.name}: {quality} viewer left, {sum(self.clients.values())} watching')
+
+
+class StreamServer:
+    """
+    asyncio HTTP server of all channels of this process, running in a background thread.
+
+    GET / lists the views, GET /stream/<view>?quality=<level> streams one of them.
+    """
+
+    def __init__(self, host=stream_host, port=stream_port, qualities=None):
+        self.qualities = qualities or parse_qualities(stream_qualities)
+        self.channels = {}
+        self.loop = asyncio.new_event_loop()
+        self._server = None
+        started = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(host, port, started), name='stream-http',
+                                        daemon=True)
+        self._thread.start()
+        started.wait()
+        if self._server is None:
+            raise OSError(errno.EADDRINUSE, f'No free stream port in {port}..{port + PORT_ATTEMPTS - 1}')
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f'Streaming views on http://{host}:{self.port}/')
+
+    def _run(self, host, port, started):
+        asyncio.set_event_loop(self.loop)
+        for attempt in range(PORT_ATTEMPTS):
+            try:
+                self._server = self.loop.run_until_complete(
+                    asyncio.start_server(self._handle, host, port + attempt))
+                break
+            except OSError as e:
+                if e.errno != errno.EADDRINUSE:
+                    break
+        started.set()
+        if self._server is not None:
+            self.loop.run_forever()
+
+    def channel(self, name):
+        """
+        Returns:
+            The Channel of a view, created on first use.
+        """
+        if name not in self.channels:
+            self.channels[name] = Channel(name, self.qualities, self.loop)
+        return self.channels[name]
+
+    def remove(self, name):
+        channel = self.channels.pop(name, None)
+        if channel is not None:
+            channel.close()
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            # Headers are not needed
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) < 2 or parts[0] != 'GET':
+                await self._reply(writer, 405, 'text/plain', b'Only GET is supported\n')
+                return
+            url = urlsplit(parts[1])
+            path = unquote(url.path)
+            if path == '/':
+                await self._reply(writer, 200, 'text/html; charset=utf-8', self._index())
+            elif path.startswith('/stream/') and path[len('/stream/'):] in self.channels:
+                channel = self.channels[path[len('/stream/'):]]
+                quality = parse_qs(url.query).get('quality', [next(iter(self.qualities))])[0]
+                if quality not in self.qualities:
+                    await self._reply(writer, 400, 'text/plain',
+                                      f'Unknown quality {quality}, expected one of {list(self.qualities)}\n'.encode())
+                    return
+                await channel.stream(quality, writer)
+            else:
+                await self._reply(writer, 404, 'text/plain', b'Not found\n')
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    async def _reply(writer, status, content_type, body):
+        reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed'}[status]
+        writer.write(f'HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\n'
+                     f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+        await writer.drain()
+
+    def _index(self):
+        items = []
+        for name, channel in list(self.channels.items()):
+            links = ' '.join(f'<a href="/stream/{quote(name)}?quality={quality}">{quality}</a>'
+                             for quality in self.qualities)
+            items.append(f'<li>{html.escape(name)}: {links} ({sum(channel.clients.values())} watching)</li>')
+        return f'<html><body><h1>Views</h1><ul>{"".join(items)}</ul></body></html>\n'.encode()
+
+
+_server = None
+
+
+def get_server():
+    """
+    Returns:
+        The StreamServer of this process, started on first use.
+    """
+    global _server
+    if _server is None:
+        _server = StreamServer()
+    return _server
+
+
+class StreamViewer:
+    """
+    Wraps a local viewer and also streams the shown frames to remote viewers.
+
+    The view counts as attached while the local window exists or somebody
+    watches the stream, so headless workers annotate only for remote viewers.
+    """
+
+    def __init__(self, viewer):
+        self.viewer = viewer
+        self.name = viewer.name
+        self.channel = get_server().channel(viewer.name)
+
+    @property
+    def attached(self):
+        return self.viewer.attached or self.channel.watched
+
+    def set_mouse_callback(self, callback):
+        self.viewer.set_mouse_callback(callback)
+
+    def show(self, frame):
+        if self.viewer.attached:
+            self.viewer.show(frame)
+        self.channel.publish(frame)
+
+    def poll(self):
+        return self.viewer.poll()
+
+    def close(self):
+        get_server().remove(self.name)
+        self.viewer.close()
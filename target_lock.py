@@ -0,0 +1,125 @@
+import os
+import logging
+
+import numpy as np
+import supervision as sv
+
+
+logger = logging.getLogger(__name__)
+
+# Run the full detector every LOCK_EVERY frames once targets are selected, 1 disables the mode
+lock_every = int(os.getenv("LOCK_EVERY", "1"))
+
+
+class TargetLock:
+    """
+    Follows the selected tracks between detector runs with constant-velocity extrapolation.
+
+    The detector runs every `detect_every` frames, or earlier when a predicted
+    track becomes uncertain, leaves the frame or is not known yet. Every run
+    corrects the boxes and the velocity estimates of the locked tracks.
+    """
+
+    def __init__(self, detect_every=lock_every, min_confidence=0.3, decay=0.9, smoothing=0.5):
+        """
+        Args:
+            detect_every: Maximum number of frames between two detector runs.
+            min_confidence: Predicted confidence below which the detector runs again.
+            decay: Factor applied to the confidence for every predicted frame.
+            smoothing: Weight of the newest velocity measurement.
+        """
+        self.detect_every = detect_every
+        self.min_confidence = min_confidence
+        self.decay = decay
+        self.smoothing = smoothing
+        self.frame_index = 0
+        self.last_detection = None
+        # tracker_id -> dict(box, detected_box, velocity, class_id, confidence, frame)
+        self.tracks = {}
+
+    def step(self, frame, detect, locked_ids):
+        """
+        Returns the detections of the next frame, either detected or predicted.
+
+        Args:
+            frame: Numpy image array.
+            detect: Callable that runs detection and tracking on a frame and returns sv.Detections.
+            locked_ids: Tracker IDs of the selected targets.
+
+        Returns:
+            Tuple (detections, detected) where detected tells whether the detector ran.
+        """
+        self.frame_index += 1
+        locked_ids = [int(tracker_id) for tracker_id in locked_ids]
+        if self._needs_detection(locked_ids, frame.shape):
+            detections = detect(frame)
+            self._correct(detections, locked_ids)
+            self.last_detection = self.frame_index
+            return detections, True
+        return self._predict(locked_ids), False
+
+    def _needs_detection(self, locked_ids, shape):
+        if not locked_ids or self.last_detection is None:
+            return True
+        if self.frame_index - self.last_detection >= self.detect_every:
+            return True
+
+        height, width = shape[:2]
+        for tracker_id in locked_ids:
+            track = self.tracks.get(tracker_id)
+            if track is None or track['confidence'] * self.decay < self.min_confidence:
+                return True
+            x1, y1, x2, y2 = track['box'] + track['velocity']
+            if x2 <= 0 or y2 <= 0 or x1 >= width or y1 >= height:
+                return True
+        return False
+
+    def _correct(self, detections, locked_ids):
+        seen = set()
+        if detections.tracker_id is not None:
+            for box, confidence, class_id, tracker_id in zip(detections.xyxy,
+                                                             detections.confidence,
+                                                             detections.class_id,
+                                                             detections.tracker_id):
+                tracker_id = int(tracker_id)
+                if tracker_id not in locked_ids:
+                    continue
+                seen.add(tracker_id)
+                track = self.tracks.get(tracker_id)
+                velocity = np.zeros(4)
+                if track is not None:
+                    measured = (box - track['detected_box']) / max(self.frame_index - track['frame'], 1)
+                    velocity = self.smoothing * measured + (1 - self.smoothing) * track['velocity']
+                self.tracks[tracker_id] = {
+                    'box': box.astype(float),
+                    'detected_box': box.astype(float),
+                    'velocity': velocity,
+                    'class_id': int(class_id),
+                    'confidence': float(confidence),
+                    'frame': self.frame_index,
+                }
+
+        # Forget tracks that are no longer selected or were not found by the detector
+        for tracker_id in list(self.tracks):
+            if tracker_id not in seen:
+                del self.tracks[tracker_id]
+
+    def _predict(self, locked_ids):
+        xyxy, confidence, class_id, tracker_ids = [], [], [], []
+        for tracker_id in locked_ids:
+            track = self.tracks[tracker_id]
+            track['box'] = track['box'] + track['velocity']
+            track['confidence'] *= self.decay
+            xyxy.append(track['box'])
+            confidence.append(track['confidence'])
+            class_id.append(track['class_id'])
+            tracker_ids.append(tracker_id)
+
+        if not xyxy:
+            return sv.Detections.empty()
+        return sv.Detections(
+            xyxy=np.array(xyxy),
+            confidence=np.array(confidence),
+            class_id=np.array(class_id, dtype=int),
+            tracker_id=np.array(tracker_ids, dtype=int),
+        )
@@ -0,0 +1,42 @@
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+from ingest import FFmpegReader, is_live
+
+
+@pytest.fixture
+def video(tmp_path):
+    path = str(tmp_path / 'clip.avi')
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), 25, (64, 48))
+    for _ in range(3):
+        writer.write(np.zeros((48, 64, 3), dtype=np.uint8))
+    writer.release()
+    return path
+
+
+def test_missing_ffmpeg_is_refused(video):
+    with pytest.raises(FileNotFoundError):
+        FFmpegReader(video, live=False, ffmpeg='/nonexistent-ffmpeg')
+
+
+@pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning')
+def test_read_returns_when_decoder_thread_fails(video):
+    reader = FFmpegReader(video, live=False, ffmpeg=sys.executable)
+
+    def spawn():
+        raise OSError('FFmpeg failed to start')
+
+    reader._spawn = spawn
+    reader.start()
+    assert reader.read(timeout=3.0) == (False, None, None)
+    assert reader.finished
+    reader.release()
+
+
+def test_live_sources():
+    assert is_live(0)
+    assert is_live('rtsp://192.168.0.10:554/stream1')
+    assert not is_live('people-walking.mp4')
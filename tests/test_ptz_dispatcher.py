@@ -0,0 +1,80 @@
+import time
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+import utils
+from ptz import PTZDispatcher
+from ptz_stub import StubCamera
+
+
+def command_code(name):
+    return parse_qs(urlparse(utils.cam_commands('camera')[name]).query)['command'][0]
+
+
+@pytest.fixture
+def camera():
+    camera = StubCamera(delay=0.05).start()
+    yield camera
+    camera.stop()
+
+
+def test_rate_limit(camera):
+    duration, min_interval = 1.5, 0.2
+    dispatcher = PTZDispatcher(utils.cam_commands(camera.address), min_interval=min_interval).start()
+    start = time.monotonic()
+    submitted = 0
+    while time.monotonic() - start < duration:
+        dispatcher.submit(1 if submitted % 2 else -1, 0)
+        submitted += 1
+        time.sleep(1 / 30)
+    dispatcher.close()
+
+    times = [received_at for received_at, _ in camera.received]
+    # The first command goes out at once, every further one waits min_interval
+    assert 2 <= len(times) <= duration / min_interval + 1
+    assert min(b - a for a, b in zip(times, times[1:])) >= min_interval * 0.9
+    assert dispatcher.dropped >= submitted - len(times) - 1
+    # A command waits at most for the rate limit and the camera's reply
+    assert dispatcher.command_latency < min_interval + camera.delay + 0.1
+
+
+def test_stale_command_is_not_sent(camera):
+    camera.delay = 0.3
+    dispatcher = PTZDispatcher(utils.cam_commands(camera.address), min_interval=0.1).start()
+    dispatcher.submit(-1, 0)
+    # 'left' is on its way to the camera, 'up' is replaced by 'right' before it can be sent
+    time.sleep(0.1)
+    dispatcher.submit(0, -1)
+    dispatcher.submit(1, 0)
+    time.sleep(1.0)
+    dispatcher.close()
+
+    assert [command for _, command in camera.received] == [command_code('left'), command_code('right')]
+    assert dispatcher.dropped == 1
+
+
+def test_latency_without_backlog(camera):
+    dispatcher = PTZDispatcher(utils.cam_commands(camera.address), min_interval=0.1).start()
+    for i in range(5):
+        dispatcher.submit(1 if i % 2 else -1, 0)
+        time.sleep(0.25)
+    dispatcher.close()
+
+    assert len(camera.received) == 5
+    assert dispatcher.dropped == 0
+    assert camera.delay <= dispatcher.command_latency < camera.delay + 0.05
+
+
+def test_proportional_steps_keep_rate_limit(camera):
+    dispatcher = PTZDispatcher(utils.cam_commands(camera.address), min_interval=0.1, max_steps=4).start()
+    dispatcher.move(1.0, 0)
+    time.sleep(0.6)
+    dispatcher.close()
+
+    times = [received_at for received_at, _ in camera.received]
+    assert len(times) == 4
+    assert min(b - a for a, b in zip(times, times[1:])) >= 0.1 * 0.9
+    # One latency per movement, measured on its first step
+    assert len(dispatcher.latencies) == 1
+    assert camera.delay <= dispatcher.command_latency < camera.delay + 0.05
@@ -0,0 +1,77 @@
+import os
+import sqlite3
+
+import pytest
+
+from selection_bus import SelectionBus, SelectionView
+
+
+@pytest.fixture
+def name():
+    name = f'dst_selection_test_{os.getpid()}'
+    yield name
+    # Whatever a failed test left behind
+    bus = SelectionBus.attach(name)
+    if bus is not None:
+        bus.owner = True
+        bus.close()
+
+
+def test_view_follows_published_selection(name):
+    bus = SelectionBus.create(name)
+    view = SelectionView(dict, name=name)
+    assert view.get() == {}
+    bus.publish({1: 5, 3: 7})
+    assert view.get() == {1: 5, 3: 7}
+    view.close()
+    bus.close()
+
+
+@pytest.fixture
+def database(tmp_path):
+    conn = sqlite3.connect(tmp_path / 'tracker_data.db')
+    conn.execute('CREATE TABLE tracked_objects (position INTEGER PRIMARY KEY, tracker_id INTEGER)')
+    conn.commit()
+    yield conn
+    conn.close()
+
+
+def test_view_attaches_to_recreated_bus(name, database):
+    database.execute('INSERT INTO tracked_objects VALUES (1, 5)')
+    database.commit()
+    bus = SelectionBus.create(name)
+    bus.publish({1: 5})
+    view = SelectionView(lambda: dict(database.execute('SELECT * FROM tracked_objects')),
+                         name=name, retry_interval=0.0)
+    assert view.get() == {1: 5}
+
+    # Operator restart: the old block is closed and unlinked, the database is emptied
+    bus.close()
+    database.execute('DELETE FROM tracked_objects')
+    database.commit()
+    assert view.get() == {}
+
+    bus = SelectionBus.create(name)
+    bus.publish({2: 9})
+    assert view.get() == {2: 9}
+    bus.publish({2: 9, 3: 4})
+    assert view.get() == {2: 9, 3: 4}
+    view.close()
+    bus.close()
+
+
+def test_view_notices_replaced_block_without_close(name):
+    bus = SelectionBus.create(name)
+    bus.publish({1: 5})
+    view = SelectionView(dict, name=name, retry_interval=0.0)
+    assert view.get() == {1: 5}
+
+    # A crashed operator never sets the closed flag, its block is only unlinked
+    bus.shm.unlink()
+    replacement = SelectionBus.create(name)
+    replacement.publish({1: 8})
+    assert view.get() == {1: 8}
+    view.close()
+    bus.owner = False
+    bus.close()
+    replacement.close()
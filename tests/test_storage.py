@@ -0,0 +1,39 @@
+import sqlite3
+
+import numpy as np
+import supervision as sv
+
+from storage import TrackHistoryStore
+
+
+def tracks(count):
+    return sv.Detections(xyxy=np.tile(np.array([[10.0, 10.0, 20.0, 20.0]]), (count, 1)),
+                         confidence=np.full(count, 0.9), class_id=np.zeros(count, dtype=int),
+                         tracker_id=np.arange(1, count + 1))
+
+
+def test_rows_are_written(tmp_path):
+    db_path = tmp_path / 'tracker_data.db'
+    store = TrackHistoryStore('camera-1', db_path=db_path, mode='all', commit_interval=0.05)
+    store.record(1, tracks(2))
+    store.record(2, tracks(2))
+    store.close()
+
+    with sqlite3.connect(db_path) as conn:
+        assert conn.execute('SELECT COUNT(*) FROM track_history WHERE source = ?', ('camera-1',)).fetchone() == (4,)
+    assert store.dropped == 0
+
+
+def test_failed_writes_are_dropped_and_counted(tmp_path):
+    db_path = tmp_path / 'tracker_data.db'
+    # Every insert violates the constraint, as if the disk were full
+    with sqlite3.connect(db_path) as conn:
+        conn.execute('''CREATE TABLE track_history
+                        (source TEXT, frame INTEGER, timestamp REAL, tracker_id INTEGER, class_id INTEGER,
+                         confidence REAL, x1 REAL CHECK (x1 < 0), y1 REAL, x2 REAL, y2 REAL)''')
+    store = TrackHistoryStore('camera-1', db_path=db_path, mode='all', commit_interval=0.05, max_retries=2)
+    store.record(1, tracks(3))
+    store.close()
+
+    assert store.dropped == 3
+    assert not store._thread.is_alive()
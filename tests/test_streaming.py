@@ -0,0 +1,32 @@
+import time
+import asyncio
+
+import numpy as np
+
+from streaming import Channel, parse_qualities
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_wake_without_new_frame_keeps_encoder_alive():
+    loop = asyncio.new_event_loop()
+    channel = Channel('view', parse_qualities('high:80:1.0'), loop)
+    channel.clients['high'] = 1
+    channel.publish(np.zeros((48, 64, 3), dtype=np.uint8))
+    assert wait_until(lambda: channel.encoded == 1)
+
+    # A wake-up with nothing new must neither encode an old buffer nor an empty one
+    channel._ready.set()
+    time.sleep(0.2)
+    assert channel._thread.is_alive()
+    assert channel.encoded == 1
+
+    channel.publish(np.ones((48, 64, 3), dtype=np.uint8))
+    assert wait_until(lambda: channel.encoded == 2)
+    channel.close()
+    loop.close()
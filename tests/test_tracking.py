@@ -0,0 +1,53 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import supervision as sv
+
+from tracking import BatchCollector
+
+
+class FakePipeline:
+    names = {0: 'person'}
+
+    def __init__(self):
+        self.batches = []
+
+    def fork(self):
+        return self
+
+    def detect_batch(self, frames, **overrides):
+        self.batches.append((len(frames), overrides))
+        return [sv.Detections(xyxy=np.array([[0.0, 0.0, frame.shape[1], frame.shape[0]]])) for frame in frames]
+
+    def associate(self, detections):
+        return detections
+
+
+def test_detections_of_parallel_steps_are_batched():
+    pipeline = FakePipeline()
+    batch = BatchCollector(pipeline)
+    members = [batch.member() for _ in range(4)]
+    results = {}
+
+    def step(i):
+        # The last step skips the detector, like a parked camera behind the motion gate
+        if i < 3:
+            results[i] = members[i].detect(np.zeros((10 + i, 20, 3), dtype=np.uint8), imgsz=320)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        batch.run(executor, [lambda i=i: step(i) for i in range(4)])
+
+    assert pipeline.batches == [(3, {'imgsz': 320})]
+    assert [results[i].xyxy[0, 3] for i in range(3)] == [10, 11, 12]
+
+
+def test_different_arguments_are_separate_batches():
+    pipeline = FakePipeline()
+    batch = BatchCollector(pipeline)
+    members = [batch.member() for _ in range(2)]
+    frame = np.zeros((10, 20, 3), dtype=np.uint8)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        batch.run(executor, [lambda: members[0].detect(frame, imgsz=320), lambda: members[1].detect(frame, imgsz=640)])
+
+    assert sorted(size for size, _ in pipeline.batches) == [1, 1]
@@ -0,0 +1,231 @@
+import os
+import logging
+import threading
+
+import numpy as np
+import supervision as sv
+
+import metrics
+from backends import imgsz, load_model, weights
+
+
+logger = logging.getLogger(__name__)
+
+# bytetrack: model.predict + one sv.ByteTrack, ultralytics: model.track with its built-in tracker
+BACKENDS = ('bytetrack', 'ultralytics')
+tracking_backend = os.getenv("TRACKER", "bytetrack")
+
+
+class TrackingPipeline:
+    """
+    Detection and tracking of one stream: one predict call and exactly one tracker per frame.
+    """
+
+    def __init__(self, model, backend=tracking_backend, tracker_config="bytetrack.yaml", **predict_args):
+        """
+        Args:
+            model: Loaded YOLO model, may be shared by several pipelines.
+            backend: One of BACKENDS.
+            tracker_config: Tracker config of the 'ultralytics' backend.
+            predict_args: Extra arguments of model.predict/model.track.
+        """
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown tracking backend {backend!r}, expected one of {BACKENDS}")
+        self.model = model
+        self.backend = backend
+        self.tracker_config = tracker_config
+        self.names = model.names
+        self.predict_args = {'verbose': False, 'agnostic_nms': True, **predict_args}
+        self.tracker = sv.ByteTrack() if backend == 'bytetrack' else None
+
+    @property
+    def separable(self):
+        """
+        True if detection and association can run separately (detect + associate).
+        """
+        return self.tracker is not None
+
+    def fork(self):
+        """
+        Returns:
+            A pipeline for another stream that shares the model but has its own tracker.
+        """
+        return TrackingPipeline(self.model, self.backend, self.tracker_config, **self.predict_args)
+
+    def detect(self, frame, **overrides):
+        """
+        Runs the detector only.
+
+        Args:
+            frame: Numpy image array.
+            overrides: predict arguments that replace the pipeline's ones for this call, e.g. imgsz.
+
+        Returns:
+            sv.Detections without tracker IDs.
+        """
+        return self.detect_batch([frame], **overrides)[0]
+
+    def detect_batch(self, frames, **overrides):
+        """
+        Runs the detector once over a batch of frames.
+
+        Returns:
+            List of sv.Detections without tracker IDs, one per frame.
+        """
+        # model.predict sets its predictor up once and reuses it for later calls
+        with metrics.inference_ms.time():
+            results = self.model.predict(frames, stream=False, **{**self.predict_args, **overrides})
+        return [sv.Detections.from_ultralytics(result) for result in results]
+
+    def associate(self, detections):
+        """
+        Assigns tracker IDs to the detections of the next frame.
+        """
+        with metrics.tracker_ms.time():
+            return self.tracker.update_with_detections(detections)
+
+    def __call__(self, frame, **overrides):
+        """
+        Detects and tracks the objects of the next frame.
+
+        Args:
+            frame: Numpy image array.
+            overrides: predict arguments that replace the pipeline's ones for this frame.
+
+        Returns:
+            sv.Detections with tracker IDs.
+        """
+        if self.backend == 'ultralytics':
+            # Detection and association run in one call, so both count as inference
+            with metrics.inference_ms.time():
+                result = self.model.track(source=frame,
+                                          persist=True,
+                                          tracker=self.tracker_config,
+                                          **{**self.predict_args, **overrides})[0]
+            detections = sv.Detections.from_ultralytics(result)
+            if result.boxes.id is None:
+                # Nothing confirmed by the tracker yet
+                detections = detections[:0]
+                detections.tracker_id = np.empty(0, dtype=int)
+            return detections
+        return self.associate(self.detect(frame, **overrides))
+
+
+class BatchCollector:
+    """
+    Gathers the detector calls of frame steps running in parallel threads into batched predicts.
+
+    Every stream gets a member() that stands in for its pipeline. The steps
+    decide themselves whether and on what they detect (motion gate, target
+    lock, ROI window); a member's detect() waits until every running step
+    detects or has finished, and then one predict runs over all waiting
+    frames with the same arguments. Association stays with each stream's own
+    tracker.
+    """
+
+    def __init__(self, pipeline):
+        """
+        Args:
+            pipeline: Separable TrackingPipeline whose model runs the batches.
+        """
+        self.pipeline = pipeline
+        self.batches = 0
+        self._cond = threading.Condition()
+        self._running = 0
+        # [frame, overrides, result, error, done] of the steps waiting for the detector
+        self._waiting = []
+
+    def member(self):
+        """
+        Returns:
+            A pipeline for one stream: batched detection, its own tracker.
+        """
+        return _BatchMember(self, self.pipeline.fork())
+
+    def run(self, executor, calls):
+        """
+        Runs the calls in the executor's threads and their detections in batches, until every call returned.
+
+        Raises:
+            The first exception of a call.
+        """
+        with self._cond:
+            self._running = len(calls)
+        futures = [executor.submit(self._call, call) for call in calls]
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: len(self._waiting) == self._running)
+                if not self._running:
+                    break
+                waiting, self._waiting = self._waiting, []
+            # Steps at the same governor level and window size share one predict
+            groups = {}
+            for request in waiting:
+                groups.setdefault(repr(sorted(request[1].items())), []).append(request)
+            for requests in groups.values():
+                try:
+                    results = self.pipeline.detect_batch([request[0] for request in requests], **requests[0][1])
+                    self.batches += 1
+                except Exception as e:
+                    results = [None] * len(requests)
+                    for request in requests:
+                        request[3] = e
+                for request, result in zip(requests, results):
+                    request[2] = result
+            with self._cond:
+                for request in waiting:
+                    request[4] = True
+                self._cond.notify_all()
+        for future in futures:
+            future.result()
+
+    def _call(self, call):
+        try:
+            call()
+        finally:
+            with self._cond:
+                self._running -= 1
+                self._cond.notify_all()
+
+    def detect(self, frame, overrides):
+        request = [frame, overrides, None, None, False]
+        with self._cond:
+            self._waiting.append(request)
+            self._cond.notify_all()
+            self._cond.wait_for(lambda: request[4])
+        if request[3] is not None:
+            raise request[3]
+        return request[2]
+
+
+class _BatchMember:
+    """
+    Pipeline interface of one stream of a BatchCollector.
+    """
+
+    separable = True
+
+    def __init__(self, batch, pipeline):
+        self.batch = batch
+        self.pipeline = pipeline
+        self.names = pipeline.names
+
+    def detect(self, frame, **overrides):
+        return self.batch.detect(frame, overrides)
+
+    def associate(self, detections):
+        return self.pipeline.associate(detections)
+
+    def __call__(self, frame, **overrides):
+        return self.associate(self.detect(frame, **overrides))
+
+
+def build_pipeline(backend=tracking_backend):
+    """
+    Loads the model and builds the tracking pipeline shared by the entry points.
+
+    The runtime (PyTorch, ONNX Runtime or OpenVINO), INT8 and imgsz come from backends.py.
+    """
+    model = load_model()
+    logger.info(f'Tracking pipeline: {weights}, backend {backend}')
+    return TrackingPipeline(model, backend, imgsz=imgsz)
@@ -1,12 +1,18 @@
-import cv2
+import startup
+import time
 import supervision as sv
 import numpy as np
-from ultralytics import YOLO
 import logging
 import sqlite3
 import sys
 
 import utils
+import metrics
+from selection_bus import SelectionView
+from display import open_viewer
+from governor import LatencyGovernor
+from frame_ring import FrameRing, FrameRingReader
+from detection_log import DetectionLog, ReplayReader, replay_log
 
 
 logging.basicConfig(level=logging.INFO)
@@ -77,77 +83,136 @@ def select_id(n):
         return None
 
 
-def device(tracker_id, n):
-    model = YOLO("yolov8n.pt")
-    source = "people-walking.mp4"
-    tracker = sv.ByteTrack()
-
-    box_annotator = sv.BoxAnnotator(
-        thickness=2,
-        text_thickness=1,
-        text_scale=0.5
-    )
-    corner_annotator = sv.BoxCornerAnnotator(
-        color=sv.Color(255, 0, 0),
-        thickness=3
-    )
-
-    label_annotator = sv.LabelAnnotator(
-        text_color=sv.Color(0, 0, 255))
-
-    # Getting results from YOLO
-    for result in model.track(source=source,
-                              show=False,
-                              stream=True,
-                              agnostic_nms=True):
-
-        frame = result.orig_img
-        detections = sv.Detections.from_ultralytics(result)
-
-        if result.boxes.id is not None:
-            detections.tracker_id = result.boxes.id.cpu().numpy().astype(int)
-
-        detections = tracker.update_with_detections(detections)
-
-        cv2.namedWindow(f'Drone-{n}', cv2.WINDOW_NORMAL)
-
-        # Filter detections based on selected tracker ID
-        if tracker_id is not None:
-            detections = detections[
-                np.isin(detections.tracker_id,
-                        get_list_tracked_object(get_tracked_objects(), n))
-            ]
-            # detections = detections[detections.tracker_id == get_tracked_objects()[1]]
-
-        # # Visualization of the text of the selected object in the upper left corner
-        for tracker_id in zip(detections.tracker_id):
-            utils.draw_object_for_tracking(frame, get_tracked_objects(), n)
-
-        # Visualization of frames
-        labels = [
-            f"#{tracker_id} {model.model.names[class_id]} {confidence:0.2f}"
-            for confidence, class_id, tracker_id
-            in zip(detections.confidence,
-                   detections.class_id,
-                   detections.tracker_id)
-        ]
-
-        annotated_frame = corner_annotator.annotate(
-            scene=frame.copy(),
-            detections=detections
+class ViewStep:
+    """
+    Work of a drone view on one frame from the inference server: filtering and annotation.
+
+    device(), pipeline.py and benchmark.py run the same step. `stage` wraps every stage of the frame.
+    """
+
+    def __init__(self, names, selection, viewer, tracker_id, n, governor=None, stage=utils.no_stage):
+        """
+        Args:
+            names: Class names of the model.
+            selection: SelectionView with the operator's selection, None when the caller passes it per frame.
+            viewer: Viewer the annotated frames are shown in.
+            tracker_id: Tracker ID selected at startup, None shows every track.
+            n: Position the view follows, None for a view of every position.
+            governor: LatencyGovernor of the view.
+            stage: Callable returning a context manager for a stage name.
+        """
+        self.selection = selection
+        self.viewer = viewer
+        self.tracker_id = tracker_id
+        self.n = n
+        # The server runs the detector, so here the governor only thins out the rendered frames
+        self.governor = governor or LatencyGovernor(name=f'view-{n}')
+        self.stage = stage
+        self.frame_count = 0
+        self.hud = utils.HudOverlay()
+        self.label_cache = utils.LabelCache(names)
+
+        self.corner_annotator = sv.BoxCornerAnnotator(
+            color=sv.Color(255, 0, 0),
+            thickness=3
         )
-        frame = label_annotator.annotate(
-            annotated_frame,
-            detections=detections,
-            labels=labels)
 
-        cv2.imshow(f'Drone-{n}', frame)
+        self.label_annotator = sv.LabelAnnotator(
+            text_color=sv.Color(0, 0, 255))
+
+    def __call__(self, frame, detections, tracked_objects=None):
+        """
+        Shows one frame of the ring.
+
+        Args:
+            frame: Numpy image array, annotated in place.
+            detections: Tracked sv.Detections of the frame.
+            tracked_objects: Selection of this frame (position -> tracker_id), read from `selection` when None.
+        """
+        stage, governor, n = self.stage, self.governor, self.n
+        self.frame_count += 1
+        frame_started = time.perf_counter()
+
+        with stage('selection'):
+            if tracked_objects is None:
+                tracked_objects = self.selection.get()
+
+            # Filter detections based on selected tracker ID
+            if self.tracker_id is not None:
+                detections = utils.select_tracks(detections, get_list_tracked_object(tracked_objects, n))
+                # detections = detections[detections.tracker_id == get_tracked_objects()[1]]
+            elif governor.selected_only and tracked_objects.get(n) is not None:
+                detections = utils.select_tracks(detections, [tracked_objects[n]])
+
+        # Annotation only when somebody watches, every detect_every-th frame when over budget
+        if self.viewer.attached and self.frame_count % governor.detect_every == 0:
+            with stage('annotation'):
+                # # Visualization of the text of the selected object in the upper left corner
+                if len(detections) and n is None:
+                    self.hud.apply(frame, tuple(tracked_objects.items()),
+                                   lambda canvas: utils.draw_tracked_objects(canvas, tracked_objects))
+                elif len(detections):
+                    self.hud.apply(frame, tracked_objects.get(n),
+                                   lambda canvas: utils.draw_object_for_tracking(canvas, tracked_objects, n))
+
+                # Visualization of frames
+                labels = self.label_cache(detections)
+
+                # The reader's frame buffer is annotated in place, it is reused after the next read
+                annotated_frame = self.corner_annotator.annotate(
+                    scene=frame,
+                    detections=detections
+                )
+                frame = self.label_annotator.annotate(
+                    annotated_frame,
+                    detections=detections,
+                    labels=labels)
+
+            with stage('display'):
+                self.viewer.show(frame)
+        startup.first_frame()
+        metrics.frames.inc()
+        frame_ms = (time.perf_counter() - frame_started) * 1000
+        metrics.frame_ms.observe(frame_ms)
+        governor.frame_done(frame_ms)
 
-        # Processing of keyboard shortcuts
-        key = cv2.waitKey(1) & 0xFF
-        if key == ord('q'):
+
+def device(tracker_id, n):
+    # Frames and tracked detections come from inference_server.py, or from a recorded log
+    if replay_log:
+        ring = reader = ReplayReader(DetectionLog(replay_log))
+    else:
+        ring = FrameRing.attach()
+        reader = FrameRingReader(ring)
+    startup.mark('attach')
+    selection = SelectionView(get_tracked_objects)
+    viewer = open_viewer(f'Drone-{n}')
+    step = ViewStep(ring.names, selection, viewer, tracker_id, n)
+
+    # Getting results from the inference server
+    while True:
+        item = reader.read()
+        if item is None:
+            if ring.closed:
+                logging.info(f'Inference server stopped')
+                break
+            # A stalled source, e.g. a camera reconnecting, is waited for
+            logging.info(f'No frame from the inference server, waiting')
+            if not viewer.poll():
+                break
+            continue
+        frame, detections, _, _ = item
+        step(frame, detections)
+
+        # Processing of keyboard shortcuts and shutdown signals
+        if not viewer.poll():
             break
 
+    logging.info(f'Frames skipped: {reader.dropped}')
+    ring.close()
+    selection.close()
+    viewer.close()
+
     # Close database connection after processing
     conn.close()
     logging.info(f'Database connection closed')
@@ -155,6 +220,8 @@ def device(tracker_id, n):
 
 def main():
     n = int(sys.argv[1])
+    startup.mark('imports')
+    metrics.start()
     device(select_id(n), n)
 
 
@@ -1,13 +1,13 @@
 import os
 import cv2
+import contextlib
+import numpy as np
 import logging
-import requests
 
-from dotenv import load_dotenv
+import metrics
 
 
 logger = logging.getLogger(__name__)
-load_dotenv()
 
 
 def draw_tracked_objects(frame, tracked_objects):
@@ -52,7 +52,7 @@ def draw_object_for_tracking(frame, tracked_objects, position):
     thickness = 2
     x, y = 20, 40
 
-    if not tracked_objects:
+    if not tracked_objects or position not in tracked_objects:
         # Displaying the text "No objects found"
         text = "No objects selected!!!"
         font_color = (0, 0, 255)
@@ -85,41 +85,221 @@ def draw_center(frame):
     cv2.line(frame, (x1, y1), (x2, y2), (0, 255, 0), thickness=line_thickness)
 
 
+class HudOverlay:
+    """
+    Caches the HUD drawn by the helpers above as the pixels it covers.
+
+    The HUD is rendered again only when the frame size or the HUD state
+    (e.g. the tracked_objects dict) changes; otherwise its opaque pixels are
+    copied and its anti-aliased edges blended onto the frame with vectorized
+    indexing, however many detections there are.
+    """
+
+    def __init__(self):
+        self.key = None
+
+    def apply(self, frame, state, draw):
+        """
+        Draws the cached HUD onto the frame.
+
+        Args:
+            frame: Numpy image array, modified in place.
+            state: Hashable description of everything the HUD shows.
+            draw: Callable that draws the HUD onto a frame-sized BGR canvas.
+        """
+        key = (frame.shape, state)
+        if key != self.key:
+            self._render(frame.shape, draw)
+            self.key = key
+
+        # A view into a larger image cannot be flattened in place, reshape copies it
+        contiguous = frame.flags.c_contiguous
+        pixels = frame.reshape(-1, 3)
+        # Opaque pixels are copied, only the anti-aliased edges are blended
+        pixels[self._opaque] = self._opaque_color
+        pixels[self._edge] = pixels[self._edge] * self._edge_transparency + self._edge_premultiplied
+        if not contiguous:
+            frame[...] = pixels.reshape(frame.shape)
+
+    def _render(self, shape, draw):
+        # Drawing on black and on white recovers the anti-aliased alpha of every pixel
+        black = np.zeros(shape, dtype=np.uint8)
+        white = np.full(shape, 255, dtype=np.uint8)
+        draw(black)
+        draw(white)
+        transparency = (white.astype(np.float32) - black) / 255
+        alpha = 1 - transparency.mean(axis=2)
+
+        # The HUD drawn on black is the color premultiplied by alpha
+        flat_alpha = alpha.reshape(-1)
+        self._opaque = np.flatnonzero(flat_alpha >= 1)
+        self._opaque_color = black.reshape(-1, 3)[self._opaque]
+        self._edge = np.flatnonzero((flat_alpha > 0) & (flat_alpha < 1))
+        self._edge_transparency = transparency.reshape(-1, 3)[self._edge]
+        self._edge_premultiplied = black.reshape(-1, 3)[self._edge].astype(np.float32)
+
+
+class LabelCache:
+    """
+    Label strings "#<tracker_id> <class> <confidence>" with the prefix built once per track and class.
+
+    Confidences change every frame, so only "#<tracker_id> <class>" is cached
+    and the confidence is appended; the cache is emptied when it holds more
+    than `max_size` prefixes.
+    """
+
+    def __init__(self, names, max_size=8192):
+        self.names = names
+        self.max_size = max_size
+        self.prefixes = {}
+
+    def __call__(self, detections):
+        """
+        Returns:
+            List of the labels of the detections.
+        """
+        if not len(detections):
+            return []
+        if len(self.prefixes) > self.max_size:
+            self.prefixes.clear()
+        labels = []
+        for tracker_id, class_id, confidence in zip(detections.tracker_id.tolist(), detections.class_id.tolist(),
+                                                    detections.confidence.tolist()):
+            prefix = self.prefixes.get((tracker_id, class_id))
+            if prefix is None:
+                prefix = self.prefixes[tracker_id, class_id] = f"#{tracker_id} {self.names[class_id]}"
+            labels.append(f"{prefix} {confidence:0.2f}")
+        return labels
+
+
+def no_stage(name):
+    """
+    Stage hook of the frame steps that measures nothing; benchmark.py passes one that times every stage.
+    """
+    return contextlib.nullcontext()
+
+
+def select_tracks(detections, tracker_ids):
+    """
+    Keeps the detections of the given tracks.
+
+    Returns:
+        The detections themselves when all of them are kept, otherwise a filtered copy.
+    """
+    if not len(detections):
+        return detections
+    mask = np.isin(detections.tracker_id, list(tracker_ids or ()))
+    if mask.all():
+        return detections
+    return detections[mask]
+
+
 # commands
 login = os.getenv("LOGIN")
 password = os.getenv("PASSWORD")
 ip_cam = os.getenv("IP_CAM")
-url_command = f'http://{ip_cam}/decoder_control.cgi?loginuse={login}&loginpas={password}'
-cam_up = f'{url_command}&command=0&onestep=1&17024724560030.8794677227005614&_=170247245600'
-cam_down = f'{url_command}&command=2&onestep=1&17024723729880.2857110046917418&_=1702472372988'
-cam_left = f'{url_command}&command=6&onestep=1&17024707176350.2731615502645298&_=1702470717636'
-cam_right = f'{url_command}&command=4&onestep=1&17024706046250.6925916266171585&_=1702470604625'
 
 
-def cam_command_left():
-    logging.info(f'turn left')
-    # return requests.request("GET", url=cam_left)
+def cam_stream_url(ip):
+    return f'http://{ip}/videostream.cgi?loginuse={login}&loginpas={password}'
+
+
+def cam_commands(ip):
+    """
+    Builds the PTZ command URLs of one camera.
+
+    Args:
+        ip: Address of the camera.
+
+    Returns:
+        Dict with the 'up', 'down', 'left' and 'right' one-step command URLs, the
+        '<direction>_start' URLs of a continuous movement and the '<direction>_stop' URLs ending it.
+    """
+    url_command = f'http://{ip}/decoder_control.cgi?loginuse={login}&loginpas={password}'
+    commands = {
+        'up': f'{url_command}&command=0&onestep=1&17024724560030.8794677227005614&_=170247245600',
+        'down': f'{url_command}&command=2&onestep=1&17024723729880.2857110046917418&_=1702472372988',
+        'left': f'{url_command}&command=6&onestep=1&17024707176350.2731615502645298&_=1702470717636',
+        'right': f'{url_command}&command=4&onestep=1&17024706046250.6925916266171585&_=1702470604625',
+    }
+    # decoder_control.cgi: a command without onestep moves until the next (odd) stop command
+    for name, command in (('up', 0), ('down', 2), ('left', 6), ('right', 4)):
+        commands[f'{name}_start'] = f'{url_command}&command={command}'
+        commands[f'{name}_stop'] = f'{url_command}&command={command + 1}'
+    return commands
+
+
+commands = cam_commands(ip_cam)
+cam_up = commands['up']
+cam_down = commands['down']
+cam_left = commands['left']
+cam_right = commands['right']
+
+
+def load_env():
+    """
+    Loads the .env file into the environment and reads the camera settings again.
+
+    Called first in the main() of the entry points that talk to the camera, so
+    importing utils does not pay for python-dotenv. Only LOGIN, PASSWORD and
+    IP_CAM are taken from .env; other settings are read when their module is imported.
+    """
+    global login, password, ip_cam, cam_up, cam_down, cam_left, cam_right
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    login = os.getenv("LOGIN")
+    password = os.getenv("PASSWORD")
+    ip_cam = os.getenv("IP_CAM")
+    # Updated in place, move_cam's default refers to this dict
+    commands.update(cam_commands(ip_cam))
+    cam_up, cam_down, cam_left, cam_right = (commands[name] for name in ('up', 'down', 'left', 'right'))
+
 
+def cam_command_left(url=cam_left):
+    if metrics.frame_log:
+        logging.info(f'turn left')
+    # return requests.request("GET", url=url)
 
-def cam_command_right():
-    logging.info(f'turn right')
-    # return requests.request("GET", url=cam_right)
 
+def cam_command_right(url=cam_right):
+    if metrics.frame_log:
+        logging.info(f'turn right')
+    # return requests.request("GET", url=url)
 
-def cam_command_up():
-    logging.info(f'turn up')
-    # return requests.request("GET", url=cam_up)
 
+def cam_command_up(url=cam_up):
+    if metrics.frame_log:
+        logging.info(f'turn up')
+    # return requests.request("GET", url=url)
 
-def cam_command_down():
-    logging.info(f'turn down')
-    # return requests.request("GET", url=cam_down)
 
+def cam_command_down(url=cam_down):
+    if metrics.frame_log:
+        logging.info(f'turn down')
+    # return requests.request("GET", url=url)
+
+
+def move_cam(frame, detect, commands=commands, dispatcher=None):
+    """
+    Turns the camera towards the detections that are not in the center.
 
-def move_cam(frame, detect):
+    The commands of all detections are merged into one movement per call,
+    conflicting directions cancel out.
+
+    Args:
+        frame: Numpy image array.
+        detect: sv.Detections of the frame.
+        commands: Dict of PTZ command URLs of the camera.
+        dispatcher: Optional ptz.PTZDispatcher that sends the movement in the background.
+
+    Returns:
+        Tuple (horizontal, vertical): -1/1 for the 'left'/'right' and 'up'/'down' commands, 0 for none.
+    """
     height, width, _ = frame.shape
     center_w = int(width / 2)  # X = 320
     center_h = int(height / 2)  # Y = 240
+    horizontal, vertical = 0, 0
     for xyxy in zip(detect.xyxy):
         x1, y1, x2, y2 = xyxy[0]
         x1, y1, x2, y2 = round(x1), round(y1), round(x2), round(y2)
@@ -130,29 +310,45 @@ def move_cam(frame, detect):
             #   0|0|0
             #   0|X|0
             #   0|0|0
-            logging.info(f'object is in the center. \n')
-            pass
+            if metrics.frame_log:
+                logging.info(f'object is in the center. \n')
         else:
-            logging.info(f'object is not in the center\n'
-                         f'{center_h}, {center_w} - ({x1}, {y1}),({x2}, {y2})')
+            if metrics.frame_log:
+                logging.info(f'object is not in the center\n'
+                             f'{center_h}, {center_w} - ({x1}, {y1}),({x2}, {y2})')
             if y1 > center_h:
                 #   X|X|X
                 #   0|O|0
                 #   0|0|0
-                cam_command_down()
+                vertical += 1  # down
             if x2 < center_w and y1 < center_h < y2:
                 #   0|0|0
                 #   X|O|0
                 #   0|0|0
-                cam_command_right()
+                horizontal += 1  # right
             if x1 > center_w and y1 < center_h < y2:
                 #   0|0|0
                 #   0|O|X
                 #   0|0|0
-                cam_command_left()
+                horizontal -= 1  # left
             if y2 < center_h:
                 #   0|0|0
                 #   0|O|0
                 #   X|X|X
-                cam_command_up()
+                vertical -= 1  # up
+
+    horizontal = (horizontal > 0) - (horizontal < 0)
+    vertical = (vertical > 0) - (vertical < 0)
+    if dispatcher is not None:
+        dispatcher.submit(horizontal, vertical)
+        return horizontal, vertical
 
+    if horizontal > 0:
+        cam_command_right(commands['right'])
+    elif horizontal < 0:
+        cam_command_left(commands['left'])
+    if vertical > 0:
+        cam_command_down(commands['down'])
+    elif vertical < 0:
+        cam_command_up(commands['up'])
+    return horizontal, vertical
@@ -0,0 +1,172 @@
+import startup
+import os
+import sys
+import json
+import time
+import signal
+import socket
+import logging
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Unix socket of the daemon; `python warm.py view <n>` talks to it
+warm_socket = os.getenv("WARM_SOCKET", "/tmp/dst_warm.sock")
+
+
+def preload():
+    """
+    Imports everything a drone view needs, once; forked views start with it in memory.
+    """
+    import numpy
+    import cv2
+    import supervision
+    import utils
+    import metrics
+    import display
+    import frame_ring
+    import selection_bus
+    import detection_log
+    startup.mark('preload')
+
+
+def _fork(target, *args):
+    """
+    Runs target(*args) in a forked child.
+
+    Returns:
+        The pid of the child.
+    """
+    pid = os.fork()
+    if pid:
+        return pid
+    code = 0
+    try:
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        target(*args)
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else 0
+    except BaseException:
+        logger.exception(f'{target.__name__} failed')
+        code = 1
+    finally:
+        logging.shutdown()
+        os._exit(code)
+
+
+def _run_server(source):
+    # The model is loaded in this child and stays loaded while views come and go
+    startup.reset()
+    import inference_server
+    inference_server.install_signal_handlers()
+    inference_server.serve(source)
+
+
+def _run_view(n, report, exit_after_first_frame):
+    startup.reset()
+    startup.startup_report = report
+    startup.startup_exit = exit_after_first_frame
+    import uav
+    startup.mark('imports')
+    uav.device(uav.select_id(n), n)
+
+
+def serve(source="people-walking.mp4", with_server=True):
+    """
+    Runs the warm daemon: preloads the view dependencies, keeps the inference
+    server (model and tracker) running and forks views on request.
+
+    Args:
+        source: Video file or stream of the inference server.
+        with_server: Also run the inference server; restarted if it dies.
+    """
+    from display import install_signal_handlers, shutdown
+
+    preload()
+    install_signal_handlers()
+    if os.path.exists(warm_socket):
+        os.unlink(warm_socket)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(warm_socket)
+    listener.listen()
+    listener.settimeout(0.5)
+
+    children = {}
+    server_pid = None
+    logger.info(f'Warm daemon on {warm_socket}')
+    try:
+        while not shutdown.is_set():
+            if with_server and server_pid is None:
+                server_pid = _fork(_run_server, source)
+                children[server_pid] = 'inference server'
+
+            # Reap finished children
+            while children:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+                if not pid:
+                    break
+                logger.info(f'{children.pop(pid, pid)} (pid {pid}) exited with {os.waitstatus_to_exitcode(status)}')
+                if pid == server_pid:
+                    server_pid = None
+
+            try:
+                connection, _ = listener.accept()
+            except socket.timeout:
+                continue
+            with connection:
+                request = json.loads(connection.makefile().readline() or '{}')
+                command = request.get('cmd')
+                if command == 'view':
+                    n = int(request['n'])
+                    pid = _fork(_run_view, n, request.get('report'), bool(request.get('exit')))
+                    children[pid] = f'view {n}'
+                    reply = {'pid': pid}
+                elif command == 'status':
+                    reply = {'children': {str(pid): name for pid, name in children.items()}}
+                elif command == 'stop':
+                    shutdown.set()
+                    reply = {'stopping': True}
+                else:
+                    reply = {'error': f'unknown command {command!r}'}
+                connection.sendall(json.dumps(reply).encode() + b'\n')
+    finally:
+        listener.close()
+        os.unlink(warm_socket)
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        for pid in list(children):
+            os.waitpid(pid, 0)
+        logger.info('Warm daemon stopped')
+
+
+def request(message, timeout=5.0):
+    """
+    Sends one command to the daemon.
+
+    Returns:
+        The daemon's reply as a dict.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(warm_socket)
+        client.sendall(json.dumps(message).encode() + b'\n')
+        return json.loads(client.makefile().readline())
+
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else 'serve'
+    if command == 'serve':
+        serve(*sys.argv[2:3])
+    elif command == 'view':
+        started = time.perf_counter()
+        reply = request({'cmd': 'view', 'n': int(sys.argv[2])})
+        logger.info(f'View {sys.argv[2]}: pid {reply["pid"]} in {(time.perf_counter() - started) * 1000:.0f} ms')
+    else:
+        print(json.dumps(request({'cmd': command})))
+
+
+if __name__ == "__main__":
+    main()
+# cmd python warm.py serve; python warm.py view 1